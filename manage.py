@@ -1,5 +1,6 @@
 import os
 import subprocess
+import time
 
 from flask import current_app
 from flask_script import Manager, Shell
@@ -84,6 +85,132 @@ def initdb():
     db.session.commit()
 
 
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=20,
+                help='Number of Eve submissions ingested per transaction')
+@manager.option('-s', '--sleep', dest='sleep', type=float, default=2,
+                help='Seconds to wait when the queue is empty')
+@manager.option('--once', dest='once', action='store_true', default=False,
+                help='Exit once the queue is empty')
+def eve_worker(batch_size, sleep, once):
+    """Drains the queue of Eve submissions (see EVE_ASYNC_INGEST).
+    """
+    from portal.api.eve import drain_eve_queue
+
+    while True:
+        try:
+            processed = drain_eve_queue(batch_size)
+        except Exception:
+            # e.g. the database is unreachable, the claimed submissions are
+            # released after EveSubmission.STALE_AFTER
+            app.logger.exception('Draining the Eve queue failed.')
+            db.session.rollback()
+            processed = 0
+
+        if processed:
+            app.logger.info('Ingested %s Eve submissions.', processed)
+            continue
+        if once:
+            break
+        time.sleep(sleep)
+
+
+@manager.option('--once', dest='once', action='store_true', default=False,
+                help='Exit after one run')
+def widget_refresher(once):
+    """Keeps the cached widgets warm every WIDGET_REFRESH_INTERVAL seconds. Run a
+    single instance of it (see Procfile).
+    """
+    from portal.utils.widgets import refresh_widgets
+
+    while True:
+        try:
+            refreshed = refresh_widgets(app)
+            if refreshed:
+                app.logger.info('Refreshed %s widgets.', refreshed)
+        except Exception:
+            app.logger.exception('Failed to refresh widgets.')
+            db.session.remove()
+
+        if once:
+            break
+        time.sleep(app.config['WIDGET_REFRESH_INTERVAL'])
+
+
+@manager.command
+def eve_queue():
+    """Prints the depth and lag of the Eve submission queue.
+    """
+    from portal.api.models import EveSubmission
+
+    depth, lag = EveSubmission.get_stats()
+    print 'depth: %s' % depth
+    print 'lag: %s' % (lag or '-')
+
+
+@manager.option('--rebuild', dest='rebuild', action='store_true', default=False,
+                help='Delete all snapshots and backfill them from accounts_version')
+def snapshot_accounts(rebuild):
+    """Takes the end of day snapshots of every account up to yesterday (HKT).
+    Run this daily, e.g. with Heroku Scheduler.
+    """
+    from portal.account.models import AccountSnapshot
+
+    if rebuild:
+        AccountSnapshot.query.delete()
+        db.session.commit()
+
+    count = AccountSnapshot.take()
+    app.logger.info('Snapshotted accounts for %s days.', count)
+
+
+@manager.command
+def reconcile_account_counts():
+    """Recomputes the per vendor and per VPS account status tallies from scratch and
+    prints the ones that had drifted.
+    """
+    from portal.account.counters import reconcile
+
+    drift = reconcile()
+    for owner_type, owner_id, status, stored, actual in drift:
+        print '%s %s %s: %s -> %s' % (owner_type, owner_id, status.value, stored, actual)
+    app.logger.info('Reconciled account counts, %s had drifted.', len(drift))
+
+
+@manager.option('path', help='CSV or XLSX file with the columns of Batch Add')
+@manager.option('-u', '--username', dest='username', required=True,
+                help='Admin whom the accounts are created by')
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int, default=None,
+                help='Accounts committed per transaction (ACCOUNT_IMPORT_CHUNK_SIZE)')
+def import_accounts(path, username, chunk_size):
+    """Creates accounts from a CSV or XLSX file, like Batch Add does. Rows with errors
+    are printed and skipped.
+    """
+    from flask_login import login_user
+    from portal.account.HandsonUploader import iter_file_rows
+    from portal.account.models import Account
+    from portal.account.views import AdminAccountModelView
+
+    user = User.query.filter_by(username=username).one()
+    if RolesEnum.ADMIN.value not in [role.name for role in user.roles]:
+        raise ValueError('%s is not an admin.' % username)
+
+    chunk_size = chunk_size or app.config['ACCOUNT_IMPORT_CHUNK_SIZE']
+    with app.test_request_context(), open(path, 'rb') as f:
+        # Versions are recorded as created by the user
+        login_user(user)
+        view = AdminAccountModelView(Account, db.session, endpoint='import_account')
+
+        for item in view.import_rows(iter_file_rows(f, path), chunk_size):
+            if 'errors' in item:
+                for label, messages in item['errors']:
+                    print (u'Row %s: %s %s' % (item['row'], label, u', '.join(messages))) \
+                        .encode('utf-8')
+            elif 'done' in item:
+                app.logger.info('Imported %s accounts.', item['accounts_added'])
+            else:
+                app.logger.info('Row %s: %s accounts added.', item['row'], item['accounts_added'])
+
+
 if __name__ == "__main__":
     if not os.path.exists('./requirements.txt'):
         raise Exception("You must run manage.py in the root directory of portal")
@@ -1,18 +1,44 @@
 import json
-
-from flask import jsonify, request
+import logging
+import os
+from itertools import chain
+
+import openpyxl
+import unicodecsv
+from flask import (Response, abort, current_app, jsonify, request,
+                   stream_with_context)
 from flask_admin import expose
+from flask_admin._compat import text_type
 from flask_admin.contrib.sqla import ModelView
 from flask_babelex import lazy_gettext
 from portal.account.models import AccountStatusHelper
-from portal.models import db
 from werkzeug.datastructures import MultiDict
 
+log = logging.getLogger(__name__)
+
+QUERY_SELECT_FIELDS = ['QuerySelectField', 'QuerySelectMultipleField']
+
 
 def encode_utf8(obj):
     return unicode(obj).encode('utf-8')
 
 
+def iter_file_rows(f, filename):
+    """Returns an iterator over the rows of a CSV or XLSX file, as lists of cell values.
+    Rows are read as they are iterated, the file is never loaded whole.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        return unicodecsv.reader(f, encoding='utf-8-sig')
+    if ext == '.xlsx':
+        try:
+            workbook = openpyxl.load_workbook(f, read_only=True, data_only=True)
+        except Exception:
+            raise ValueError('%s is not a valid XLSX file.' % filename)
+        return ([cell.value for cell in row] for row in workbook.active.iter_rows())
+    raise ValueError('Only .csv and .xlsx files can be imported.')
+
+
 class HandsonUploader(ModelView):
 
     # it's very difficult to make this class abstract
@@ -90,7 +116,7 @@ class HandsonUploader(ModelView):
 
             if field.type == 'EnumField':
                 pass        # noop - Check for "status" explicitly instead.
-            elif field.type in ['QuerySelectField', 'QuerySelectMultipleField']:
+            elif field.type in QUERY_SELECT_FIELDS:
                 prop['type'] = 'dropdown'
                 c = []
                 for value, obj, checked in field.iter_choices():
@@ -104,7 +130,23 @@ class HandsonUploader(ModelView):
     def is_empty(self, row):
         return not any(row)
 
-    def map_row_to_dict(self, row):
+    def get_reverse_maps(self, fields):
+        """Returns { field name: { label: value } } of the QuerySelect fields.
+
+        When we rendered the form, we mapped an object to a string. Now, we will map
+        the object to a string and then associate it with a value which we will be
+        assigning to the wtform later.
+        """
+        ret = {}
+        for field in fields:
+            if field.type in QUERY_SELECT_FIELDS:
+                reverse_map = {}
+                for value, obj, checked in field.iter_choices():
+                    reverse_map[encode_utf8(obj)] = value
+                ret[field.name] = reverse_map
+        return ret
+
+    def map_row_to_dict(self, row, fields=None, reverse_maps=None):
         """Maps raw data from JS (handson-table) to data compatible to WTForm.
 
         For each WTForm field, these are the label and values from self.get_create_form()
@@ -118,8 +160,14 @@ class HandsonUploader(ModelView):
 
         LABEL is rendered in JS handson table. To achieve what we want,
         we need to map these labels back to values.
+
+        Pass `fields` and `reverse_maps` when mapping many rows so that the form and
+        its choices are only built once.
         """
-        fields = self.get_wtfields()
+        if fields is None:
+            fields = self.get_wtfields()
+        if reverse_maps is None:
+            reverse_maps = self.get_reverse_maps(fields)
         assert len(fields) == len(row), "JS Table columns does not match WTForm's."
 
         data = MultiDict()
@@ -139,16 +187,9 @@ class HandsonUploader(ModelView):
                     else:
                         pass            # no status given, hand off to sqlalchemy for default
 
-            elif field.type in ['QuerySelectField', 'QuerySelectMultipleField']:
-                reverse_map = {}
-                for value, obj, checked in field.iter_choices():
-                    # When we rendered the form, we mapped an object to a string.    Now,
-                    # we will map the object to a string and then associate it with a
-                    # value which we will be assigning to the wtform later
-                    label = encode_utf8(obj)
-                    reverse_map[label] = value
+            elif field.type in QUERY_SELECT_FIELDS:
                 try:
-                    data[field.name] = reverse_map[encode_utf8(raw_value)]
+                    data[field.name] = reverse_maps[field.name][encode_utf8(raw_value)]
                 except KeyError:
                     # NOTE: we cannot attach this error to the wtform right here because
                     # wtform.field.errors can only be appended after you have binded data
@@ -173,34 +214,225 @@ class HandsonUploader(ModelView):
         # {row_num: {label: [ error_msg, .. ]}
         errors = {}
 
-        for row_num, row in enumerate(json.loads(request.form['rows'])):
+        for row_num, form, row_errors in self.iter_row_forms(json.loads(request.form['rows'])):
+            if form:
+                good_forms.append(form)
+            else:
+                errors[row_num] = row_errors
+
+        # If we have any errors, do not proceed with creation and saving
+        if errors:
+            return jsonify({'success': False, 'errors': errors, 'accounts_added': 0})
+
+        try:
+            self.create_models(good_forms)
+        except Exception as ex:
+            return jsonify({'success': False, 'errors': {}, 'accounts_added': 0,
+                            'message': str(ex)})
+
+        return jsonify({'success': True, 'accounts_added': len(good_forms)})
+
+    def get_preloaded_form(self, fields):
+        """Returns a subclass of the create form whose QuerySelect fields choose from
+        the choices of `fields`, queried once here rather than once per row.
+        """
+        form_class = self.get_create_form()
+        attrs = {}
+        for field in fields:
+            if field.type in QUERY_SELECT_FIELDS:
+                objects = list(field.query if field.query is not None else field.query_factory())
+                unbound = getattr(form_class, field.name)
+                kwargs = dict(unbound.kwargs, query_factory=lambda objects=objects: objects)
+                attrs[field.name] = unbound.field_class(*unbound.args, **kwargs)
+        return type(form_class)(form_class.__name__, (form_class, ), attrs)
+
+    def iter_row_forms(self, rows, fields=None, start=1):
+        """Yields (row_num, form, errors) for every non-empty row, numbered from `start`.
+        Rows are lists of handson table values in the order of `fields`.
+
+        `form` is validated and None if it is not valid, in which case `errors` is
+        [(translated label, [ error_msg, .. ])].
+        """
+        # Built once instead of once per row
+        if fields is None:
+            fields = self.get_wtfields()
+        form_class = self.get_preloaded_form(fields)
+        reverse_maps = self.get_reverse_maps(fields)
+
+        for row_num, row in enumerate(rows, start):
             if self.is_empty(row):
                 continue
 
-            form = self.get_create_form()
-            data = self.map_row_to_dict(row)
-            form = form(data)
+            data = self.map_row_to_dict(row, fields, reverse_maps)
+            form = form_class(data)
             if form.validate():
-                good_forms.append(form)
+                yield row_num, form, None
             else:
                 # Map the field_name to label for translation purposes
                 new_errors = []
                 for field_name, messages in form.errors.iteritems():
                     translated_label = lazy_gettext(getattr(form, field_name).label.text)
                     new_errors.append((translated_label, messages))
-                errors[row_num + 1] = new_errors
+                yield row_num, None, new_errors
 
-        # If we have any errors, do not proceed with creation and saving
-        if errors:
-            return jsonify({'success': False, 'errors': errors, 'accounts_added': 0})
+    @expose('/handson_batch/import', methods=['POST'])
+    def import_file(self):
+        """Creates accounts from an uploaded CSV or XLSX file, see import_rows.
+
+        The progress is streamed back as it happens, one JSON object per line.
+        """
+        if not self.can_create:
+            abort(403)
+
+        f = request.files.get('file')
+        if not f:
+            return jsonify({'error': 'No file uploaded.'}), 400
+
+        try:
+            progress = self.import_rows(iter_file_rows(f.stream, f.filename),
+                                        current_app.config['ACCOUNT_IMPORT_CHUNK_SIZE'])
+        except ValueError as ex:
+            return jsonify({'error': text_type(ex)}), 400
+
+        def generate():
+            try:
+                for item in progress:
+                    yield json.dumps(item, cls=current_app.json_encoder) + '\n'
+            except Exception as ex:
+                # The file is read as the rows are imported, so e.g. a UnicodeDecodeError,
+                # a csv.Error or a bad XLSX row only shows up here
+                log.exception('Import of %s stopped.', f.filename)
+                yield json.dumps({'error': text_type(ex)}) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='text/plain')
+
+    def get_column_indexes(self, header, fields):
+        """Maps each column of the header of an imported file to the index of its field
+        in `fields`, or None for blank columns.
+
+        Columns are matched by field name or by label (as in handson table), ignoring case
+        and the ' *' of required fields.
+        """
+        lookup = {}
+        for i, field in enumerate(fields):
+            for key in [field.name, field.label.text, lazy_gettext(field.label.text)]:
+                lookup[unicode(key).lower()] = i
+
+        ret = []
+        for column in header:
+            key = unicode(column or '').strip().rstrip('*').strip().lower()
+            if not key:
+                ret.append(None)
+            elif key in lookup:
+                ret.append(lookup[key])
+            else:
+                raise ValueError('Unknown column: %s' % column)
+        return ret
 
-        for form in good_forms:
-            model = self.model()
-            form.populate_obj(model)
-            db.session.add(model)         # TODO remove db reference to DRY
-            self._on_model_change(form, model, True)
-            # NOTE .commit has been moved here (inside the loop) due to
-            # unique nature of transaction_id for account_vps_version
-            db.session.commit()
+    def import_rows(self, rows, chunk_size):
+        """Creates an account per row of `rows`, whose first row is the header. Accepts
+        the same values as handson table and validates them with the same form.
 
-        return jsonify({'success': True, 'accounts_added': len(good_forms)})
+        Valid rows are committed every `chunk_size` rows, invalid ones are skipped.
+        Raises ValueError if the header is not understood, otherwise returns an iterator
+        of progress reports:
+
+            {'row': row_num, 'errors': [(label, [ error_msg, .. ])]}
+                for each row which was not created
+            {'row': row_num, 'accounts_added': total}
+                after each chunk
+            {'accounts_added': total, 'done': True}
+                at the end
+
+        Row numbers are those of the file, starting at 2 after the header.
+        """
+        rows = iter(rows)
+        fields = self.get_wtfields()
+        indexes = self.get_column_indexes(next(rows, []), fields)
+
+        def _align(row):
+            ret = [None] * len(fields)
+            for index, value in zip(indexes, row):
+                if index is not None and value not in (None, ''):
+                    ret[index] = value
+            return ret
+
+        def _import():
+            # The choices preloaded by get_preloaded_form serve every chunk, the commits
+            # of create_chunk would expire them and each chunk would load them again
+            session = self.session()
+            expire_on_commit, session.expire_on_commit = session.expire_on_commit, False
+            try:
+                total = 0
+                chunk = []
+                # None marks the end of the rows, to commit the last chunk
+                for item in chain(self.iter_row_forms((_align(row) for row in rows),
+                                                      fields, start=2), [None]):
+                    if item is not None:
+                        row_num, form, errors = item
+                        if form is None:
+                            yield {'row': row_num, 'errors': errors}
+                            continue
+                        chunk.append((row_num, form))
+                        if len(chunk) < chunk_size:
+                            continue
+
+                    if chunk:
+                        created, failures = self.create_chunk(chunk)
+                        total += created
+                        for failed_row_num, message in failures:
+                            yield {'row': failed_row_num, 'errors': [('', [message])]}
+                        yield {'row': chunk[-1][0], 'accounts_added': total}
+                        chunk = []
+
+                yield {'accounts_added': total, 'done': True}
+            finally:
+                session.expire_on_commit = expire_on_commit
+
+        return _import()
+
+    def create_chunk(self, chunk):
+        """Creates the models of a chunk of [(row_num, form)] in one transaction. If that
+        fails, they are created one by one so that only the bad rows are left out.
+
+        Returns (number of models created, [(row_num, error_msg)]).
+        """
+        try:
+            self.create_models([form for row_num, form in chunk])
+            return len(chunk), []
+        except Exception as ex:
+            if len(chunk) == 1:
+                return 0, [(chunk[0][0], str(getattr(ex, 'orig', ex)))]
+
+        created = 0
+        failures = []
+        for row_num, form in chunk:
+            try:
+                self.create_models([form])
+                created += 1
+            except Exception as ex:
+                failures.append((row_num, str(getattr(ex, 'orig', ex))))
+        return created, failures
+
+    def create_models(self, forms):
+        """Creates the models of all `forms` in a single transaction, and so in a single
+        Continuum transaction. Either all of them are created or none.
+        """
+        models = []
+        try:
+            with self.session.no_autoflush:
+                for form in forms:
+                    model = self.model()
+                    form.populate_obj(model)
+                    self.session.add(model)
+                    self._on_model_change(form, model, True)
+                    models.append(model)
+            self.session.commit()
+        except Exception:
+            log.exception('Failed to create records.')
+            self.session.rollback()
+            raise
+
+        for form, model in zip(forms, models):
+            self.after_model_change(form, model, True)
+        return models
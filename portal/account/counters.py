@@ -0,0 +1,193 @@
+"""Tallies of account statuses per vendor and per VPS.
+
+They are kept up to date by session events whenever a flush inserts or deletes an
+account, or changes its status, vendor or VPSs. Writes that bypass the session
+(Core UPDATEs, psql) are not seen, `python manage.py reconcile_account_counts`
+recomputes everything from scratch and reports the drift.
+"""
+from collections import Counter, defaultdict
+
+from portal.account.models import Account, AccountStatus, association_table
+from portal.models import db
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+DEAD = [AccountStatus.SUSPENDED, AccountStatus.ABANDONED]
+
+VENDOR = 'vendor'
+VPS = 'vps'
+
+# Changing any of these moves an account from one tally to another
+TRACKED_ATTRIBUTES = ['status', 'vendor', 'vendor_id', 'VPSs']
+
+INFO_KEY = 'account_status_counts'
+
+
+class AccountStatusCount(db.Model):
+    """Number of accounts of a vendor or VPS (owner) in a status.
+    A missing row means 0.
+    """
+    __tablename__ = 'account_status_counts'
+
+    owner_type = db.Column(db.String(8), primary_key=True)
+    owner_id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    status = db.Column(db.Enum(AccountStatus, name='account_status'), primary_key=True)
+    count = db.Column(db.Integer(), nullable=False, default=0)
+
+
+def _get_owner_column(owner_type):
+    if owner_type == VENDOR:
+        return Account.vendor_id
+    return association_table.c.vps_id
+
+
+def _count(session, owner_type, owner_ids=None):
+    """Returns { (owner id, status): count } computed from the accounts.
+    """
+    owner = _get_owner_column(owner_type)
+    query = session.query(owner, Account.status, func.count(Account.id)) \
+        .select_from(Account).filter(owner.isnot(None))
+    if owner_type == VPS:
+        query = query.join(association_table, association_table.c.account_id == Account.id)
+    if owner_ids is not None:
+        query = query.filter(owner.in_(owner_ids))
+    return {(owner_id, status): count
+            for owner_id, status, count in query.group_by(owner, Account.status)}
+
+
+def get_status_counts(owner_type, owner_ids):
+    """Returns { owner id: { status: count } }, owners without accounts are left out.
+    """
+    ret = defaultdict(dict)
+    if owner_ids:
+        for row in AccountStatusCount.query.filter(
+                AccountStatusCount.owner_type == owner_type,
+                AccountStatusCount.owner_id.in_(owner_ids),
+                AccountStatusCount.count > 0):
+            ret[row.owner_id][row.status] = row.count
+    return ret
+
+
+def add_deltas(session, deltas):
+    """Adds { (owner type, owner id, status): delta } to the tallies.
+
+    The increment happens in the UPDATE itself, so concurrent transactions changing
+    the same tally wait for each other's row lock and both of their changes count.
+    """
+    deltas = dict((key, delta) for key, delta in deltas.iteritems() if delta)
+    if not deltas:
+        return
+
+    table = AccountStatusCount.__table__
+    stmt = insert(table)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.owner_type, table.c.owner_id, table.c.status],
+        set_=dict(count=table.c.count + stmt.excluded.count)
+    ), [dict(owner_type=owner_type, owner_id=owner_id, status=status, count=delta)
+        for (owner_type, owner_id, status), delta in sorted(
+            deltas.iteritems(), key=lambda (k, d): (k[0], k[1], k[2].value))])
+
+
+def reconcile():
+    """Recomputes every tally from scratch.
+
+    Returns [(owner type, owner id, status, stored count, actual count)] of the
+    tallies which had drifted.
+    """
+    drift = []
+    for owner_type in [VENDOR, VPS]:
+        actual = _count(db.session, owner_type)
+        stored = {(row.owner_id, row.status): row.count
+                  for row in AccountStatusCount.query.filter(
+                      AccountStatusCount.owner_type == owner_type)}
+
+        for key in sorted(set(actual) | set(stored), key=lambda k: (k[0], k[1].value)):
+            if actual.get(key, 0) != stored.get(key, 0):
+                owner_id, status = key
+                drift.append((owner_type, owner_id, status,
+                              stored.get(key, 0), actual.get(key, 0)))
+
+        AccountStatusCount.query.filter(AccountStatusCount.owner_type == owner_type) \
+            .delete(synchronize_session=False)
+        if actual:
+            db.session.execute(AccountStatusCount.__table__.insert(), [
+                dict(owner_type=owner_type, owner_id=owner_id, status=status, count=count)
+                for (owner_id, status), count in actual.iteritems()])
+    db.session.commit()
+    return drift
+
+
+def _get_memberships(session, account_ids):
+    """Returns Counter({ (owner type, owner id, status): number of accounts }) of the
+    accounts as stored in the database.
+    """
+    ret = Counter()
+    if account_ids:
+        for vendor_id, status in session.query(Account.vendor_id, Account.status) \
+                .filter(Account.id.in_(account_ids), Account.vendor_id.isnot(None)):
+            ret[(VENDOR, vendor_id, status)] += 1
+        for vps_id, status in session.query(association_table.c.vps_id, Account.status) \
+                .join(Account, Account.id == association_table.c.account_id) \
+                .filter(Account.id.in_(account_ids)):
+            ret[(VPS, vps_id, status)] += 1
+    return ret
+
+
+def _is_touched(account):
+    attrs = inspect(account).attrs
+    return any(attrs[key].history.has_changes() for key in TRACKED_ATTRIBUTES)
+
+
+@event.listens_for(Session, 'before_flush')
+def before_flush(session, flush_context, instances):
+    """Remembers the tallies that the accounts being flushed count in before the flush.
+    """
+    Vps = Account.VPSs.property.mapper.class_
+
+    accounts = [obj for obj in session.new | session.deleted if isinstance(obj, Account)]
+    accounts += [obj for obj in session.dirty if isinstance(obj, Account) and _is_touched(obj)]
+
+    # Accounts moved from the VPS side
+    for vps in session.new | session.dirty:
+        if isinstance(vps, Vps):
+            history = inspect(vps).attrs.accounts.history
+            accounts += list(history.added or ()) + list(history.deleted or ())
+
+    if not accounts:
+        session.info.pop(INFO_KEY, None)
+        return
+
+    session.info[INFO_KEY] = (
+        accounts, _get_memberships(session, [a.id for a in accounts if a.id is not None]))
+
+
+@event.listens_for(Session, 'after_flush')
+def after_flush(session, flush_context):
+    """Adds the difference between the tallies of the flushed accounts after and before
+    the flush.
+    """
+    Vendor = Account.vendor.property.mapper.class_
+    Vps = Account.VPSs.property.mapper.class_
+
+    accounts, before = session.info.pop(INFO_KEY, ([], Counter()))
+
+    # Owners that are gone
+    deleted = {VENDOR: set(obj.id for obj in session.deleted if isinstance(obj, Vendor)),
+               VPS: set(obj.id for obj in session.deleted if isinstance(obj, Vps))}
+    for owner_type in [VENDOR, VPS]:
+        if deleted[owner_type]:
+            session.query(AccountStatusCount).filter(
+                AccountStatusCount.owner_type == owner_type,
+                AccountStatusCount.owner_id.in_(deleted[owner_type])
+            ).delete(synchronize_session=False)
+
+    # Deleted accounts are no longer found, which subtracts them
+    after = _get_memberships(session, set(a.id for a in accounts if a.id is not None))
+    deltas = defaultdict(int)
+    for key in set(before) | set(after):
+        owner_type, owner_id, status = key
+        if owner_id not in deleted[owner_type]:
+            deltas[key] = after[key] - before[key]
+    add_deltas(session, deltas)
@@ -2,20 +2,25 @@
 
 import enum
 import math
+from datetime import datetime, time, timedelta
 
+import pytz
 import sqlalchemy
+import sqlalchemy_continuum
 from flask_admin.babel import gettext
 from flask_babelex import lazy_gettext
-from portal.cache import cache
 from portal.models import db
-from portal.permission.models import Permission
+from portal.permission.models import permission_index
 from portal.user import RolesEnum
-from portal.utils import ranges
+from portal.utils.entity_cache import entity_cache
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql import expression, func
+from sqlalchemy_continuum.operation import Operation
 
 u = lambda s: unicode(s, 'utf-8')       # noqa
 
+HKTZ = pytz.timezone('Asia/Hong_Kong')
+
 
 association_table = db.Table(
     'account_vps',
@@ -172,6 +177,15 @@ class Account(db.Model):
             return self.remaining_account_budget_override
         return self.remaining_account_budget
 
+    @classmethod
+    def get_budget_expressions(cls):
+        """Returns (account_budget, remaining_account_budget) as SQL expressions with the
+        overrides applied, like get_account_budget and get_remaining_account_budget.
+        """
+        return (func.coalesce(cls.account_budget_override, cls.account_budget),
+                func.coalesce(cls.remaining_account_budget_override,
+                              cls.remaining_account_budget))
+
     @hybrid_property
     def days_left(self):
         """Returns the number of days left before the budget exhausts.
@@ -189,7 +203,11 @@ class Account(db.Model):
 
     @days_left.expression
     def days_left(cls):
-        return sqlalchemy.func.floor(cls.remaining_account_budget / (cls.daily_budget + 1))  # hack
+        account_budget, remaining_account_budget = cls.get_budget_expressions()
+        return sqlalchemy.case(
+            [(sqlalchemy.and_(remaining_account_budget.isnot(None), cls.daily_budget != 0),
+              func.floor(remaining_account_budget / cls.daily_budget))],
+            else_=99)
 
     @property
     def percentage_spent(self):
@@ -224,44 +242,88 @@ class Account(db.Model):
             return self.get_remaining_account_budget() * self.exchange_rate
 
     @property
-    @cache.memoize()
+    @entity_cache.attribute
     def days_to_topup(self):
         """Rather than using inline model form, just reflect this
         """
         return self.vendor.days_to_topup
 
+    @classmethod
+    def get_version_dates(cls, account_ids):
+        """Returns { account id: (created on, suspended on) } read from accounts_version
+        in one query. Accounts without versions are left out.
+
+        created on is when the transaction of the first version was issued, suspended
+        on the updated_at of the first SUSPENDED version or None:
+
+        SELECT v.id, t.issued_at, s.updated_at
+        FROM (SELECT id, min(transaction_id) AS first_id,
+                     min(transaction_id) FILTER (WHERE status = 'SUSPENDED') AS suspended_id
+              FROM accounts_version WHERE id IN (...) GROUP BY id) v
+        JOIN transaction t ON t.id = v.first_id
+        LEFT OUTER JOIN accounts_version s ON s.id = v.id AND s.transaction_id = v.suspended_id
+        """
+        if not account_ids:
+            return {}
+        AccountVersion = sqlalchemy_continuum.version_class(Account)
+        Transaction = sqlalchemy_continuum.transaction_class(Account)
+
+        firsts = db.session.query(
+            AccountVersion.id.label('id'),
+            func.min(AccountVersion.transaction_id).label('first_id'),
+            func.min(AccountVersion.transaction_id).filter(
+                AccountVersion.status == AccountStatus.SUSPENDED).label('suspended_id')
+        ).filter(AccountVersion.id.in_(account_ids)).group_by(AccountVersion.id).subquery()
+
+        Suspended = sqlalchemy.orm.aliased(AccountVersion)
+        query = db.session.query(firsts.c.id, Transaction.issued_at, Suspended.updated_at) \
+            .join(Transaction, Transaction.id == firsts.c.first_id) \
+            .outerjoin(Suspended, sqlalchemy.and_(Suspended.id == firsts.c.id,
+                                                  Suspended.transaction_id == firsts.c.suspended_id))
+        return {account_id: (created_on, suspended_on)
+                for account_id, created_on, suspended_on in query}
+
+    @classmethod
+    def set_version_dates(cls, accounts):
+        """Loads the version dates of all `accounts` in one query.
+        """
+        dates = cls.get_version_dates([a.id for a in accounts])
+        for account in accounts:
+            account._version_dates = dates.get(account.id, (None, None))
+
+    @property
+    @entity_cache.attribute
+    def version_dates(self):
+        """(created on, suspended on) of this account alone, see get_version_dates.
+        """
+        return Account.get_version_dates([self.id]).get(self.id, (None, None))
+
+    def get_cached_version_dates(self):
+        """Dates preloaded for a whole page by set_version_dates, otherwise queried for
+        this account alone.
+        """
+        if '_version_dates' in self.__dict__:
+            return self._version_dates
+        return self.version_dates
+
     @property
-    @cache.memoize()
     def suspended_on(self):
-        """Returns a dt for when suspension occurs. If account is not suspended return None.
+        """Returns a dt for when the account was first suspended, None if it never was.
         """
-        for v in self.versions:
-            if v.status == AccountStatus.SUSPENDED:
-                return v.updated_at
+        return self.get_cached_version_dates()[1]
 
     @property
     def clients_allowed(self):
-        """Returns a string which shows which clients are allowed.
-
-        Not memoizing here because this could be used by other widgets. So it makes sense to use
-        cache_helper as we are sharing this between different classes.
+        """Returns a string which shows which clients are allowed, from the permission
+        index which is shared by every account of the vendor.
         """
-        key = 'clients_allowed-%s' % self.vendor_id
-        if self.vendor:
-            ret = cache.get(key)
-            if not ret:
-                pems = Permission.query.filter(
-                    Permission.vendor_id == self.vendor_id).order_by(Permission.user_id)
-                if pems.count():
-                    ret = ranges([p.user_id for p in pems])
-                else:
-                    ret = lazy_gettext("Vendor permissions not defined.")
-                cache.set(key, ret)
-            return ret
+        if self.vendor_id:
+            return permission_index.get_ranges(self.vendor_id) or \
+                lazy_gettext("Vendor permissions not defined.")
         return lazy_gettext("Vendor is empty.")
 
     @property
-    @cache.memoize()
+    @entity_cache.attribute
     def VPSs_jinja(self):
         """Show only AWS VPSs if there are multiple VPSs.
         """
@@ -281,17 +343,188 @@ class Account(db.Model):
             return ", ".join(sorted([str(v) for v in VPSs]))
 
     @property
-    @cache.memoize()
     def created_at(self):
-        """Running this operation even after memoization has caused the request to take longer than
-        30 seconds. Hence, we will only execute this method on the relevant vendors.
+        """When the first version was committed. Preload it with set_version_dates when
+        listing accounts.
         """
-        VENDORS = [40, 41, 42]
-        if self.vendor_id in VENDORS:
-            return self.versions.first().transaction.issued_at.strftime('%m/%d %H:%M')
+        created_on = self.get_cached_version_dates()[0]
+        if created_on:
+            return created_on.strftime('%m/%d %H:%M')
         return ""
 
 
+# Cached attributes of accounts read their vendor and VPSs too
+entity_cache.register(Account)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.orm.mapper, 'after_configured')
+def _index_account_versions():
+    """Serves get_version_dates and the status history of accounts. accounts_version
+    is only created by Continuum once the mappers are configured.
+    """
+    table = sqlalchemy_continuum.version_class(Account).__table__
+    name = 'ix_accounts_version_id_status_transaction_id'
+    if name not in [index.name for index in table.indexes]:
+        db.Index(name, table.c.id, table.c.status, table.c.transaction_id)
+
+
+def _get_vendor_account_ids(session, vendors):
+    return [account_id for account_id, in session.query(Account.id).filter(
+        Account.vendor_id.in_([vendor.id for vendor in vendors]))]
+
+
+def _get_vps_account_ids(session, vpses):
+    ret = set(account_id for account_id, in session.query(association_table.c.account_id)
+              .filter(association_table.c.vps_id.in_([vps.id for vps in vpses])))
+    # Removed from the VPS side, or from a deleted VPS
+    for vps in vpses:
+        ret.update(a.id for a in sqlalchemy.inspect(vps).attrs.accounts.history.sum())
+    return ret
+
+
+entity_cache.add_dependency('vendors', Account, _get_vendor_account_ids)
+entity_cache.add_dependency('vps', Account, _get_vps_account_ids)
+
+
+def get_hkt_day_start(day):
+    """Returns 00:00 HKT of `day` in UTC.
+    """
+    return HKTZ.localize(datetime.combine(day, time())).astimezone(pytz.utc)
+
+
+class AccountSnapshot(db.Model):
+    """State of an account at the end of a day (HKT).
+
+    Widgets reporting on previous days read these instead of picking the latest
+    row per account out of accounts_version. Snapshots are taken by
+    `python manage.py snapshot_accounts`, which is meant to run daily.
+    """
+    __tablename__ = 'account_snapshots'
+
+    day = db.Column(db.Date(), primary_key=True)
+    account_id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+
+    adwords_id = db.Column(db.String(20), nullable=False)
+    client_id = db.Column(db.Integer())
+    status = db.Column(db.Enum(AccountStatus, name='account_status'), nullable=False)
+
+    account_budget = db.Column(db.Float())
+    account_budget_override = db.Column(db.Float())
+    remaining_account_budget = db.Column(db.Float())
+    remaining_account_budget_override = db.Column(db.Float())
+    daily_budget = db.Column(db.Float())
+    exchange_rate = db.Column(db.Float())
+
+    # True if the account was ACTIVE at any time of the day
+    was_active = db.Column(db.Boolean(), nullable=False, default=False)
+
+    # Columns copied from accounts_version
+    STATE_COLUMNS = ['adwords_id', 'client_id', 'status', 'account_budget',
+                     'account_budget_override', 'remaining_account_budget',
+                     'remaining_account_budget_override', 'daily_budget', 'exchange_rate']
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.day, self.adwords_id)
+
+    def get_account_budget(self):
+        if self.account_budget_override is not None:
+            return self.account_budget_override
+        return self.account_budget
+
+    def get_remaining_account_budget(self):
+        if self.remaining_account_budget_override is not None:
+            return self.remaining_account_budget_override
+        return self.remaining_account_budget
+
+    @property
+    def spent_in_hkd(self):
+        ab, rab = self.get_account_budget(), self.get_remaining_account_budget()
+        if no_none(ab, rab, self.exchange_rate):
+            return (ab - rab) * self.exchange_rate
+
+    @classmethod
+    def get_days(cls, days):
+        """Returns the subset of `days` which have been snapshotted.
+        """
+        q = db.session.query(cls.day).filter(cls.day.in_(days)).distinct()
+        return set(day for day, in q)
+
+    @classmethod
+    def take(cls, until=None):
+        """Snapshots every day after the last snapshotted day up to `until`, which
+        defaults to yesterday (HKT). The first run backfills from the oldest version.
+
+        accounts_version is read once, in order, carrying the state of every account
+        from one day to the next. Returns the number of days snapshotted.
+        """
+        AccountVersion = sqlalchemy_continuum.version_class(Account)
+        if until is None:
+            until = datetime.now(HKTZ).date() - timedelta(days=1)
+
+        state = {}          # account_id: { column: value }
+        last_day = db.session.query(func.max(cls.day)).scalar()
+        if last_day is None:
+            first_dt = db.session.query(func.min(AccountVersion.updated_at)).scalar()
+            if first_dt is None:
+                return 0
+            day = first_dt.astimezone(HKTZ).date()
+        else:
+            for snapshot in cls.query.filter(cls.day == last_day):
+                state[snapshot.account_id] = dict(
+                    (c, getattr(snapshot, c)) for c in cls.STATE_COLUMNS)
+            day = last_day + timedelta(days=1)
+
+        if day > until:
+            return 0
+
+        table = AccountVersion.__table__
+        columns = [table.c.id, table.c.operation_type, table.c.updated_at] + \
+            [table.c[c] for c in cls.STATE_COLUMNS]
+        stmt = sqlalchemy.select(columns).where(sqlalchemy.and_(
+            table.c.updated_at >= get_hkt_day_start(day),
+            table.c.updated_at < get_hkt_day_start(until + timedelta(days=1))
+        )).order_by(table.c.updated_at, table.c.transaction_id)
+
+        def _was_active():
+            return set(account_id for account_id, values in state.iteritems()
+                       if values['status'] == AccountStatus.ACTIVE)
+
+        def _save(day, was_active):
+            if state:
+                db.session.execute(cls.__table__.insert(), [
+                    dict(values, day=day, account_id=account_id,
+                         was_active=account_id in was_active)
+                    for account_id, values in state.iteritems()])
+            db.session.commit()
+
+        # A separate connection so that the commits of each day do not close the
+        # server side cursor
+        count = 0
+        was_active = _was_active()
+        with db.engine.connect() as conn:
+            for row in conn.execution_options(stream_results=True).execute(stmt):
+                row_day = row.updated_at.astimezone(HKTZ).date()
+                while day < row_day:
+                    _save(day, was_active)
+                    count += 1
+                    day += timedelta(days=1)
+                    was_active = _was_active()
+
+                if row.operation_type == Operation.DELETE:
+                    state.pop(row.id, None)
+                    continue
+                state[row.id] = dict((c, row[c]) for c in cls.STATE_COLUMNS)
+                if row.status == AccountStatus.ACTIVE:
+                    was_active.add(row.id)
+
+        while day <= until:
+            _save(day, was_active)
+            count += 1
+            day += timedelta(days=1)
+            was_active = _was_active()
+        return count
+
+
 A = RolesEnum.ADMIN.value
 T = RolesEnum.TECHNICIAN.value
 S = RolesEnum.SUPPORT.value
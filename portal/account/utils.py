@@ -1,11 +1,28 @@
 import json
 
 import pytz
+import sqlalchemy as sa
 from flask import Markup
 from flask_admin.babel import lazy_gettext
 from portal.account.models import AttributeManagerSingleton as AMS
 from portal.account.models import AccountStatus
 from sqlalchemy_continuum import Operation
+from sqlalchemy_continuum.utils import is_internal_column
+
+
+def get_changeset(version, previous):
+    """Same as version.changeset, but with the previous version already loaded so that
+    no query is issued.
+    """
+    data = {}
+    for key in sa.inspect(version.__class__).columns.keys():
+        if is_internal_column(version, key) or key.endswith('_mod'):
+            continue
+        old = getattr(previous, key) if previous else None
+        new = getattr(version, key)
+        if old != new:
+            data[key] = [old, new]
+    return data
 
 
 class History(object):
@@ -52,12 +69,12 @@ class VersionHistory(History):
     Figures out which attributes are displayable to the current user.
     Renders to Jinja.
     """
-    def __init__(self, version, role):
+    def __init__(self, version, role, changeset=None):
         self.can_render_flag = False
         self.time_str = str()
         self.user = str()
         self.content = str()
-        self.set_version(version, role)
+        self.set_version(version, role, changeset)
 
     def can_render(self):
         return self.can_render_flag
@@ -76,11 +93,16 @@ class VersionHistory(History):
             return Markup('<b>%s</b>' % obj.value.encode('utf-8'))
         return obj        # Don't coerce, let jinja handle it
 
-    def set_version(self, version, role):
+    def set_version(self, version, role, changeset=None):
         """Returns None if current_user has no access to this version
+
+        Pass `changeset` if it is already known, see get_changeset.
         """
+        if changeset is None:
+            changeset = version.changeset
+
         modifications = []
-        for attr, before_after in version.changeset.iteritems():
+        for attr, before_after in changeset.iteritems():
 
             if attr in ['updated_at', 'created_at', 'id', 'password', 'last_visited_by_eve']:
                 continue
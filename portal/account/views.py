@@ -1,27 +1,48 @@
+import json
 import re
-
-from flask import (Blueprint, Markup, flash, jsonify, redirect, request,
-                   session, url_for)
+import tempfile
+from collections import defaultdict
+from contextlib import closing
+
+import openpyxl
+import unicodecsv
+import pytz
+from flask import (Blueprint, Markup, Response, abort, current_app, flash, jsonify,
+                   redirect, request, session, stream_with_context, url_for)
+from flask_admin._compat import text_type
 from flask_admin.base import expose
 from flask_admin.model.helpers import get_mdict_item_or_list
-from flask_babelex import gettext
+from flask_babelex import get_locale, gettext
 from flask_sqlalchemy_cache import FromCache
 from flask_user import current_user, login_required
-from jinja2 import contextfunction
+from jinja2 import contextfunction, escape
+from portal.access.models import Access
 from portal.account.models import AttributeManagerSingleton as AMS
-from portal.account.models import Account, AccountStatus, AccountStatusHelper
-from portal.account.utils import AccessHistory, ReplacementBank, VersionHistory
+from portal.account.models import (Account, AccountStatus, AccountStatusHelper,
+                                   association_table)
+from portal.account.utils import (AccessHistory, ReplacementBank, VersionHistory,
+                                  get_changeset)
 from portal.account.widgets import (AttentionWidget, ExpiringWidget,
                                     NotUpdatedTodayWidget)
 from portal.admin.utils import (AccessControlView, AuthorizationRequiredView,
                                 TimeTrackedModelView)
 from portal.cache import cache
+from portal.models import db
 from portal.permission.forms import PermissionCheckingAccountForm
 from portal.user import RolesEnum
 from portal.user.models import Role, User, UsersRoles
+from portal.utils.conditional import (conditional, get_high_water_mark,
+                                      make_etag)
+from portal.utils.datatables import (LIKE_ESCAPE, DataTablesArgs, escape_like,
+                                     parse_range_values, parse_select_values)
 from portal.utils.EnumRelated import EnumSQLAModelView
+from portal.vendor.models import Vendor
 from portal.vps.models import Vps
-from sqlalchemy import and_
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import aliased, contains_eager, joinedload, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy_continuum import Operation, transaction_class, version_class
+from werkzeug.utils import secure_filename
 from wtforms.validators import ValidationError, required
 
 from .HandsonUploader import HandsonUploader
@@ -84,7 +105,8 @@ class AbstractAccountModelView(EnumSQLAModelView):
 
     Regarding providing data for index_view's DataTable, we will not be using the
     native export in flask-admin because it sends the file as an attachment and
-    doesn't allow additional info such as column data to be sent over.
+    doesn't allow additional info such as column data to be sent over. Files are
+    exported by our own `export` which streams the rows instead.
     """
 
     role = None         # This must be overriden!
@@ -198,21 +220,89 @@ class AbstractAccountModelView(EnumSQLAModelView):
 
         super(AbstractAccountModelView, self).__init__(*args, **kwargs)
 
-    def get_account_histories(self, account_id):
-        model = self.get_one(account_id)
+    def get_account_histories(self, account_id, versions_offset=0, accesses_offset=0):
+        """Returns (histories, next_offsets) of one page of the account's change history,
+        newest first. next_offsets is None on the last page.
+
+        Two queries whatever the age of the account: the versions with their
+        transaction, user and previous version (see AccountHistoryWidget), and the
+        accesses with their user. Each fetches one row more than the page, the
+        offsets of the next page count the rows of each that made it in.
+        """
+        limit = current_app.config['ACCOUNT_HISTORY_PAGE_SIZE']
+
+        Transaction = transaction_class(Account)
+        AccountVersion = version_class(Account)
+        Previous = aliased(AccountVersion)
+
+        # Versions where only heartbeat columns changed never render
+        heartbeat = ['updated_at', 'last_visited_by_eve']
+        real_change = or_(AccountVersion.operation_type != Operation.UPDATE, *[
+            getattr(AccountVersion, column.name)
+            for column in AccountVersion.__table__.columns
+            if column.name.endswith('_mod') and column.name[:-len('_mod')] not in heartbeat
+        ])
+
+        versions = db.session.query(AccountVersion, Previous) \
+            .join(AccountVersion.transaction) \
+            .outerjoin(Transaction.user) \
+            .outerjoin(Previous, and_(
+                Previous.id == AccountVersion.id,
+                Previous.end_transaction_id == AccountVersion.transaction_id)) \
+            .options(contains_eager(AccountVersion.transaction).contains_eager('user')) \
+            .filter(AccountVersion.id == account_id, real_change) \
+            .order_by(Transaction.issued_at.desc(), AccountVersion.transaction_id.desc()) \
+            .offset(versions_offset).limit(limit + 1).all()
+
+        accesses = Access.query \
+            .options(joinedload(Access.user)) \
+            .filter(Access.account_id == account_id) \
+            .order_by(Access.created_at.desc(), Access.id.desc()) \
+            .offset(accesses_offset).limit(limit + 1).all()
+
+        # issued_at is NOT timezone aware
+        entries = [(pytz.utc.localize(version.transaction.issued_at), 0, version, previous)
+                   for version, previous in versions]
+        entries += [(access.created_at, 1, access, None) for access in accesses]
+        entries = sorted(entries, key=lambda entry: entry[0], reverse=True)
+        page = entries[:limit]
+
         histories = []
-        for version in model.versions:
-            history = VersionHistory(version, self.role)
+        for dt, is_access, obj, previous in page:
+            if is_access:
+                history = AccessHistory(obj)
+            else:
+                history = VersionHistory(obj, self.role, get_changeset(obj, previous))
             if history.can_render():
                 histories.append(history)
 
-        for access in model.accesses:
-            history = AccessHistory(access)
-            if history.can_render():
-                histories.append(history)
+        next_offsets = None
+        if len(entries) > limit:
+            n_accesses = sum(entry[1] for entry in page)
+            next_offsets = (versions_offset + len(page) - n_accesses,
+                            accesses_offset + n_accesses)
+        return histories, next_offsets
+
+    def get_history_url(self, account_id, next_offsets):
+        if next_offsets is None:
+            return None
+        return self.get_url('.history_view', id=account_id, versions_offset=next_offsets[0],
+                            accesses_offset=next_offsets[1])
+
+    @expose('/details/history/')
+    def history_view(self):
+        """Next page of details_view's change history, for its "Load more" button.
+        """
+        account_id = request.args.get('id', type=int)
+        if not self.get_query().filter(Account.id == account_id).count():
+            abort(404)
 
-        histories = sorted(histories)
-        return histories
+        histories, next_offsets = self.get_account_histories(
+            account_id,
+            versions_offset=max(request.args.get('versions_offset', 0, type=int), 0),
+            accesses_offset=max(request.args.get('accesses_offset', 0, type=int), 0))
+        return jsonify(html=u''.join(history.render() for history in histories),
+                       next_url=self.get_history_url(account_id, next_offsets))
 
     @expose('/<regex("[0-9]{3}-[0-9]{3}-[0-9]{4}"):adwords_id>/')
     def redirect_to_details_views(self, adwords_id):
@@ -241,13 +331,16 @@ class AbstractAccountModelView(EnumSQLAModelView):
             kwargs['attention_widget'] = AttentionWidget()
 
         if template.endswith('list.html'):
+            kwargs['server_side'] = self.is_server_side()
             kwargs['replacement_bank'] = ReplacementBank()
             kwargs['AccountStatusHelper'] = AccountStatusHelper
             kwargs['locale'] = session.get('lang', 'en')
         elif template.endswith('details.html'):
             id = get_mdict_item_or_list(request.args, 'id')
             if id:
-                kwargs['histories'] = self.get_account_histories(id)
+                histories, next_offsets = self.get_account_histories(id)
+                kwargs['histories'] = histories
+                kwargs['history_url'] = self.get_history_url(id, next_offsets)
 
         return super(AbstractAccountModelView, self).render(template, **kwargs)
 
@@ -317,11 +410,15 @@ class AbstractAccountModelView(EnumSQLAModelView):
             base = {'targets': i, 'name': key}
             if key in mapping:
                 base.update(mapping[key])
+            if self.is_server_side():
+                # Sorting is done in SQL, columns without an expression cannot be sorted
+                base['orderable'] = self.get_dt_sort_expression(key) is not None
             ret.append(base)
         return ret
 
-    def get_dt_filters(self):
-        """Provides YADCF options to be included in index_view_data json.
+    def get_dt_filters(self, with_data=True):
+        """Provides YADCF options to be included in index_view_data json. `with_data`
+        False leaves out the options loaded from the DB.
 
         Note that there is a bug with X-Editable and Select2 filters. Select2
         filters cannot different solely just on text alone. Hence you will see
@@ -346,6 +443,11 @@ class AbstractAccountModelView(EnumSQLAModelView):
                 if key in AMS.get_list_view_editable_columns(self.role):
                     settings[key]['column_data_type'] = 'html'
 
+                # Server-side filters cannot collect their options from the DOM
+                if with_data and self.is_server_side() and \
+                        settings[key].get('filter_type', 'select') in ['select', 'multi_select']:
+                    settings[key]['data'] = self.get_dt_filter_data(key)
+
                 ret.append(dict(column_number=i,
                                 filter_container_id='filter_container_%s' % i,
                                 label=c[1],
@@ -358,7 +460,24 @@ class AbstractAccountModelView(EnumSQLAModelView):
                 return i + 1
         raise Exception('"status" position cannot be determined')
 
+    def get_index_view_data_etag(self):
+        """index_view_data only depends on the role's columns and their settings,
+        hashed so that a deploy changing them is picked up, except for the filter
+        options which are loaded from the DB when server-side processing is on.
+        """
+        settings = json.dumps([[key for key, label in self.get_dt_columns(True)],
+                               self.get_dt_filters(with_data=False),
+                               self.get_column_defs()],
+                              cls=current_app.json_encoder, sort_keys=True)
+        parts = [self.endpoint, current_user.id, str(get_locale()), self.is_server_side(),
+                 settings]
+        if self.is_server_side():
+            parts += [get_high_water_mark(self.get_query(), Account),
+                      get_high_water_mark(Vendor.query, Vendor)]
+        return make_etag(*parts)
+
     @expose('/index_view_data/')
+    @conditional(lambda self: self.get_index_view_data_etag())
     def index_view_data(self):
         """Provides data for index_view to be used with DataTables.
         """
@@ -367,11 +486,344 @@ class AbstractAccountModelView(EnumSQLAModelView):
             'status_pos': self.get_status_position(),
             'summary_pos': self.get_summary_positions(),
             'columnDefs': self.get_column_defs(),
+            'server_side': self.is_server_side(),
         }
+        if self.is_server_side():
+            response_raw['columns'] = [{'data': key, 'name': key}
+                                       for key, label in self.get_dt_columns(True)]
         return jsonify(response_raw)
 
+    #
+    # Server-side processing for DataTables.
+    #
+    # With ACCOUNT_LIST_SERVER_SIDE enabled, list.html only renders the table
+    # skeleton and DataTables fetches each page from index_view_rows. Sorting,
+    # searching and YADCF filtering are all done in SQL.
+    #
+
+    dt_max_page_length = 500
+
+    dt_searchable_columns = ['adwords_id', 'nickname', 'login', 'batch',
+                             'internal_comment', 'external_comment']
+
+    def is_server_side(self):
+        return current_app.config.get('ACCOUNT_LIST_SERVER_SIDE', False)
+
+    def get_dt_sort_expression(self, key):
+        """Returns the SQL expression used to sort column `key` or None if the column
+        cannot be sorted in SQL.
+        """
+        # With the overrides applied, as displayed
+        account_budget, remaining_account_budget = Account.get_budget_expressions()
+        spent = account_budget - remaining_account_budget
+        mapping = {
+            'days_left': Account.days_left,
+            'spent': spent,
+            'spent_in_hkd': spent * Account.exchange_rate,
+            'remaining_in_hkd': remaining_account_budget * Account.exchange_rate,
+            'percentage_spent': 100 * spent / func.nullif(account_budget, 0),
+            'client': Account.client_id,
+            'vendor': Vendor.get_str_expression(),
+        }
+        if key in mapping:
+            return mapping[key]
+        return Account.__table__.columns.get(key)
+
+    def get_dt_filter_data(self, key):
+        """Options of YADCF select filters, [{'value': value, 'label': label}, ..]
+        """
+        if key == 'status':
+            return [{'value': value.name, 'label': label}
+                    for value, label, desc in AccountStatusHelper.iterall()]
+        elif key == 'client_id':
+            q = self.get_query().with_entities(Account.client_id).distinct()
+            return sorted(client_id for client_id, in q if client_id is not None)
+        elif key == 'vendor':
+            return [{'value': v.id, 'label': text_type(v)}
+                    for v in Vendor.query.order_by(Vendor.id)]
+        return []
+
+    def get_dt_filter_clause(self, key, value):
+        """Maps a YADCF filter value of column `key` to a where clause.
+        """
+        if key == 'status':
+            statuses = [AccountStatus[v] for v in parse_select_values(value)
+                        if v in AccountStatus.__members__]
+            if statuses:
+                return Account.status.in_(statuses)
+        elif key in ['client_id', 'vendor']:
+            column = Account.client_id if key == 'client_id' else Account.vendor_id
+            ids = [int(v) for v in parse_select_values(value) if v.isdigit()]
+            if ids:
+                return column.in_(ids)
+        elif key == 'account_budget':
+            lo, hi = parse_range_values(value)
+            clauses = []
+            if lo is not None:
+                clauses.append(Account.account_budget >= lo)
+            if hi is not None:
+                clauses.append(Account.account_budget <= hi)
+            if clauses:
+                return and_(*clauses)
+
+    def filter_dt_query(self, query, dt_args):
+        """Applies the global search and the YADCF filters of `dt_args` to `query`.
+        """
+        columns = self.get_dt_columns(True)
+
+        # Global search, only on columns this role can read
+        readable = set(AMS.get_list_view_columns(self.role))
+        if dt_args.search:
+            pattern = u'%%%s%%' % escape_like(dt_args.search)
+            query = query.filter(or_(*[
+                getattr(Account, key).ilike(pattern, escape=LIKE_ESCAPE)
+                for key in self.dt_searchable_columns if key in readable]))
+
+        # YADCF filters
+        for i, value in dt_args.column_searches.iteritems():
+            if i < len(columns):
+                clause = self.get_dt_filter_clause(columns[i][0], value)
+                if clause is not None:
+                    query = query.filter(clause)
+
+        return query
+
+    def order_dt_query(self, query, dt_args):
+        """Sorts `query` by the columns of `dt_args`, the most recently updated first
+        by default.
+        """
+        columns = self.get_dt_columns(True)
+
+        order_by = []
+        for i, is_desc in dt_args.orders:
+            if i >= len(columns):
+                continue
+            key = columns[i][0]
+            expr = self.get_dt_sort_expression(key)
+            if expr is None:
+                continue
+            if key == 'vendor':
+                query = query.outerjoin(Account.vendor)
+            order_by.append(expr.desc().nullslast() if is_desc else expr.asc().nullsfirst())
+        if not order_by:
+            order_by.append(Account.updated_at.desc())
+        return query.order_by(*(order_by + [Account.id]))
+
+    def get_dt_query(self, dt_args):
+        """Returns (total count, filtered count, rows of the current page).
+        """
+        query = self.get_query()
+        total = query.order_by(None).count()
+
+        query = self.filter_dt_query(query, dt_args)
+        filtered = query.order_by(None).count()
+
+        query = self.order_dt_query(query, dt_args)
+
+        # Avoid lazy loading per row for relationships shown on this page
+        keys = set(key for key, label in self.get_dt_columns(True))
+        if 'vendor' in keys or 'days_to_topup' in keys:
+            query = query.options(joinedload(Account.vendor))
+        if 'client' in keys:
+            query = query.options(joinedload(Account.client))
+        if 'VPSs' in keys:
+            query = query.options(subqueryload(Account.VPSs))
+
+        rows = query.offset(dt_args.start).limit(dt_args.length).all()
+        if 'created_at' in keys:
+            Account.set_version_dates(rows)
+        return total, filtered, rows
+
+    def get_dt_row(self, row, list_form, row_actions_args):
+        """Renders the cells of one row as {column_key: html}
+        """
+        pk = self.get_pk_value(row)
+        ret = {'DT_RowAttr': {'data-account_id': row.id}}
+
+        for key, label in self.get_dt_columns(True):
+            if key == 'checkbox':
+                ret[key] = Markup('<input type="checkbox" name="rowid" class="action-checkbox" '
+                                  'value="%s" />') % pk
+            elif key == 'row_actions':
+                ret[key] = self.render('account/row_actions.html', row=row,
+                                       **row_actions_args)
+            elif key in self.column_editable_list:
+                value = self.get_list_value(None, row, key)
+                kwargs = dict(pk=pk, display_value=value)
+                if getattr(list_form, 'csrf_token', None):
+                    kwargs['csrf'] = list_form.csrf_token._value()
+                ret[key] = list_form[key](**kwargs)
+            else:
+                ret[key] = escape(self.get_list_value(None, row, key))
+        return ret
+
+    @expose('/index_view_rows/')
+    def index_view_rows(self):
+        """Provides the visible page of index_view's DataTable (server-side processing).
+        """
+        dt_args = DataTablesArgs(request.args, max_length=self.dt_max_page_length)
+        total, filtered, rows = self.get_dt_query(dt_args)
+
+        row_actions_args = dict(
+            list_row_actions=self.get_list_row_actions(),
+            delete_form=self.delete_form() if self.can_delete else None,
+            get_pk_value=self.get_pk_value,
+            return_url=self.get_url('.index_view'))
+
+        data = []
+        for row in rows:
+            list_form = self.list_form(obj=row) if self.column_editable_list else None
+            data.append(self.get_dt_row(row, list_form, row_actions_args))
+
+        return jsonify(draw=dt_args.draw, recordsTotal=total, recordsFiltered=filtered,
+                       data=data)
+
+    #
+    # Export
+    #
+    # flask-admin's export loads every row before writing the file. Here the rows
+    # are fetched through a server-side cursor and written as they arrive, so memory
+    # use does not depend on the number of accounts. list.html passes the
+    # DataTable's search, filters and sorting in the same parameters as
+    # index_view_rows.
+    #
+    # Without ACCOUNT_LIST_SERVER_SIDE, DataTables searches and filters the
+    # rendered cells (labels, vendor names, computed columns), which SQL cannot
+    # reproduce. Only unfiltered exports are served in that mode.
+    #
+
+    can_export = False
+
+    export_types = ['csv', 'xlsx', 'jsonl']
+
+    @expose('/export/<export_type>/')
+    def export(self, export_type):
+        if not self.can_export or export_type not in self.export_types:
+            flash(gettext('Permission denied.'), 'error')
+            return redirect(self.get_url('.index_view'))
+
+        dt_args = DataTablesArgs(request.args)
+        if not self.is_server_side() and (dt_args.search or dt_args.column_searches):
+            flash(gettext('Clear the search and the filters before exporting.'), 'error')
+            return redirect(self.get_url('.index_view'))
+
+        query = self.order_dt_query(self.filter_dt_query(self.get_query(), dt_args), dt_args)
+        rows = self.iter_export_rows(query)
+
+        if export_type == 'csv':
+            body, mimetype = self._export_csv_rows(rows), 'text/csv'
+        elif export_type == 'jsonl':
+            body, mimetype = self._export_jsonl_rows(rows), 'application/x-ndjson'
+        else:
+            body = self._export_xlsx_rows(rows)
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+        disposition = 'attachment;filename=%s' % secure_filename(
+            self.get_export_name(export_type))
+        return Response(stream_with_context(body), mimetype=mimetype,
+                        headers={'Content-Disposition': disposition})
+
+    def iter_export_rows(self, query):
+        """Yields [(key, value), ..] of the export columns for every account of `query`.
+
+        The accounts are fetched ACCOUNT_EXPORT_BATCH_SIZE at a time. yield_per
+        cannot eager load collections, so the VPSs are loaded once per batch.
+        """
+        batch_size = current_app.config['ACCOUNT_EXPORT_BATCH_SIZE']
+        keys = [key for key, label in self._export_columns]
+
+        if 'vendor' in keys or 'days_to_topup' in keys:
+            query = query.options(joinedload(Account.vendor))
+        if 'client' in keys:
+            query = query.options(joinedload(Account.client))
+
+        def _format(batch):
+            if 'VPSs' in keys:
+                self._load_vpses(batch)
+            if 'created_at' in keys:
+                Account.set_version_dates(batch)
+            for account in batch:
+                yield [(key, self._get_export_cell(account, key)) for key in keys]
+
+        batch = []
+        for account in query.yield_per(batch_size):
+            batch.append(account)
+            if len(batch) == batch_size:
+                for row in _format(batch):
+                    yield row
+                batch = []
+        for row in _format(batch):
+            yield row
+
+    def _get_export_cell(self, account, key):
+        """Related models, enums and markup are exported as text.
+        """
+        value = self.get_export_value(account, key)
+        if value is None or isinstance(value, (int, long, float)):
+            return value
+        return text_type(value)
+
+    def _load_vpses(self, accounts):
+        if not accounts:
+            return
+        vpses = defaultdict(list)
+        for account_id, vps in self.session.query(association_table.c.account_id, Vps) \
+                .filter(association_table.c.vps_id == Vps.id,
+                        association_table.c.account_id.in_([a.id for a in accounts])):
+            vpses[account_id].append(vps)
+        for account in accounts:
+            set_committed_value(account, 'VPSs', vpses[account.id])
+
+    def _export_csv_rows(self, rows):
+        class Echo(object):
+            def write(self, value):
+                return value
+
+        writer = unicodecsv.writer(Echo(), encoding='utf-8')
+        yield writer.writerow([label for key, label in self._export_columns])
+        for row in rows:
+            yield writer.writerow([value for key, value in row])
+
+    def _export_jsonl_rows(self, rows):
+        for row in rows:
+            yield json.dumps(dict(row), cls=current_app.json_encoder) + '\n'
+
+    def _export_xlsx_rows(self, rows):
+        """A zip archive cannot be written as a stream. The rows are written to a
+        temporary file by openpyxl's write-only mode and the workbook is sent once
+        it is complete.
+        """
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append([text_type(label) for key, label in self._export_columns])
+        for row in rows:
+            sheet.append([value for key, value in row])
+
+        f = tempfile.TemporaryFile()
+        workbook.save(f)
+        f.seek(0)
+        with closing(f):
+            for chunk in iter(lambda: f.read(64 * 1024), ''):
+                yield chunk
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        """index_view only renders the table skeleton when rows are served by
+        index_view_rows.
+        """
+        if self.is_server_side() and request.endpoint == '%s.index_view' % self.endpoint:
+            return None, []
+        count, query = super(AbstractAccountModelView, self).get_list(
+            page, sort_column, sort_desc, search, filters, execute=execute, page_size=page_size)
+
+        # The creation dates of the whole page in one query
+        if execute and 'created_at' in self.column_list:
+            Account.set_version_dates(query)
+        return count, query
+
     def get_query(self):
-        """Using flask-sqlalchemy-cache now
+        """Served from the cache until one of the tables read is written to, see
+        portal.utils.query_cache.
         """
         return self.session.query(self.model).options(FromCache(cache))
 
@@ -383,6 +835,8 @@ class AdminAccountModelView(AbstractAccountModelView,
 
     role = RolesEnum.ADMIN.value
 
+    can_export = True
+
     def get_accessible_roles(self):
         return [RolesEnum.ADMIN.value]
 
@@ -397,6 +851,7 @@ class TechnicianAccountModelView(AbstractAccountModelView,
     can_delete = False
     can_create = False
     can_edit = True
+    can_export = True
 
     def get_accessible_roles(self):
         return [RolesEnum.TECHNICIAN.value, RolesEnum.ADMIN.value]
@@ -409,6 +864,7 @@ class SupportAccountModelView(AbstractAccountModelView, AuthorizationRequiredVie
     can_delete = False
     can_create = False
     can_edit = True
+    can_export = True
 
     def get_accessible_roles(self):
         return [RolesEnum.SUPPORT.value, RolesEnum.ADMIN.value]
@@ -427,3 +883,11 @@ class ClientAccountModelView(AccessControlView,
 
     def get_accessible_roles(self):
         return [RolesEnum.CLIENT.value, RolesEnum.ADMIN.value]
+
+    @expose('/export/<export_type>/')
+    def export(self, export_type):
+        """flask-admin's metaclass copies BaseModelView.export onto AccessControlView,
+        which would shadow AbstractAccountModelView's. Clients cannot export
+        (can_export), the rows would still be jailed by AccessControlView.get_query.
+        """
+        return AbstractAccountModelView.export(self, export_type)
@@ -1,12 +1,12 @@
-from collections import defaultdict
-from datetime import date, datetime, time, timedelta
+from collections import OrderedDict, defaultdict
+from datetime import datetime, time, timedelta
 from itertools import groupby
 
 import pytz
 from flask_babelex import gettext
-from flask_user import current_user
-from portal.account.models import Account, AccountStatus, no_none
-from portal.account.utils import VersionHistory
+from portal.account.models import (HKTZ, Account, AccountSnapshot, AccountStatus,
+                                   get_hkt_day_start, no_none)
+from portal.account.utils import VersionHistory, get_changeset
 from portal.models import db
 from portal.user import RolesEnum
 from portal.user.models import User
@@ -14,9 +14,8 @@ from portal.utils import OrderedDefaultDict
 from portal.utils.widgets import Widget
 from portal.vps.models import Vps
 from sqlalchemy import and_, func, or_
-from sqlalchemy_continuum import transaction_class, version_class
-
-HKTZ = pytz.timezone('Asia/Hong_Kong')
+from sqlalchemy.orm import aliased, contains_eager, joinedload
+from sqlalchemy_continuum import Operation, transaction_class, version_class
 
 
 def debug_dt(message, dt):
@@ -37,19 +36,21 @@ def get_shift_start_dt(lohr, current_dt):
 def get_end_of_hkt_today():
     """Return today at 23:59 HKT in UTC.
     """
-    todate = date.today()
+    todate = datetime.now(HKTZ).date()
     ret_hkt = HKTZ.localize(datetime.combine(todate, time(23, 59)))
     ret_utc = ret_hkt.astimezone(pytz.utc)
     return ret_utc
 
 
 class ExpiringWidget(Widget):
+    cache_timeout = 300
+    template = 'widgets/expiring.html'
 
     def get_roles(self):
         return [RolesEnum.ADMIN]
 
     def get_data(self):
-        return Account.query.filter(and_(
+        return Account.query.options(joinedload(Account.vendor)).filter(and_(
             ~Account.status.in_([AccountStatus.SUSPENDED,
                                  AccountStatus.ABANDONED,
                                  AccountStatus.APPEAL_REQUESTED,
@@ -64,6 +65,8 @@ class ExpiringWidget(Widget):
 
 
 class NotUpdatedTodayWidget(Widget):
+    cache_timeout = 300
+    template = 'widgets/not_updated_today.html'
 
     def get_roles(self):
         return [RolesEnum.ADMIN, RolesEnum.TECHNICIAN]
@@ -87,10 +90,12 @@ class NotUpdatedTodayWidget(Widget):
         for act in accounts:
             ret[act.login].append(act)
 
-        return title, ret
+        return title, OrderedDict(ret)
 
 
 class AttentionWidget(Widget):
+    cache_timeout = 60
+    template = 'widgets/attention.html'
 
     def get_roles(self):
         return [RolesEnum.ADMIN]
@@ -103,10 +108,14 @@ class AttentionWidget(Widget):
             Account.status == AccountStatus.UNINITIALIZED)
         ).order_by(Account.status)
 
-        return groupby(q, key=lambda a: a.status)
+        return [(status, list(accounts))
+                for status, accounts in groupby(q, key=lambda a: a.status)]
 
 
 class RecentStatusChangeWidget(Widget):
+    cache_timeout = 300
+    template = 'widgets/recent_status_change.html'
+
     def get_roles(self):
         return [RolesEnum.ADMIN]
 
@@ -114,7 +123,8 @@ class RecentStatusChangeWidget(Widget):
         """Do not pass AccountVersion objects to jinja because we need
         updated information on each account.
 
-        Return in the order of when the account was suspended DESC.
+        Return in the order of when the account was suspended DESC as
+        [(account, updated_at, status_from, status_to)]
         """
         AccountVersion = version_class(Account)
         week_ago = datetime.now(pytz.utc) - timedelta(days=7)
@@ -136,38 +146,76 @@ class RecentStatusChangeWidget(Widget):
                 Account.adwords_id.in_(account_versions.keys())):
             accounts[account.adwords_id] = account
 
+        ret = []
         for adwords_id in order:
-            yield (accounts[adwords_id], account_versions[adwords_id])
+            av = account_versions[adwords_id]
+            status_from, status_to = av.changeset['status']
+            ret.append((accounts[adwords_id], av.updated_at, status_from, status_to))
+        return ret
 
 
 class AccountHistoryWidget(Widget):
     """This widget is only for changes that are not updated_at nor last_visited_by_eve.
     """
+    cache_timeout = 60
+    template = 'widgets/account_history.html'
+    cache_per_role = True
+
     def get_roles(self):
         return [RolesEnum.ADMIN, RolesEnum.SUPPORT, RolesEnum.TECHNICIAN]
 
     def get_data(self):
+        """One query for the versions of the last day, their transaction and user, and
+        the previous version the changeset is computed against.
+
+        SELECT v.*, t.*, users.*, prev.*
+        FROM accounts_version v
+        JOIN transaction t ON t.id = v.transaction_id
+        LEFT OUTER JOIN users ON users.id = t.user_id
+        LEFT OUTER JOIN accounts_version prev
+            ON prev.id = v.id AND prev.end_transaction_id = v.transaction_id
+        WHERE t.issued_at > :yesterday
+            AND (v.operation_type != 1 OR v.status_mod OR v.nickname_mod OR ...)
+        ORDER BY t.issued_at DESC, v.id
+        """
         Transaction = transaction_class(Account)
+        AccountVersion = version_class(Account)
+        Previous = aliased(AccountVersion)
         yesterday = datetime.utcnow() - timedelta(days=1)
-        trans = Transaction.query.order_by(Transaction.issued_at.desc()) \
-            .filter(Transaction.issued_at > yesterday).all()
 
-        AccountVersion = version_class(Account)
-        histories = []
-        for t in trans:
+        # Versions where only updated_at or last_visited_by_eve changed are heartbeats
+        heartbeat = ['updated_at', 'last_visited_by_eve']
+        real_change = or_(AccountVersion.operation_type != Operation.UPDATE, *[
+            getattr(AccountVersion, column.name)
+            for column in AccountVersion.__table__.columns
+            if column.name.endswith('_mod') and column.name[:-len('_mod')] not in heartbeat
+        ])
+
+        query = db.session.query(AccountVersion, Previous) \
+            .join(AccountVersion.transaction) \
+            .outerjoin(Transaction.user) \
+            .outerjoin(Previous, and_(
+                Previous.id == AccountVersion.id,
+                Previous.end_transaction_id == AccountVersion.transaction_id)) \
+            .options(contains_eager(AccountVersion.transaction).contains_eager('user')) \
+            .filter(Transaction.issued_at > yesterday, real_change) \
+            .order_by(Transaction.issued_at.desc(), AccountVersion.id)
 
-            # Note that one transaction can have effect on multiple entity
-            for av in AccountVersion.query.filter(AccountVersion.transaction_id == t.id):
-                history = VersionHistory(av, current_user.roles[0].name)
-                has_real_change = set(av.changeset.keys()) != set(['updated_at',
-                                                                   'last_visited_by_eve'])
-                if has_real_change and history.can_render():
-                    histories.append(history)
+        histories = []
+        for av, previous in query:
+            changeset = get_changeset(av, previous)
+            if set(changeset.keys()) == set(heartbeat):
+                continue
+            history = VersionHistory(av, self.get_role(), changeset)
+            if history.can_render():
+                histories.append(history)
 
         return histories
 
 
 class TotalSpendWidget(Widget):
+    cache_timeout = 600
+    template = 'widgets/total_spend.html'
 
     def get_roles(self):
         return [RolesEnum.ADMIN]
@@ -198,29 +246,53 @@ class TotalSpendWidget(Widget):
         q = db.session.query(t.c.client_id, hyb).group_by(t.c.client_id)
         return q.all()
 
+    def _get_snapshot_data(self, days):
+        """Same as _get_data but for whole days, from AccountSnapshot.
+        Returns { day: [(client_id, total)] }
+        """
+        S = AccountSnapshot
+        q = db.session.query(
+            S.day, S.client_id,
+            func.sum((S.account_budget - S.remaining_account_budget) * S.exchange_rate)
+        ).filter(S.day.in_(days)).group_by(S.day, S.client_id)
+
+        ret = defaultdict(list)
+        for day, client_id, total in q:
+            ret[day].append((client_id, total))
+        return ret
+
     def get_data(self):
         users = []
         for user in User.query.order_by(User.id).all():
             if RolesEnum.CLIENT.value in [role.name for role in user.roles]:
                 users.append((user.id, user.name))
 
-        # (user_id, total)
-        db.session.query(Account.client_id, func.sum(Account.spent_in_hkd))\
-            .group_by(Account.client_id).order_by(Account.client_id).all()
+        today = datetime.now(HKTZ).date()
+        days = [today - timedelta(days=i) for i in reversed(xrange(7))]
 
-        results = []
+        # Previous days come from the snapshots, or from accounts_version if they
+        # have not been taken yet. Today is the current state.
+        snapshots = self._get_snapshot_data(days[:-1])
+        snapshot_days = AccountSnapshot.get_days(days[:-1])
 
-        utc_dt = get_end_of_hkt_today()
-        for i in xrange(7):
-            hk_dt = utc_dt.astimezone(HKTZ)
-            t = self._get_data(utc_dt) + [('header', hk_dt.strftime('%m/%d %A'))]
-            results.append(dict(t))
-            utc_dt = utc_dt - timedelta(days=1)
+        results = []
+        for day in days:
+            if day == today:
+                # (user_id, total)
+                t = db.session.query(Account.client_id, func.sum(Account.spent_in_hkd))\
+                    .group_by(Account.client_id).all()
+            elif day in snapshot_days:
+                t = snapshots[day]
+            else:
+                t = self._get_data(get_hkt_day_start(day + timedelta(days=1)))
+            results.append(dict(t + [('header', day.strftime('%m/%d %A'))]))
 
-        return users, list(reversed(results))
+        return users, results
 
 
 class HighSpendWidget(Widget):
+    cache_timeout = 600
+    template = 'widgets/high_spend.html'
 
     def get_roles(self):
         return [RolesEnum.ADMIN]
@@ -229,12 +301,15 @@ class HighSpendWidget(Widget):
         ret = []
         hyb = (Account.account_budget - Account.remaining_account_budget) * Account.exchange_rate
 
-        for account in Account.query.order_by(hyb.desc()):
+        for account in Account.query.options(joinedload(Account.client),
+                                              joinedload(Account.vendor)) \
+                .order_by(hyb.desc()):
             if account.spent_in_hkd > 0:
                 ret.append(account)
                 if len(ret) > 30:
                     break
 
+        Account.set_version_dates(ret)
         return ret
 
 
@@ -261,6 +336,9 @@ class ActiveAccountsWidget(Widget):
     act_3     x
     act_4             x     x
     """
+    cache_timeout = 600
+    template = 'widgets/active_accounts.html'
+
     def get_roles(self):
         return [RolesEnum.ADMIN, RolesEnum.SUPPORT]
 
@@ -301,6 +379,18 @@ class ActiveAccountsWidget(Widget):
         day_before = today - timedelta(days=2)
 
         AccountVersion = version_class(Account)
+        snapshot_days = AccountSnapshot.get_days([dt.astimezone(HKTZ).date()
+                                                  for dt in (yesterday, day_before)])
+
+        def _set_from_snapshots(dic, day):
+            for snapshot in AccountSnapshot.query.filter(and_(
+                    AccountSnapshot.day == day,
+                    AccountSnapshot.was_active == True)):    # noqa
+                key = snapshot.adwords_id
+                users[snapshot.client_id].add(key)
+                dic[key] = FakeAccount(adwords_id=key,
+                                       daily_budget=snapshot.daily_budget,
+                                       spent_in_hkd=snapshot.spent_in_hkd)
 
         def _set(dic, dt):
             """
@@ -329,8 +419,12 @@ class ActiveAccountsWidget(Widget):
                                        daily_budget=av.daily_budget,
                                        spent_in_hkd=spent_in_hkd)
 
-        _set(actives_1, yesterday)
-        _set(actives_2, day_before)
+        for dic, dt in [(actives_1, yesterday), (actives_2, day_before)]:
+            day = dt.astimezone(HKTZ).date()
+            if day in snapshot_days:
+                _set_from_snapshots(dic, day)
+            else:
+                _set(dic, dt)
 
         ret = {}
         for user_id, adwords_ids in users.iteritems():
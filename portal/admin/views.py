@@ -1,4 +1,5 @@
 from flask import current_app
+from portal.cache import prometheus_credentials
 from portal.user import RolesEnum
 from wtforms import StringField
 
@@ -42,6 +43,12 @@ class UserModelView(TimeTrackedModelView, AuthorizationRequiredView):
             print "PASSWORD DATA IS NOT NONE, CHANGING TO", debug, type(debug), len(debug)
             user.password = current_app.user_manager.hash_password(form.plain_password.data)
 
+    def after_model_change(self, form, user, is_created):
+        """Revokes the cached API credentials once the new password is committed.
+        """
+        if form.plain_password.data:
+            prometheus_credentials.invalidate(user.username)
+
 
 class RoleModelView(TimeTrackedModelView, AuthorizationRequiredView):
     def get_accessible_roles(self):
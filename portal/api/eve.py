@@ -3,19 +3,29 @@ import locale
 import re
 from functools import wraps
 
-from flask import Blueprint, Response, jsonify, request
+from flask import Blueprint, Response, current_app, jsonify, request
+from flask_admin._compat import text_type
 from portal.account.models import Account
+from portal.api.models import EveSubmission
+from portal.cache import eve_credentials
 from portal.models import db
+from portal.utils.query_cache import invalidate
 from portal.vps.models import Vps
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.sql import func
 
 eve_blueprint = Blueprint('eve', __name__, template_folder='templates')
 
 
 def check_auth(username, password):
+    if eve_credentials.is_verified(username, password):
+        return True
+
     vps = Vps.query.filter(Vps.api_key == username).first()
-    if vps:
-        return vps.api_secret == password
+    if vps and vps.api_secret == password:
+        eve_credentials.set_verified(username, password)
+        return True
+    return False
 
 
 def basic_auth(f):
@@ -63,6 +73,144 @@ def parse_numeral(string):
         raise ValueError('Invalid data: %s' % repr(string))
 
 
+def parse_entry(dic):
+    """Maps one entry of Eve's response to the Account attributes it reports.
+
+    Raises ValueError if the entry cannot be parsed.
+    """
+    try:
+        values = dict(
+            currency=parse_currency(dic['daily_budget']),
+            account_budget=parse_numeral(dic['account_budget']),
+            remaining_account_budget=parse_numeral(dic['remaining_account_budget']),
+            daily_budget=parse_numeral(dic['daily_budget']),
+            nickname=dic['nickname'],
+        )
+    except KeyError, e:
+        raise ValueError('Missing data: %s' % e)
+    except TypeError, e:
+        raise ValueError('Invalid data: %s' % e)
+
+    if dic['account_budget'] == UNLIMITED_SPENDING:
+        values['is_unlimited'] = True
+    return values
+
+
+def apply_entry(act, values):
+    """Only sets the attributes Eve reports differently so that unchanged accounts
+    do not produce accounts_version rows. Returns True if anything changed.
+    """
+    changed = False
+    for attr, value in values.iteritems():
+        if getattr(act, attr) != value:
+            setattr(act, attr, value)
+            changed = True
+    return changed
+
+
+def touch_last_visited_by_eve(account_ids):
+    """Records Eve's visit with a core UPDATE.
+
+    Continuum only versions changes made through the ORM, hence heartbeats do
+    not create accounts_version nor transaction rows. updated_at is kept as is
+    because nothing about the account has changed.
+    """
+    if not account_ids:
+        return
+    db.session.execute(
+        Account.__table__.update()
+        .where(Account.id.in_(account_ids))
+        .values(last_visited_by_eve=func.now(), updated_at=Account.updated_at))
+    invalidate(db.session, [Account.__tablename__])
+
+
+def get_entry_key(i, dic):
+    """Returns the key of the i-th entry in the errors of ingest_accounts.
+    """
+    adwords_id = dic.get('adwords_id') if isinstance(dic, dict) else None
+    if adwords_id and isinstance(adwords_id, basestring):
+        return adwords_id
+    return 'row-%s' % i
+
+
+def ingest_accounts(entries):
+    """Applies Eve's entries to our accounts in a single transaction.
+
+    1. Every entry is parsed first so that bad data never reaches the session.
+    2. All referenced accounts are loaded with one IN query.
+    3. Only the values that changed are written, last_visited_by_eve is
+       recorded for every account by touch_last_visited_by_eve.
+    4. Everything is committed at once. Should that fail, the entries are
+       replayed one savepoint at a time so that one bad row does not roll back
+       the good ones.
+
+    Returns (updated_count, errors) where errors = { adwords_id: message }.
+    """
+    errors = {}
+    parsed = []       # [(adwords_id, values), ..]
+
+    for i, dic in enumerate(entries):
+        key = get_entry_key(i, dic)
+        try:
+            if not isinstance(dic, dict):
+                raise ValueError('Invalid entry: %s' % repr(dic))
+            if not isinstance(dic['adwords_id'], basestring):
+                raise ValueError('Invalid adwords_id: %s' % repr(dic['adwords_id']))
+            parsed.append((dic['adwords_id'], parse_entry(dic)))
+        except (KeyError, ValueError), e:
+            current_app.logger.warning('Invalid Eve entry: %s, data: %r', e, dic)
+            errors[key] = str(e)
+
+    accounts = {}
+    adwords_ids = list(set(adwords_id for adwords_id, values in parsed))
+    if adwords_ids:
+        for act in Account.query.filter(Account.adwords_id.in_(adwords_ids)):
+            accounts[act.adwords_id] = act
+
+    found = []
+    for adwords_id, values in parsed:
+        act = accounts.get(adwords_id)
+        if not act:
+            current_app.logger.warning(
+                'Account contained in Eve not found in db: adwords_id:%s', adwords_id)
+            errors[adwords_id] = 'Account not found.'
+            continue
+        found.append((act.id, adwords_id, values))
+
+        # TODO 04/13/2018 - Disabling checking on api_key and secret due to lack
+        # of manpower to go through our logs.
+        #elif act not in vps.accounts:
+        #    current_app.logger.warning(
+        #        "Vps.api_key not authorized to modify account. "
+        #        "status: %s, adwords_id:%s, vps.api_key:%s",
+        #        act.status, dic['adwords_id'], vps.api_key)
+        #    continue
+
+        apply_entry(act, values)
+
+    try:
+        touch_last_visited_by_eve([account_id for account_id, _, _ in found])
+        db.session.commit()
+        return len(found), errors
+    except SQLAlchemyError, e:
+        current_app.logger.warning('Bulk commit failed, retrying row by row: %s', e)
+        db.session.rollback()
+
+    updated = []
+    for account_id, adwords_id, values in found:
+        try:
+            with db.session.begin_nested():
+                apply_entry(Account.query.get(account_id), values)
+            updated.append(account_id)
+        except SQLAlchemyError, e:
+            current_app.logger.warning('Failed to update %s: %s, data: %r',
+                                       adwords_id, e, values)
+            errors[adwords_id] = str(getattr(e, 'orig', e)).strip()
+    touch_last_visited_by_eve(updated)
+    db.session.commit()
+    return len(updated), errors
+
+
 @eve_blueprint.route('/account/update', methods=['POST'])
 @basic_auth
 def update_accounts():
@@ -71,6 +219,8 @@ def update_accounts():
     the API call *will* include your personal cookies. This will result in
     transaction.user_id to be you as flask-login.current_user = you.
 
+    All entries are ingested in one transaction, see ingest_accounts.
+
     TODO:
     1. decide on the right course of action when act does not exist
     2. decide on whether we want to check vendor info
@@ -86,40 +236,74 @@ def update_accounts():
     if not dics:
         return jsonify(success=False, message='No data present.')
 
-    updated = 0
+    if current_app.config.get('EVE_ASYNC_INGEST'):
+        submission = EveSubmission.enqueue(request.data, request.authorization.username)
+        return jsonify(success=True, queued=True, submission_id=submission.id), 202
 
-    for dic in dics['response']:
-        try:
-            act = Account.query.filter(Account.adwords_id == dic['adwords_id']).one_or_none()
-            if not act:
-                print "Account contained in Eve not found in db: adwords_id:%s" % dic['adwords_id']
-                continue
-
-            # TODO 04/13/2018 - Disabling checking on api_key and secret due to lack
-            # of manpower to go through our logs.
-            #elif act not in vps.accounts:
-            #    current_app.logger.warning(
-            #        "Vps.api_key not authorized to modify account. "
-            #        "status: %s, adwords_id:%s, vps.api_key:%s",
-            #        act.status, dic['adwords_id'], vps.api_key)
-            #    continue
-
-            else:
-                if dic['account_budget'] == UNLIMITED_SPENDING:
-                    act.is_unlimited = True
-                act.currency = parse_currency(dic['daily_budget'])
-                act.account_budget = parse_numeral(dic['account_budget'])
-                act.remaining_account_budget = parse_numeral(dic['remaining_account_budget'])
-                act.daily_budget = parse_numeral(dic['daily_budget'])
-                act.nickname = dic['nickname']
-                act.last_visited_by_eve = func.now()
-                db.session.add(act)
+    updated, errors = ingest_accounts(dics['response'])
+    return jsonify(success=True, updated_count=updated, errors=errors)
+
+
+def drain_eve_queue(batch_size):
+    """Ingests up to batch_size queued submissions with a single ingest_accounts.
+
+    Entries are applied in the order they were submitted, so the latest report
+    of an account wins. Should the batch raise, the submissions are ingested one
+    at a time and those which still raise are marked processed with the error, so
+    that they are not claimed again. Returns the number of submissions processed.
+    """
+    submissions = EveSubmission.claim(batch_size)
+    if not submissions:
+        return 0
+
+    try:
+        ingest_submissions(submissions)
+    except Exception:
+        current_app.logger.exception('Batch of Eve submissions failed, retrying one by one')
+        db.session.rollback()
+
+        for submission in submissions:
+            try:
+                ingest_submissions([submission])
+            except Exception, e:
+                current_app.logger.exception('Failed to ingest %s', submission)
+                db.session.rollback()
+                submission.updated_count = 0
+                submission.errors = json.dumps({'submission': text_type(e)})
+                submission.processed_at = func.now()
                 db.session.commit()
-                updated += 1
-        except Exception, e:
-            print 'Exception:', e,
-            print 'Data:', dic
-            db.session.rollback()
-            continue
 
-    return jsonify(success=True, updated_count=updated)
+    return len(submissions)
+
+
+def ingest_submissions(submissions):
+    """Ingests the entries of `submissions` in one ingest_accounts and records the
+    outcome on each submission. A payload without a list of entries is recorded
+    as an error.
+    """
+    entries = []
+    keys = {}        # { submission.id: [key of each entry, ..] }, see get_entry_key
+    payload_errors = {}
+    for submission in submissions:
+        try:
+            response = json.loads(submission.payload)['response']
+            if not isinstance(response, list):
+                raise ValueError('response is not a list')
+        except (ValueError, KeyError, TypeError), e:
+            current_app.logger.warning('Bad payload of %s: %s', submission, e)
+            payload_errors[submission.id] = {'payload': 'Bad payload: %s' % e}
+            response = []
+        keys[submission.id] = [get_entry_key(len(entries) + i, dic)
+                               for i, dic in enumerate(response)]
+        entries.extend(response)
+
+    updated, errors = ingest_accounts(entries)
+
+    for submission in submissions:
+        own_keys = keys[submission.id]
+        own_errors = dict((key, errors[key]) for key in own_keys if key in errors)
+        own_errors.update(payload_errors.get(submission.id, {}))
+        submission.updated_count = len([key for key in own_keys if key not in errors])
+        submission.errors = json.dumps(own_errors)
+        submission.processed_at = func.now()
+    db.session.commit()
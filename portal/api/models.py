@@ -0,0 +1,63 @@
+from datetime import timedelta
+
+from portal.models import db
+from sqlalchemy import and_, or_
+from sqlalchemy.sql import func
+
+
+class EveSubmission(db.Model):
+    """A raw payload posted by Eve to /eve/account/update, waiting to be ingested by
+    `python manage.py eve_worker`.
+    """
+    __tablename__ = 'eve_submissions'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    api_key = db.Column(db.String())
+    payload = db.Column(db.Text(), nullable=False)
+
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    started_at = db.Column(db.DateTime(timezone=True))
+    processed_at = db.Column(db.DateTime(timezone=True), index=True)
+
+    updated_count = db.Column(db.Integer)
+    errors = db.Column(db.Text())
+
+    # A worker that died mid-batch releases its submissions after this long
+    STALE_AFTER = timedelta(minutes=10)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, self.id)
+
+    @classmethod
+    def enqueue(cls, payload, api_key=None):
+        submission = cls(payload=payload, api_key=api_key)
+        db.session.add(submission)
+        db.session.commit()
+        return submission
+
+    @classmethod
+    def claim(cls, limit):
+        """Returns up to `limit` pending submissions in the order they arrived and
+        marks them as started so that other workers skip them.
+        """
+        submissions = cls.query.filter(and_(
+            cls.processed_at.is_(None),
+            or_(cls.started_at.is_(None),
+                cls.started_at < func.now() - cls.STALE_AFTER))
+        ).order_by(cls.id).limit(limit).with_for_update(skip_locked=True).all()
+
+        for submission in submissions:
+            submission.started_at = func.now()
+        db.session.commit()
+        return submissions
+
+    @classmethod
+    def get_stats(cls):
+        """Returns (depth, lag) of the queue. lag is a timedelta of how long the oldest
+        pending submission has been waiting, or None if the queue is empty.
+        """
+        depth, lag = db.session.query(
+            func.count(cls.id), func.now() - func.min(cls.created_at)
+        ).filter(cls.processed_at.is_(None)).one()
+        return depth, lag
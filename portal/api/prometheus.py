@@ -1,9 +1,23 @@
 
+import json
 from functools import wraps
 
-from flask import Blueprint, Response, current_app, jsonify, request
-from portal.account.models import Account
+from flask import (Blueprint, Response, current_app, jsonify, request,
+                   stream_with_context)
+from flask_user.signals import user_changed_password
+from portal.account.models import Account, association_table
+from portal.api.models import EveSubmission
+from portal.cache import cache, prometheus_credentials
+from portal.models import db
 from portal.user.models import User
+from portal.utils.conditional import (conditional, get_high_water_mark,
+                                      make_etag)
+from portal.utils.entity_cache import entity_cache
+from portal.vendor.models import Vendor
+from portal.vps.models import Vps
+from sqlalchemy import String, cast, literal_column
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.sql import func
 
 prometheus_blueprint = Blueprint('prometheus', __name__, template_folder='templates')
 
@@ -12,9 +26,22 @@ def check_auth(username, password):
     if username != current_app.config['PROMETHEUS_API_LOGIN']:
         return False
 
+    if prometheus_credentials.is_verified(username, password):
+        return True
+
     user = User.query.filter(
         User.username == current_app.config['PROMETHEUS_API_LOGIN']).one()
-    return current_app.user_manager.verify_password(password, user)
+    if current_app.user_manager.verify_password(password, user):
+        prometheus_credentials.set_verified(username, password)
+        return True
+    return False
+
+
+@user_changed_password.connect
+def on_user_changed_password(sender, user, **extra):
+    """Password changed through flask-user's change password page.
+    """
+    prometheus_credentials.invalidate(user.username)
 
 
 def basic_auth(f):
@@ -31,8 +58,83 @@ def basic_auth(f):
     return decorated
 
 
+def _get_vps_subquery():
+    """Aggregates the VPSs of each account. aws and names are the parts of
+    Account.VPSs_jinja: the AWS VPS if there is one, otherwise all VPS names.
+    """
+    return db.session.query(
+        association_table.c.account_id.label('account_id'),
+        func.min(Vps.name).filter(func.upper(Vps.provider).like('AWS%')).label('aws'),
+        func.string_agg(Vps.name, aggregate_order_by(literal_column("', '"), Vps.name))
+        .label('names'),
+    ).join(Vps, Vps.id == association_table.c.vps_id) \
+        .group_by(association_table.c.account_id).subquery()
+
+
+def _get_hkd_columns():
+    """Returns (daily_budget_in_hkd, spent_in_hkd) computed in SQL, honouring the budget
+    overrides like the model properties do.
+    """
+    account_budget, remaining_account_budget = Account.get_budget_expressions()
+    return (
+        (Account.daily_budget * Account.exchange_rate).label('daily_budget_in_hkd'),
+        ((account_budget - remaining_account_budget) * Account.exchange_rate)
+        .label('spent_in_hkd'),
+    )
+
+
+def get_account_list_query():
+    """Returns a single query yielding one row per account with everything that
+    list_accounts needs, so that exporting N accounts does not take 2N+1 queries.
+    """
+    wm_id = current_app.config['WHALESMEDIA_USER_ID']
+    vps = _get_vps_subquery()
+
+    return db.session.query(
+        Account.adwords_id,
+        Account.status,
+        Account.login,
+        Vendor.nickname.label('vendor_nickname'),
+        func.coalesce(vps.c.aws, vps.c.names, '').label('vps'),
+        *_get_hkd_columns()
+    ).outerjoin(Vendor, Vendor.id == Account.vendor_id) \
+        .outerjoin(vps, vps.c.account_id == Account.id) \
+        .filter(Account.client_id >= wm_id)
+
+
+def get_account_dict(row):
+    return dict(
+        status=str(row.status.name),
+        daily_budget_in_hkd=round(row.daily_budget_in_hkd or 0, 2),
+        spent_in_hkd=round(row.spent_in_hkd or 0, 2),
+        login=row.login,
+        vendor_nickname=row.vendor_nickname,
+        vps=row.vps,
+    )
+
+
+def get_account_list_etag():
+    """Changes whenever an exported account, a vendor or a VPS is inserted, updated or
+    deleted, or an account is moved to another VPS.
+    """
+    wm_id = current_app.config['WHALESMEDIA_USER_ID']
+    link = cast(association_table.c.account_id, String) + ':' + \
+        cast(association_table.c.vps_id, String)
+    links = db.session.query(func.md5(func.string_agg(
+        link, aggregate_order_by(literal_column("','"), link)))).scalar()
+
+    return make_etag(
+        get_high_water_mark(Account.query.filter(Account.client_id >= wm_id), Account),
+        get_high_water_mark(Vendor.query, Vendor),
+        get_high_water_mark(Vps.query, Vps),
+        links,
+        request.args.get('stream'),
+    )
+
+
 @prometheus_blueprint.route('/account/list', methods=['GET'])
 @basic_auth
+@conditional(get_account_list_etag)
 def list_accounts():
     """Returns json of our accounts with the following fields:
     - adwords_id
@@ -50,16 +152,158 @@ def list_accounts():
                         },
         '234-678-8900': ...
     }
+
+    Pass ?stream=1 to have the response written as the rows are fetched instead
+    of being built in memory first.
     """
-    wm_id = current_app.config['WHALESMEDIA_USER_ID']
+    query = get_account_list_query()
+    if request.args.get('stream'):
+        return Response(stream_with_context(_stream_accounts(query)),
+                        mimetype='application/json')
+
     ret = {}
-    for account in Account.query.filter(Account.client_id >= wm_id):
-        ret[account.adwords_id] = dict(
-            status=str(account.status.name),
-            daily_budget_in_hkd=round(account.daily_budget_in_hkd or 0, 2),
-            spent_in_hkd=round(account.spent_in_hkd or 0, 2),
-            login=account.login,
-            vendor_nickname=account.vendor.nickname,
-            vps=account.VPSs_jinja,
-        )
+    for row in query:
+        ret[row.adwords_id] = get_account_dict(row)
     return jsonify(ret)
+
+
+def _stream_accounts(query):
+    yield '{'
+    sep = ''
+    for row in query.yield_per(current_app.config['PROMETHEUS_STREAM_BATCH_SIZE']):
+        yield '%s%s: %s' % (sep, json.dumps(row.adwords_id),
+                            json.dumps(get_account_dict(row)))
+        sep = ', '
+    yield '}'
+
+
+@prometheus_blueprint.route('/eve/queue', methods=['GET'])
+@basic_auth
+def eve_queue():
+    """Returns the backlog of Eve submissions waiting for `manage.py eve_worker`:
+    {
+        'depth': 12,
+        'lag_seconds': 35.2
+    }
+    """
+    depth, lag = EveSubmission.get_stats()
+    return jsonify(depth=depth, lag_seconds=lag.total_seconds() if lag else 0)
+
+
+def get_metrics_query():
+    """Same as get_account_list_query but with the seconds since Eve last visited the
+    account.
+    """
+    return get_account_list_query().add_columns(
+        func.extract('epoch', func.now() - Account.last_visited_by_eve).label('eve_age'))
+
+
+def get_status_counts():
+    """Returns ([(vendor nickname, status, count)], [(VPS name, status, count)]) of every
+    account, counted by one GROUP BY each.
+    """
+    count = func.count(Account.id)
+    by_vendor = db.session.query(Vendor.nickname, Account.status, count) \
+        .select_from(Account) \
+        .outerjoin(Vendor, Vendor.id == Account.vendor_id) \
+        .group_by(Vendor.nickname, Account.status)
+    by_vps = db.session.query(Vps.name, Account.status, count) \
+        .select_from(Account) \
+        .join(association_table, association_table.c.account_id == Account.id) \
+        .join(Vps, Vps.id == association_table.c.vps_id) \
+        .group_by(Vps.name, Account.status)
+
+    def _sorted(rows):
+        return sorted(rows, key=lambda (name, status, count): (name, status.name))
+    return _sorted(by_vendor), _sorted(by_vps)
+
+
+def _escape_label_value(value):
+    return unicode(value if value is not None else '') \
+        .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricFamily(object):
+    """A gauge in the Prometheus text exposition format.
+    """
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.samples = []
+
+    def add(self, value, **labels):
+        self.samples.append((labels, value))
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s gauge' % self.name]
+        for labels, value in self.samples:
+            label_str = ','.join('%s="%s"' % (k, _escape_label_value(v))
+                                 for k, v in sorted(labels.iteritems()))
+            if label_str:
+                label_str = '{%s}' % label_str
+            lines.append('%s%s %s' % (self.name, label_str, repr(float(value))))
+        return '\n'.join(lines)
+
+
+def render_metrics():
+    """Returns all metrics as text. Per account series are limited to the accounts
+    exported by list_accounts, the counts cover every account.
+    """
+    spent = MetricFamily('portal_account_spent_hkd', 'Amount spent by the account in HKD.')
+    daily_budget = MetricFamily('portal_account_daily_budget_hkd',
+                                'Daily budget of the account in HKD.')
+    eve_age = MetricFamily('portal_account_eve_age_seconds',
+                           'Seconds since Eve last updated the account.')
+    vendor_counts = MetricFamily('portal_vendor_accounts',
+                                 'Number of accounts per vendor and status.')
+    vps_counts = MetricFamily('portal_vps_accounts', 'Number of accounts per VPS and status.')
+
+    for row in get_metrics_query():
+        labels = dict(adwords_id=row.adwords_id, status=row.status.name,
+                      vendor=row.vendor_nickname, vps=row.vps)
+        spent.add(row.spent_in_hkd or 0, **labels)
+        daily_budget.add(row.daily_budget_in_hkd or 0, **labels)
+        if row.eve_age is not None:
+            eve_age.add(row.eve_age, adwords_id=row.adwords_id)
+
+    by_vendor, by_vps = get_status_counts()
+    for vendor, status, count in by_vendor:
+        vendor_counts.add(count, vendor=vendor, status=status.name)
+    for vps, status, count in by_vps:
+        vps_counts.add(count, vps=vps, status=status.name)
+
+    depth, lag = EveSubmission.get_stats()
+    queue_depth = MetricFamily('portal_eve_queue_depth',
+                               'Eve submissions waiting to be ingested.')
+    queue_depth.add(depth)
+    queue_lag = MetricFamily('portal_eve_queue_lag_seconds',
+                             'Age of the oldest Eve submission waiting to be ingested.')
+    queue_lag.add(lag.total_seconds() if lag else 0)
+
+    entity_cache_stats = entity_cache.get_stats()
+    entity_cache_hits = MetricFamily('portal_entity_cache_hits',
+                                     'Cached account attributes served from the cache.')
+    entity_cache_hits.add(entity_cache_stats['hits'])
+    entity_cache_misses = MetricFamily('portal_entity_cache_misses',
+                                       'Cached account attributes which were computed.')
+    entity_cache_misses.add(entity_cache_stats['misses'])
+
+    families = [spent, daily_budget, eve_age, vendor_counts, vps_counts,
+                queue_depth, queue_lag, entity_cache_hits, entity_cache_misses]
+    return '\n'.join(f.render() for f in families) + '\n'
+
+
+@prometheus_blueprint.route('/metrics', methods=['GET'])
+@basic_auth
+def metrics():
+    """Returns the metrics in the Prometheus text format so that they can be scraped
+    without an exporter. The output is cached for PROMETHEUS_METRICS_CACHE_TIMEOUT
+    seconds, so ages are as of the time it was generated.
+    """
+    key = 'prometheus_metrics'
+    ret = cache.get(key)
+    if ret is None:
+        ret = render_metrics()
+        cache.set(key, ret, timeout=current_app.config['PROMETHEUS_METRICS_CACHE_TIMEOUT'])
+    return Response(ret, mimetype='text/plain; version=0.0.4')
@@ -3,6 +3,8 @@ from flask import Markup, url_for
 from portal.account.models import Account
 from portal.models import TimeTrackedModel, db
 from portal.transfer.models import Transfer
+from portal.vendor.models import Vendor
+from sqlalchemy.sql import func
 
 
 class BankAccount(TimeTrackedModel):
@@ -21,38 +23,83 @@ class BankAccount(TimeTrackedModel):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def get_rollups(cls, bank_account_ids):
+        """Returns { bank account id: (transfer_count, total_sent_in_hkd, total_spent_in_hkd,
+        total_remaining_in_hkd) } in two grouped queries, one over the transfers and one
+        over the accounts of the vendors:
+
+        SELECT bank_account_id, count(id), sum(coalesce(net * exchange_rate, 0))
+        FROM transfers WHERE bank_account_id IN (...) GROUP BY bank_account_id
+
+        SELECT vendors.bank_account_id,
+               sum(coalesce((account_budget - remaining_account_budget) * exchange_rate, 0)),
+               sum(coalesce(remaining_account_budget * exchange_rate, 0))
+        FROM accounts JOIN vendors ON vendors.id = accounts.vendor_id
+        WHERE vendors.bank_account_id IN (...) GROUP BY vendors.bank_account_id
+
+        where the budgets have their overrides applied.
+        """
+        ret = dict((bank_account_id, (0, 0, 0, 0)) for bank_account_id in bank_account_ids)
+        if not bank_account_ids:
+            return ret
+
+        transfers = db.session.query(
+            Transfer.bank_account_id, func.count(Transfer.id),
+            func.sum(func.coalesce(Transfer.net * Transfer.exchange_rate, 0))
+        ).filter(Transfer.bank_account_id.in_(bank_account_ids)) \
+            .group_by(Transfer.bank_account_id)
+
+        account_budget, remaining_account_budget = Account.get_budget_expressions()
+        accounts = db.session.query(
+            Vendor.bank_account_id,
+            func.sum(func.coalesce(
+                (account_budget - remaining_account_budget) * Account.exchange_rate, 0)),
+            func.sum(func.coalesce(remaining_account_budget * Account.exchange_rate, 0))
+        ).join(Account.vendor).filter(Vendor.bank_account_id.in_(bank_account_ids)) \
+            .group_by(Vendor.bank_account_id)
+
+        for bank_account_id, count, sent in transfers:
+            ret[bank_account_id] = (count, sent) + ret[bank_account_id][2:]
+        for bank_account_id, spent, remaining in accounts:
+            ret[bank_account_id] = ret[bank_account_id][:2] + (spent, remaining)
+        return ret
+
+    @classmethod
+    def set_rollups(cls, bank_accounts):
+        """Loads the rollups of all `bank_accounts` in two queries.
+        """
+        rollups = cls.get_rollups([b.id for b in bank_accounts])
+        for bank_account in bank_accounts:
+            bank_account._rollup = rollups[bank_account.id]
+
+    def get_rollup(self):
+        """The rollup preloaded for a whole page by set_rollups, otherwise queried for this
+        bank account alone.
+        """
+        if '_rollup' in self.__dict__:
+            return self._rollup
+        return BankAccount.get_rollups([self.id])[self.id]
+
     @property
     def transfer_count(self):
         url = url_for('transfer.index_view', flt1_0=self.name)
-        count = Transfer.query.filter(Transfer.bank_account_id == self.id).count()
+        count = self.get_rollup()[0]
         return Markup('<u><a href=%s>%s</a></u>' % (url, count))
 
     @property
     def total_sent_in_hkd(self):
-        total = 0
-        for transfer in Transfer.query.filter(Transfer.bank_account_id == self.id):
-            if transfer.net and transfer.exchange_rate:
-                total += transfer.net * transfer.exchange_rate
-        return total
+        return self.get_rollup()[1]
 
     @property
     def total_spent_in_hkd(self):
-        total = 0
-        for act in Account.query.filter(Account.vendor_id.in_(
-                [ v.id for v in self.vendors ])):
-            total += act.spent_in_hkd
-        return total
+        return self.get_rollup()[2]
 
     @property
     def total_remaining_in_hkd(self):
-        total = 0
-        for act in Account.query.filter(Account.vendor_id.in_(
-                [ v.id for v in self.vendors ])):
-            if act.get_remaining_account_budget() and act.exchange_rate:
-                total += act.get_remaining_account_budget() * act.exchange_rate
-        return total
+        return self.get_rollup()[3]
 
     @property
     def total_outstanding_in_hkd(self):
-        return self.total_sent_in_hkd - self.total_spent_in_hkd - self.total_remaining_in_hkd
-
+        _, sent, spent, remaining = self.get_rollup()
+        return sent - spent - remaining
@@ -3,6 +3,7 @@ from flask_babelex import lazy_gettext as lg
 from wtforms.validators import required
 
 from portal.admin.utils import AuthorizationRequiredView, TimeTrackedModelView
+from portal.bank_account.models import BankAccount
 from portal.user import RolesEnum
 from portal.utils import ColumnMetaContainer
 
@@ -60,3 +61,13 @@ class BankAccountModelView(TimeTrackedModelView, AuthorizationRequiredView):
     column_formatters = {
         'vendors': macro('render_vendors'),
     }
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        count, query = super(BankAccountModelView, self).get_list(
+            page, sort_column, sort_desc, search, filters, execute, page_size)
+
+        # The totals of the whole page in two queries
+        if execute:
+            BankAccount.set_rollups(query)
+        return count, query
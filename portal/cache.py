@@ -1,11 +1,103 @@
+import hashlib
+import hmac
+from time import time
+
+from flask import current_app
 from flask_cache import Cache
+from werkzeug.contrib.cache import FileSystemCache
 
 cache = Cache()
 
 
-class CacheHelper(object):
-    def get_clients_allowed_key(self, vendor_id):
-        return 'clients_allowed-%s' % vendor_id
+class SharedFileSystemCache(FileSystemCache):
+    """One file per key in CACHE_DIR, shared by every process of the host.
+
+    werkzeug lists the whole directory on every set to enforce the threshold. Here
+    that is done at most once every `prune_interval` seconds per process.
+    """
+    def __init__(self, cache_dir, prune_interval=60, **kwargs):
+        super(SharedFileSystemCache, self).__init__(cache_dir, **kwargs)
+        self.prune_interval = prune_interval
+        self._pruned_at = time()
+
+    def _prune(self):
+        if time() - self._pruned_at >= self.prune_interval:
+            self._pruned_at = time()
+            super(SharedFileSystemCache, self)._prune()
+
+
+def filesystem(app, config, args, kwargs):
+    """Flask-Cache backend factory for SharedFileSystemCache.
+    """
+    kwargs.update(dict(threshold=config['CACHE_THRESHOLD'],
+                       prune_interval=config.get('CACHE_PRUNE_INTERVAL', 60)))
+    return SharedFileSystemCache(config['CACHE_DIR'], *args, **kwargs)
+
+
+# Backends seen by every process of the host, see init_cache
+SHARED_CACHE_TYPES = ['filesystem', 'redis']
+
+
+def is_shared(app=None):
+    """Whether an invalidation by one process reaches the others. Per process state
+    versioned through `cache` must not be trusted otherwise.
+    """
+    app = app or current_app
+    return app.config.get('CACHE_TYPE', 'simple') in SHARED_CACHE_TYPES
+
+
+def init_cache(app):
+    """Sets up `cache` with the backend named by CACHE_TYPE:
+
+    - simple: private to each process, a cache.delete only reaches one worker
+    - filesystem: shared by the workers of a host through CACHE_DIR, not by other
+      hosts (e.g. Heroku dynos)
+    - redis: shared by every host through CACHE_REDIS_URL, needs the redis package
+    """
+    cache_type = app.config.get('CACHE_TYPE', 'simple')
+    if cache_type == 'filesystem':
+        cache_type = 'portal.cache.filesystem'
+    elif cache_type == 'redis':
+        if not app.config.get('CACHE_REDIS_URL') and not app.config.get('CACHE_REDIS_HOST'):
+            raise ValueError('CACHE_TYPE redis requires CACHE_REDIS_URL.')
+        try:
+            import redis  # noqa
+        except ImportError:
+            raise ImportError('CACHE_TYPE redis requires the redis package.')
+    cache.init_app(app, config={'CACHE_TYPE': cache_type})
+
+
+class CredentialCache(object):
+    """Remembers API credentials which passed verification for
+    API_AUTH_CACHE_TIMEOUT seconds so that repeated calls skip the DB (and bcrypt).
+
+    Only a keyed hash of (username, password) is stored. Call invalidate when the
+    credentials of username change.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+
+    def _get_key(self, username):
+        return '%s-%s' % (self.prefix, username)
+
+    def _digest(self, username, password):
+        msg = u'%s:%s' % (username, password)
+        return hmac.new(str(current_app.config['SECRET_KEY']), msg.encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def is_verified(self, username, password):
+        digest = cache.get(self._get_key(username))
+        return digest is not None and \
+            hmac.compare_digest(digest, self._digest(username, password))
+
+    def set_verified(self, username, password):
+        cache.set(self._get_key(username), self._digest(username, password),
+                  timeout=current_app.config['API_AUTH_CACHE_TIMEOUT'])
+
+    def invalidate(self, username):
+        if username:
+            cache.delete(self._get_key(username))
 
 
-cache_helper = CacheHelper()
+eve_credentials = CredentialCache('eve_auth')
+prometheus_credentials = CredentialCache('prometheus_auth')
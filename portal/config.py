@@ -35,9 +35,48 @@ class Core(object):
     PROMETHEUS_API_LOGIN = 'prometheus'
     WHALESMEDIA_USER_ID = 888
 
-    CACHE_TYPE = 'simple'
+    # Rows fetched per round trip by /prometheus/account/list?stream=1
+    PROMETHEUS_STREAM_BATCH_SIZE = 1000
+
+    # Seconds for which /prometheus/metrics is served from the cache
+    PROMETHEUS_METRICS_CACHE_TIMEOUT = 30
+
+    # Seconds for which verified Eve/Prometheus credentials are remembered
+    API_AUTH_CACHE_TIMEOUT = 300
+
+    # See portal.cache.init_cache. 'simple' is private to each gunicorn worker, so
+    # the query, entity and permission caches diverge between them.
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')
     CACHE_DEFAULT_TIMEOUT = 86400
     CACHE_THRESHOLD = 999999
+    CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/portal-cache')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+    CACHE_KEY_PREFIX = 'portal_'
+
+    # Seconds between checks of CACHE_THRESHOLD by each process (filesystem only)
+    CACHE_PRUNE_INTERVAL = 60
+
+    # Account list views fetch their rows page by page from index_view_rows
+    # instead of rendering every account into the page.
+    ACCOUNT_LIST_SERVER_SIDE = False
+
+    # Seconds between runs of `python manage.py widget_refresher` (see Procfile),
+    # which computes the cached widgets of every role and locale before they expire
+    WIDGET_REFRESH_INTERVAL = 30
+    WIDGET_LOCALES = ['en', 'zh_CN']
+
+    # Accounts committed per transaction when importing a CSV/XLSX file
+    ACCOUNT_IMPORT_CHUNK_SIZE = 100
+
+    # Rows fetched per round trip when exporting accounts
+    ACCOUNT_EXPORT_BATCH_SIZE = 1000
+
+    # Entries of an account's change history per page of details_view
+    ACCOUNT_HISTORY_PAGE_SIZE = 50
+
+    # /eve/account/update only queues the payload and returns 202. Requires
+    # `python manage.py eve_worker` (see Procfile) to be running.
+    EVE_ASYNC_INGEST = False
 
 
 class DevelopmentConfig(Core):
@@ -52,10 +91,17 @@ class HerokuConfig(Core):
     TESTING = False
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', None)
 
+    # The web, worker and one-off dynos only share redis (REDIS_URL is set by the
+    # Heroku Redis add-on). The query, entity and permission caches are invalidated
+    # through it, hence there is no fallback to the per-dyno filesystem.
+    CACHE_TYPE = 'redis'
+    CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+
 
 class TestingConfig(Core):
-    SERVER_NAME = 'Testing'
+    SERVER_NAME = 'localhost'
     DEBUG = True
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/portal_testing'
     SQLALCHEMY_ECHO = False
+    WTF_CSRF_ENABLED = False
@@ -18,7 +18,7 @@ from speaklater import _LazyString
 from sqlalchemy import MetaData
 from werkzeug.routing import BaseConverter
 
-from .cache import cache
+from .cache import init_cache
 from .models import db
 
 
@@ -70,12 +70,14 @@ def create_app(config, register_blueprints=True):
 
     # This needs to be after db is instantiated for migrate to discover
     from portal.user.models import Role, User
-    from portal.account.models import Account
+    from portal.account.models import Account, AccountSnapshot
+    from portal.account.counters import AccountStatusCount
     from portal.vps.models import Vps
     from portal.vendor.models import Vendor
     from portal.transfer.models import Transfer
     from portal.bank_account.models import BankAccount
     from portal.permission.models import Permission
+    from portal.api.models import EveSubmission
     Migrate(app, db)
 
     db_adapter = SQLAlchemyAdapter(db, User)
@@ -85,7 +87,7 @@ def create_app(config, register_blueprints=True):
 
     #DebugToolbarExtension(app)
 
-    cache.init_app(app, config={'CACHE_TYPE': 'simple'})
+    init_cache(app)
 
     babel = Babel(app)
     # Monkeypatching Flask-babel
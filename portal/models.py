@@ -1,10 +1,11 @@
 
 from flask_sqlalchemy import SQLAlchemy
+from portal.utils.query_cache import VersionedCachingQuery
 from sqlalchemy.sql import func
 from sqlalchemy_continuum import make_versioned, versioning_manager
 from sqlalchemy_continuum.plugins import FlaskPlugin, PropertyModTrackerPlugin
 
-db = SQLAlchemy()
+db = SQLAlchemy(query_class=VersionedCachingQuery)
 
 make_versioned(plugins=[FlaskPlugin()])
 versioning_manager.plugins.append(PropertyModTrackerPlugin())
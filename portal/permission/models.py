@@ -1,6 +1,8 @@
 
+from portal.cache import is_shared
 from portal.models import TimeTrackedModel, db
-from sqlalchemy import and_
+from portal.utils import ranges
+from portal.utils.query_cache import get_generations
 
 
 class Permission(TimeTrackedModel):
@@ -26,9 +28,64 @@ class Permission(TimeTrackedModel):
 
     @classmethod
     def check(self, vendor, user):
-        """https://stackoverflow.com/questions/32938475/flask-sqlalchemy-check-if-row-exists-in-table
-        """
         if vendor and user:
-            return db.session.query(db.exists().where(
-                and_(Permission.vendor_id == vendor.id, Permission.user_id == user.id))).scalar()
+            return permission_index.check(vendor.id, user.id)
+
+
+class PermissionIndex(object):
+    """The whole permission matrix, held by every process.
+
+    { vendor_id: frozenset of client ids } and the ranges() string of each vendor,
+    built in one query. The index is versioned by the query cache generation of the
+    permissions table, which any write to it through the session bumps (see
+    portal.utils.query_cache), and rebuilt by the first reader after a bump.
+
+    The rows are read through their own connection so that permissions flushed but
+    not yet committed never make it into the index.
+
+    The other processes only see the bump through a shared cache (see
+    portal.cache.is_shared). With a per process cache, a permission granted or
+    revoked by another worker would never reach this one, so the database is
+    queried instead.
+    """
+    def __init__(self):
+        # (generation, clients, ranges), swapped as a whole
+        self._index = (None, {}, {})
+
+    def _get_index(self):
+        generation = get_generations([Permission.__tablename__])[0]
+        if self._index[0] != generation:
+            self._index = (generation, ) + self.build()
+        return self._index
+
+    def build(self):
+        rows = db.engine.execute(
+            db.select([Permission.vendor_id, Permission.user_id])
+            .order_by(Permission.vendor_id, Permission.user_id))
+
+        user_ids = {}
+        for vendor_id, user_id in rows:
+            user_ids.setdefault(vendor_id, []).append(user_id)
+
+        clients = {vendor_id: frozenset(ids) for vendor_id, ids in user_ids.iteritems()}
+        vendor_ranges = {vendor_id: ranges(ids) for vendor_id, ids in user_ids.iteritems()}
+        return clients, vendor_ranges
+
+    def check(self, vendor_id, user_id):
+        if not is_shared():
+            return db.session.query(db.exists().where(db.and_(
+                Permission.vendor_id == vendor_id, Permission.user_id == user_id))).scalar()
+        return user_id in self._get_index()[1].get(vendor_id, ())
+
+    def get_ranges(self, vendor_id):
+        """Returns the clients allowed to use the accounts of the vendor, as in
+        '1-3, 5', None if there are none.
+        """
+        if not is_shared():
+            user_ids = [user_id for user_id, in db.session.query(Permission.user_id)
+                        .filter(Permission.vendor_id == vendor_id).order_by(Permission.user_id)]
+            return ranges(user_ids) or None
+        return self._get_index()[2].get(vendor_id)
+
 
+permission_index = PermissionIndex()
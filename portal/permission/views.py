@@ -9,7 +9,6 @@ from flask_user import current_user
 from sqlalchemy import and_
 
 from portal.admin.utils import AuthorizationRequiredView, TimeTrackedModelView
-from portal.cache import cache, cache_helper
 from portal.models import db
 from portal.permission.models import Permission
 from portal.user import RolesEnum
@@ -131,9 +130,6 @@ class PermissionModelView(TimeTrackedModelView, AuthorizationRequiredView):
             db.session.add(p)
             db.session.commit()
 
-            key = cache_helper.get_clients_allowed_key(vendor_id)
-            cache.delete(key)
-
     def delete_if_exists(self, vendor_id, user_id):
         conditions = and_(
                 Permission.vendor_id == vendor_id,
@@ -143,17 +139,9 @@ class PermissionModelView(TimeTrackedModelView, AuthorizationRequiredView):
             Permission.query.filter(conditions).delete()
             db.session.commit()
 
-            key = cache_helper.get_clients_allowed_key(vendor_id)
-            cache.delete(key)
-
     def on_model_change(self, form, model, is_created):
         model.created_by = current_user
 
-    def on_model_delete(self, model):
-        if model.vendor_id:
-            key = cache_helper.get_clients_allowed_key(model.vendor_id)
-            cache.delete(key)
-
     def render(self, template, **kwargs):
         if template == 'permission/list.html':
              kwargs['vendors'] = Vendor.query.filter(Vendor.is_active == True).order_by(Vendor.id)
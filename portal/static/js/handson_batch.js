@@ -44,6 +44,10 @@ function translate(resp) {
   } else {
     ret += 'Not Successful!\n\n'
 
+    if (resp.message) {
+      ret += resp.message + '\n\n';
+    }
+
     for (const [row_num_1, list] of Object.entries(resp.errors)) {
       ret +=`Row ${row_num_1}:\n`;
 
@@ -0,0 +1,15 @@
+// Loads every widget placeholder (see templates/widgets/macros.html) in parallel
+$(function() {
+  $('.widget-placeholder').each(function() {
+    var $placeholder = $(this);
+    $.get($placeholder.data('url'))
+      .done(function(html) {
+        $placeholder.replaceWith(html);
+      })
+      .fail(function(xhr) {
+        $placeholder.find('p')
+          .removeClass('text-muted').addClass('text-danger')
+          .text(xhr.status + ' ' + xhr.statusText);
+      });
+  });
+});
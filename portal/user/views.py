@@ -1,11 +1,12 @@
 
-from flask import Blueprint, render_template
+from flask import Blueprint, abort, render_template
 from flask_user import current_user, login_required
 
 from portal.account.widgets import (AccountHistoryWidget, ActiveAccountsWidget,
                                     AttentionWidget, ExpiringWidget,
                                     HighSpendWidget, NotUpdatedTodayWidget,
                                     RecentStatusChangeWidget, TotalSpendWidget)
+from portal.utils.widgets import get_widget_classes
 
 user_blueprint = Blueprint('user', __name__, template_folder='templates')
 
@@ -29,6 +30,22 @@ def member_page():
                                                  recent_status_change_widget=RecentStatusChangeWidget())
 
 
+@user_blueprint.route('/widget/<name>')
+@login_required
+def widget(name):
+    """Renders a single widget. member_page and important_widgets only render
+    placeholders which fetch their widgets from here.
+    """
+    cls = get_widget_classes().get(name)
+    if cls is None or cls.template is None:
+        abort(404)
+
+    widget = cls()
+    if not widget.is_accessible():
+        abort(403)
+    return render_template(widget.template, widget=widget)
+
+
 @user_blueprint.route('/budget')
 @login_required
 def budget():
@@ -0,0 +1,40 @@
+import hashlib
+from functools import wraps
+
+from flask import Response, request
+from sqlalchemy.sql import func
+
+
+def make_etag(*parts):
+    return hashlib.md5(repr(parts)).hexdigest()
+
+
+def get_high_water_mark(query, model):
+    """Returns (count, max(updated_at)) of the rows of `model` selected by `query`.
+    Any insert, update or delete moves at least one of them.
+    """
+    return tuple(query.with_entities(func.count(model.id), func.max(model.updated_at))
+                 .order_by(None).one())
+
+
+def conditional(get_etag):
+    """Answers GET requests with 304 Not Modified when the client's If-None-Match
+    matches get_etag(*args, **kwargs), which is called with the arguments of the view.
+    The view itself only runs when the ETag has changed.
+
+    Responses are marked no-cache so that browsers revalidate instead of guessing
+    how long the payload stays fresh.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            etag = get_etag(*args, **kwargs)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = f(*args, **kwargs)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return decorated
+    return decorator
@@ -0,0 +1,89 @@
+import re
+
+YADCF_RANGE_DELIMITER = '-yadcf_delim-'
+
+
+def _to_int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class DataTablesArgs(object):
+    """Parses the parameters sent by DataTables when serverSide is enabled.
+
+    See https://datatables.net/manual/server-side for the full protocol. YADCF
+    sends its filter values through columns[i][search][value].
+    """
+    ORDER_REGEX = re.compile(r'^order\[(\d+)\]\[(column|dir)\]$')
+    COLUMN_SEARCH_REGEX = re.compile(r'^columns\[(\d+)\]\[search\]\[value\]$')
+
+    def __init__(self, args, max_length=None):
+        self.draw = _to_int(args.get('draw'), 0)
+        self.start = max(_to_int(args.get('start'), 0), 0)
+
+        # -1 means "All" in the lengthMenu
+        self.length = _to_int(args.get('length'), 10)
+        if max_length and (self.length < 0 or self.length > max_length):
+            self.length = max_length
+
+        self.search = (args.get('search[value]') or '').strip()
+
+        orders = {}
+        column_searches = {}
+        for key in args.keys():
+            m = self.ORDER_REGEX.match(key)
+            if m:
+                orders.setdefault(int(m.group(1)), {})[m.group(2)] = args.get(key)
+                continue
+
+            m = self.COLUMN_SEARCH_REGEX.match(key)
+            if m and args.get(key):
+                column_searches[int(m.group(1))] = args.get(key)
+
+        # [(column_number, is_desc), ..] in the order of priority
+        self.orders = []
+        for i in sorted(orders):
+            column = _to_int(orders[i].get('column'), None)
+            if column is not None:
+                self.orders.append((column, orders[i].get('dir') == 'desc'))
+
+        # { column_number: raw_value }
+        self.column_searches = column_searches
+
+
+LIKE_ESCAPE = '\\'
+
+
+def escape_like(value):
+    """Escapes the wildcards of `value` for a LIKE with escape=LIKE_ESCAPE, so that
+    searching '10%' matches '10%' only.
+    """
+    for c in [LIKE_ESCAPE, '%', '_']:
+        value = value.replace(c, LIKE_ESCAPE + c)
+    return value
+
+
+def parse_select_values(value):
+    """Maps '^ACTIVE$|^SUSPENDED$' or 'ACTIVE|SUSPENDED' -> ['ACTIVE', 'SUSPENDED']
+    """
+    ret = []
+    for v in value.split('|'):
+        v = v.strip().lstrip('^').rstrip('$')
+        if v:
+            ret.append(v)
+    return ret
+
+
+def parse_range_values(value):
+    """Maps '10-yadcf_delim-20' -> (10.0, 20.0). Either end can be None.
+    """
+    def _to_float(v):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+
+    lo, _, hi = value.partition(YADCF_RANGE_DELIMITER)
+    return _to_float(lo), _to_float(hi)
@@ -0,0 +1,169 @@
+"""Computed attributes of model instances, cached under
+(model, primary key, attribute, version of the row).
+
+Each row of a model with cached attributes has a version, a random token kept in
+the shared cache. A flush which writes the row starts a new version, as does a
+flush writing a row it depends on (see add_dependency). Values cached under older
+versions are never read again and simply expire. Like the query cache, versions
+are started once more on commit so that values read by other workers between the
+flush and the commit do not survive it.
+
+Lookups are counted per process and added to the shared totals every
+STATS_FLUSH_INTERVAL lookups, see get_stats. The totals are only exact on redis,
+whose INCRBY is atomic. The simple and filesystem backends increment by reading
+and writing the value, so workers flushing at the same time lose counts.
+"""
+from functools import wraps
+from uuid import uuid4
+
+from portal.cache import cache
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+INFO_KEY = 'entity_cache_rows'
+
+STATS_FLUSH_INTERVAL = 100
+
+HITS = 'hits'
+MISSES = 'misses'
+
+
+def _get_pk(obj):
+    return '-'.join(str(v) for v in inspect(obj).mapper.primary_key_from_instance(obj))
+
+
+class EntityCache(object):
+
+    def __init__(self, prefix='entity'):
+        self.prefix = prefix
+        self.models = set()
+
+        # { table name: [(dependent model, get_dependent_ids(session, instances))] }
+        self.dependencies = {}
+
+        self._pending = {HITS: 0, MISSES: 0}
+
+    def _get_version_key(self, model_name, pk):
+        return '%s-version-%s-%s' % (self.prefix, model_name, pk)
+
+    def get_version(self, model_name, pk):
+        key = self._get_version_key(model_name, pk)
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid4().hex, timeout=0)
+            version = cache.get(key)
+        return version
+
+    def bump(self, model_name, pks):
+        """Starts a new version of the rows, invalidating their cached attributes.
+        """
+        if pks:
+            cache.set_many({self._get_version_key(model_name, pk): uuid4().hex
+                            for pk in pks}, timeout=0)
+
+    def register(self, model):
+        """Rows of `model` are versioned, call it for models with cached attributes.
+        """
+        self.models.add(model)
+
+    def get_or_compute(self, obj, name, compute):
+        if inspect(obj).identity is None:
+            # Not persisted yet
+            return compute()
+
+        model_name = type(obj).__name__
+        pk = _get_pk(obj)
+        key = '%s-%s-%s-%s-%s' % (self.prefix, model_name, pk, name,
+                                  self.get_version(model_name, pk))
+
+        # Wrapped so that None can be cached too
+        ret = cache.get(key)
+        if ret is not None:
+            self._count(HITS)
+            return ret[0]
+
+        self._count(MISSES)
+        value = compute()
+        cache.set(key, (value,))
+        return value
+
+    def attribute(self, f):
+        """Decorator for read-only properties of models, use it below @property.
+        """
+        name = f.__name__
+
+        @wraps(f)
+        def decorated(obj):
+            return self.get_or_compute(obj, name, lambda: f(obj))
+        return decorated
+
+    def add_dependency(self, table, model, get_ids):
+        """Cached attributes of `model` also depend on the rows of `table`.
+
+        get_ids(session, instances) returns the ids of the `model` rows related to
+        the flushed `instances` of `table`.
+        """
+        self.dependencies.setdefault(table, []).append((model, get_ids))
+
+    def _count(self, name):
+        self._pending[name] += 1
+        if sum(self._pending.itervalues()) >= STATS_FLUSH_INTERVAL:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Adds the lookups counted by this process to the shared totals. Atomic on
+        redis only, see the module docstring.
+        """
+        for name, count in self._pending.iteritems():
+            if count:
+                cache.cache.inc('%s-stats-%s' % (self.prefix, name), count)
+                self._pending[name] = 0
+
+    def get_stats(self):
+        """Returns {'hits': n, 'misses': n} of every process sharing the cache, which
+        may under-report unless the cache is redis.
+        """
+        self.flush_stats()
+        return {name: cache.get('%s-stats-%s' % (self.prefix, name)) or 0
+                for name in [HITS, MISSES]}
+
+    def get_changed_rows(self, session):
+        """Returns { model name: set of primary keys } of the rows written by the
+        flush, or related to them.
+        """
+        ret = {}
+        written = list(session.new | session.deleted)
+        written += [obj for obj in session.dirty if session.is_modified(obj)]
+
+        by_table = {}
+        for obj in written:
+            if type(obj) in self.models:
+                ret.setdefault(type(obj).__name__, set()).add(_get_pk(obj))
+            table = getattr(obj, '__tablename__', None)
+            if table in self.dependencies:
+                by_table.setdefault(table, []).append(obj)
+
+        for table, instances in by_table.iteritems():
+            for model, get_ids in self.dependencies[table]:
+                ret.setdefault(model.__name__, set()).update(
+                    str(pk) for pk in get_ids(session, instances))
+        return ret
+
+
+entity_cache = EntityCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def after_flush(session, flush_context):
+    rows = entity_cache.get_changed_rows(session)
+    if rows:
+        pending = session.info.setdefault(INFO_KEY, {})
+        for model_name, pks in rows.iteritems():
+            entity_cache.bump(model_name, pks)
+            pending.setdefault(model_name, set()).update(pks)
+
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session):
+    for model_name, pks in session.info.pop(INFO_KEY, {}).iteritems():
+        entity_cache.bump(model_name, pks)
@@ -0,0 +1,107 @@
+"""Query results cached under keys which include a generation of the tables read.
+
+Queries with the FromCache option are looked up under the md5 of their SQL plus
+the current generation of every table in TRACKED_TABLES. Any write to one of those
+tables through the session starts a new generation, after which the entries cached
+before it are never read again and simply expire. The generations live in the
+shared cache, hence a write seen by one worker invalidates the others too.
+
+A generation is a random token rather than a counter. Should the backend evict
+it, the next reader starts a new one instead of counting up into numbers which
+older entries were cached under.
+
+Core statements (session.execute, db.engine.execute) and psql are not seen, call
+invalidate for them.
+"""
+from uuid import uuid4
+
+from flask_sqlalchemy import BaseQuery
+from flask_sqlalchemy_cache import CachingQuery
+from portal.cache import cache
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Tables whose rows appear in cached queries, directly or eager loaded
+TRACKED_TABLES = ['accounts', 'vps', 'vendors', 'permissions', 'users']
+
+INFO_KEY = 'query_cache_tables'
+
+
+def _get_generation_key(table):
+    return 'query-generation-%s' % table
+
+
+def get_generations(tables=TRACKED_TABLES):
+    """Returns the current generations of `tables`, in the same order.
+    """
+    keys = [_get_generation_key(table) for table in tables]
+    ret = cache.get_many(*keys)
+    for i, generation in enumerate(ret):
+        if generation is None:
+            cache.add(keys[i], uuid4().hex, timeout=0)
+            ret[i] = cache.get(keys[i])
+    return ret
+
+
+def bump_generations(tables):
+    """Starts a new generation of `tables`, invalidating every cached query.
+    """
+    for table in set(tables) & set(TRACKED_TABLES):
+        cache.set(_get_generation_key(table), uuid4().hex, timeout=0)
+
+
+class VersionedCachingQuery(CachingQuery):
+    """The query class of db.session, FromCache has no effect without it.
+    """
+
+    def __iter__(self):
+        if not hasattr(self, '_cache') or self._yield_per:
+            # Streamed queries are not cached, they would have to be loaded whole
+            return BaseQuery.__iter__(self)
+
+        # Pending changes would otherwise only be flushed on a miss, after the key
+        # was computed with the generations they are about to bump
+        if self._autoflush and not self._populate_existing:
+            self.session._autoflush()
+        return super(VersionedCachingQuery, self).__iter__()
+
+    def _get_cache_plus_key(self):
+        cache, key = super(VersionedCachingQuery, self)._get_cache_plus_key()
+        return cache, '%s-%s' % (key, '-'.join(get_generations()))
+
+
+def invalidate(session, tables):
+    """Invalidates the queries of `tables` now and once more when `session` commits.
+    Another worker could otherwise cache the rows from before the commit under the
+    new generations in the meantime.
+    """
+    tables = set(tables) & set(TRACKED_TABLES)
+    if tables:
+        bump_generations(tables)
+        session.info.setdefault(INFO_KEY, set()).update(tables)
+
+
+def _get_tables(objs):
+    return set(obj.__table__.name for obj in objs if hasattr(obj, '__table__'))
+
+
+@event.listens_for(Session, 'after_flush')
+def after_flush(session, flush_context):
+    """Invalidates the queries of the tables written by the flush.
+    """
+    tables = _get_tables(session.new | session.deleted)
+    tables |= _get_tables(obj for obj in session.dirty if session.is_modified(obj))
+    invalidate(session, tables)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def after_bulk(context):
+    """Query.update() and Query.delete() do not flush.
+    """
+    invalidate(context.session, [context.primary_table.name])
+
+
+@event.listens_for(Session, 'after_commit')
+def after_commit(session):
+    bump_generations(session.info.pop(INFO_KEY, ()))
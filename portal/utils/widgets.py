@@ -1,20 +1,140 @@
+from datetime import datetime
+
+import pytz
+from flask_babelex import get_locale
 from flask_user import current_user
+from portal.cache import cache
+from portal.models import db
+
+
+def get_widget_classes():
+    """Returns { class name: class } of every imported Widget subclass.
+    """
+    ret = {}
+    stack = list(Widget.__subclasses__())
+    while stack:
+        cls = stack.pop()
+        ret[cls.__name__] = cls
+        stack.extend(cls.__subclasses__())
+    return ret
+
+
+def _merge(value):
+    """Attaches the models found in a cached result to the current session so that
+    their relationships can still be lazy loaded. Relationships the templates read
+    should be eager loaded by get_data instead, they are cached along.
+    """
+    if isinstance(value, db.Model):
+        return db.session.merge(value, load=False)
+    if isinstance(value, list):
+        return [_merge(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_merge(v) for v in value)
+    if isinstance(value, dict):
+        return value.__class__((k, _merge(v)) for k, v in value.iteritems())
+    return value
 
 
 class Widget(object):
     """Class to encapsulate logic for ACL and rendering
     """
+    # Seconds for which get_cached_data serves a result. None disables caching.
+    cache_timeout = None
+
+    # Set if get_data depends on the role of the user
+    cache_per_role = False
+
+    # Template rendering the widget on its own, see user.widget
+    template = None
+
+    def __init__(self, role=None):
+        self.role = role
+        self.as_of = None
+
     def get_roles(self):
         """Roles that have the permission to render this widget.
         """
         raise NotImplementedError
 
-    def is_accessible(self):
+    def get_name(self):
+        return self.__class__.__name__
+
+    def get_role(self):
+        if self.role:
+            return self.role
         assert len(current_user.roles) == 1, 'Only 1 role per user allowed'
-        role = current_user.roles[0].name
-        return role in [ role.value for role in self.get_roles() ]
+        return current_user.roles[0].name
+
+    def is_accessible(self):
+        return self.get_role() in [ role.value for role in self.get_roles() ]
 
     def get_data(self):
         """Returns the data needed to do the rendering
         """
         raise NotImplementedError
+
+    def get_variant(self):
+        """(class name, role, locale) which identifies a cached result.
+        """
+        role = self.get_role() if self.cache_per_role else None
+        return self.get_name(), role, str(get_locale())
+
+    @classmethod
+    def get_variants(cls, locales):
+        """Every variant of this widget, see get_variant.
+        """
+        roles = [role.value for role in cls().get_roles()] if cls.cache_per_role else [None]
+        return [(cls.__name__, role, locale) for role in roles for locale in locales]
+
+    def get_cache_key(self):
+        return 'widget-%s-%s-%s' % self.get_variant()
+
+    def refresh(self):
+        """Computes get_data and caches it. Returns (as_of, data).
+        """
+        entry = (datetime.now(pytz.utc), self.get_data())
+        cache.set(self.get_cache_key(), entry, timeout=self.cache_timeout)
+        return entry
+
+    def get_cached_data(self):
+        """Returns get_data from the cache, which `python manage.py widget_refresher`
+        keeps warm for every variant. It is only computed here when the refresher is
+        not running.
+
+        `as_of` is set to the time the result was computed.
+        """
+        if self.cache_timeout is None:
+            self.as_of = datetime.now(pytz.utc)
+            return self.get_data()
+
+        entry = cache.get(self.get_cache_key())
+        if entry is None:
+            entry = self.refresh()
+        self.as_of, data = entry
+        return _merge(data)
+
+
+def refresh_widgets(app):
+    """Computes the cached widgets of every role and WIDGET_LOCALES which are missing
+    or more than halfway through their cache_timeout, so that requests never have
+    to. Returns the number refreshed.
+    """
+    count = 0
+    for cls in get_widget_classes().itervalues():
+        if cls.cache_timeout is None:
+            continue
+
+        for class_name, role, locale in cls.get_variants(app.config['WIDGET_LOCALES']):
+            # The locale selector picks up ?lang=
+            with app.test_request_context(query_string={'lang': locale}):
+                widget = cls(role=role or cls().get_roles()[0].value)
+                entry = cache.get(widget.get_cache_key())
+                if entry is not None and (datetime.now(pytz.utc) - entry[0]) \
+                        .total_seconds() < cls.cache_timeout / 2.0:
+                    continue
+                try:
+                    widget.refresh()
+                    count += 1
+                finally:
+                    db.session.remove()
+    return count
@@ -1,14 +1,11 @@
 
-from collections import defaultdict
-
 from flask import Markup
 
-from portal.account.models import AccountStatus, association_table
+from portal.account.counters import DEAD, VPS, get_status_counts
+from portal.account.models import association_table
 from portal.models import TimeTrackedModel, db
 from portal.vps import generate_key, generate_secret
 
-DEAD = [AccountStatus.SUSPENDED, AccountStatus.ABANDONED]
-
 
 class Vps(TimeTrackedModel):
     __tablename__ = 'vps'
@@ -34,28 +31,40 @@ class Vps(TimeTrackedModel):
     def __str__(self):
         return self.name
 
+    def get_status_counts(self):
+        """{ status: count } of the accounts on this VPS, see portal.account.counters.
+        """
+        if '_status_counts' in self.__dict__:
+            return self._status_counts
+        return get_status_counts(VPS, [self.id]).get(self.id, {})
+
+    @classmethod
+    def set_status_counts(cls, vpses):
+        """Loads the status counts of all `vpses` in one query.
+        """
+        counts = get_status_counts(VPS, [vps.id for vps in vpses])
+        for vps in vpses:
+            vps._status_counts = counts.get(vps.id, {})
+
+    @property
+    def num_accounts(self):
+        return sum(self.get_status_counts().values())
+
     @property
     def alive_count(self):
         bad = 0
-        for account in self.accounts:
-            if account.status in DEAD:
-                bad += 1
-        return len(self.accounts) - bad
-
+        for status, count in self.get_status_counts().iteritems():
+            if status in DEAD:
+                bad += count
+        return self.num_accounts - bad
 
     def _render_markup_list_view(self, is_alive):
         """Returns Markup for List View.
         """
-        tele = defaultdict(int)
-        for account in self.accounts:
-            if is_alive and account.status not in DEAD:
-                tele[account.status.value] += 1
-            elif not is_alive and account.status in DEAD:
-                tele[account.status.value] += 1
-
         ret = ""
-        for status, count in tele.iteritems():
-            ret += '<div>%s (%s)</div>' % (status, count)
+        for status, count in self.get_status_counts().iteritems():
+            if is_alive != (status in DEAD):
+                ret += '<div>%s (%s)</div>' % (status.value, count)
         return Markup(ret)
 
     @property
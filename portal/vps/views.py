@@ -1,11 +1,13 @@
 from flask import Markup
 from flask_babelex import lazy_gettext
+from sqlalchemy import inspect
 from wtforms.fields import SelectField
 from wtforms.validators import required
 from wtforms_alchemy import Unique
 
 from portal.admin.utils import (AccessControlView, AuthorizationRequiredView,
                                                                 TimeTrackedModelView)
+from portal.cache import eve_credentials
 from portal.user import RolesEnum
 from portal.utils import ColumnMetaContainer
 from portal.utils.EnumRelated import EnumSQLAModelView
@@ -75,3 +77,23 @@ class VpsModelView(TimeTrackedModelView, EnumSQLAModelView, AuthorizationRequire
         if template.endswith('list.html'):
             kwargs['releasable_widget'] = ReleasableWidget()
         return super(VpsModelView, self).render(template, **kwargs)
+
+    def on_model_change(self, form, model, is_created):
+        """Remembers the old and new api_key if the credentials changed, their cached
+        Eve credentials are revoked by after_model_change.
+        """
+        state = inspect(model)
+        form.revoked_api_keys = []
+        if state.attrs.api_key.history.has_changes() or \
+                state.attrs.api_secret.history.has_changes():
+            form.revoked_api_keys = list(state.attrs.api_key.history.deleted) + [model.api_key]
+
+    def after_model_change(self, form, model, is_created):
+        """Once committed: revoked earlier, a concurrent request could cache the old
+        credentials again before the commit.
+        """
+        for api_key in form.revoked_api_keys:
+            eve_credentials.invalidate(api_key)
+
+    def after_model_delete(self, model):
+        eve_credentials.invalidate(model.api_key)
@@ -13,10 +13,11 @@ class ReleasableWidget(Widget):
     def get_data(self):
         vpses = {}
 
-        for vps in Vps.query.filter(Vps.is_deleted==False):
+        candidates = Vps.query.filter(Vps.is_deleted==False).all()
+        Vps.set_status_counts(candidates)
+        for vps in candidates:
             # Not new and no more alive
-            if len(vps.accounts) > 0 and vps.alive_count == 0:
-                for account in vps.accounts:
-                    vpses[vps.id] = vps
+            if vps.num_accounts > 0 and vps.alive_count == 0:
+                vpses[vps.id] = vps
 
         return vpses
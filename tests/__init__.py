@@ -6,9 +6,11 @@ from portal.models import db
 
 
 class BaseTestCase(unittest.TestCase):
+    # A subclass of TestingConfig overriding the settings a test needs
+    config = TestingConfig
 
     def setUp(self):
-        self.app = create_app(TestingConfig)
+        self.app = create_app(self.config)
         self.app_context = self.app.app_context()
         self.client = self.app.test_client()
         self.db = db
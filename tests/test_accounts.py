@@ -1,12 +1,17 @@
+import json
+import re
 import unittest
 from collections import namedtuple
+from io import BytesIO
 
+import openpyxl
 from flask import current_app, url_for
 from flask_login import current_user, login_user
 from flask_user import signals
 from flask_user.views import _do_login_user, logout_user
+from portal.access.models import Access
 from portal.account.models import AttributeManagerSingleton as AMS
-from portal.account.models import Account
+from portal.account.models import Account, AccountStatus, AccountStatusHelper
 from portal.config import Core
 from portal.factory import create_app
 from portal.models import db
@@ -14,6 +19,9 @@ from portal.permission.models import Permission
 from portal.user import RolesEnum
 from portal.user.models import find_or_create_role, find_or_create_user
 from portal.vendor.models import Vendor
+from portal.vps.models import Vps
+from sqlalchemy import event
+from sqlalchemy_continuum import version_class
 
 
 class CustomConfig(Core):
@@ -352,6 +360,444 @@ class VendorUserPermissionTest(AccountViewsTest):
         assert 'Record was successfully saved.' in rv.data
 
 
+class ServerSideListTest(AccountViewsTest):
+    """Tests index_view_rows which serves DataTables page by page.
+    """
+    def setUp(self):
+        super(ServerSideListTest, self).setUp()
+        self.app.config['ACCOUNT_LIST_SERVER_SIDE'] = True
+
+    def _get_rows(self, role, **kwargs):
+        r = self.client.get(url_for('%s_account.index_view_rows' % role, **kwargs))
+        return json.loads(r.data)
+
+    def test_index_view_skips_rows(self):
+        self.login(ud_admin)
+        r = self.client.get(url_for('support_account.index_view'))
+        assert ad_1.nickname not in r.data
+
+    def test_paging(self):
+        self.login(ud_admin)
+        ret = self._get_rows(RolesEnum.SUPPORT.value, draw=3, start=0, length=1)
+        assert ret['draw'] == 3
+        assert ret['recordsTotal'] == 2
+        assert ret['recordsFiltered'] == 2
+        assert len(ret['data']) == 1
+
+    def test_search(self):
+        self.login(ud_admin)
+        ret = self._get_rows(RolesEnum.SUPPORT.value, **{'search[value]': ad_2.nickname})
+        assert ret['recordsFiltered'] == 1
+        assert ad_2.adwords_id in ret['data'][0]['adwords_id']
+
+    def test_search_escapes_wildcards(self):
+        self.account_1.nickname = '100%_off'
+        db.session.commit()
+        self.login(ud_admin)
+        ret = self._get_rows(RolesEnum.SUPPORT.value, **{'search[value]': '0%_'})
+        assert ret['recordsFiltered'] == 1
+        ret = self._get_rows(RolesEnum.SUPPORT.value, **{'search[value]': 'nick_'})
+        assert ret['recordsFiltered'] == 0
+
+    def _get_sorted_adwords_ids(self, role, key):
+        view = self.app.view_functions['%s_account.index_view' % role].__self__
+        with self.app.test_request_context():
+            login_user(self.admin)
+            column = [k for k, label in view.get_dt_columns(True)].index(key)
+        ret = self._get_rows(role, **{'order[0][column]': column, 'order[0][dir]': 'asc'})
+        return [re.search('[0-9]{3}-[0-9]{3}-[0-9]{4}', row['adwords_id']).group(0)
+                for row in ret['data']]
+
+    def test_sort_by_displayed_values(self):
+        self.account_1.account_budget = 100
+        self.account_1.remaining_account_budget = 50
+        self.account_1.remaining_account_budget_override = 90
+        self.account_1.daily_budget = 10
+        self.account_1.exchange_rate = 1
+        self.account_2.account_budget = 100
+        self.account_2.remaining_account_budget = 80
+        self.account_2.daily_budget = 10
+        self.account_2.exchange_rate = 1
+        self.account_1.vendor = Vendor(nickname='V1', company_name='A', contact_name='C',
+                                       payments_profile_id='9999-0001')
+        self.account_2.vendor = Vendor(nickname='V2', company_name='B', contact_name='C',
+                                       payments_profile_id='1111-0002')
+        db.session.commit()
+        self.login(ud_admin)
+
+        role = RolesEnum.ADMIN.value
+        assert self.account_1.spent == 10 and self.account_2.spent == 20
+        assert self._get_sorted_adwords_ids(role, 'spent') == [ad_1.adwords_id, ad_2.adwords_id]
+        assert self._get_sorted_adwords_ids(role, 'percentage_spent') == \
+            [ad_1.adwords_id, ad_2.adwords_id]
+        assert self._get_sorted_adwords_ids(role, 'remaining_in_hkd') == \
+            [ad_2.adwords_id, ad_1.adwords_id]
+        # '1111 B' < '9999 A'
+        assert self._get_sorted_adwords_ids(role, 'vendor') == [ad_2.adwords_id, ad_1.adwords_id]
+
+        assert self.account_1.days_left == 9 and self.account_2.days_left == 8
+        assert self._get_sorted_adwords_ids(role, 'days_left') == \
+            [ad_2.adwords_id, ad_1.adwords_id]
+        self.account_2.daily_budget = 0
+        db.session.commit()
+        assert self.account_2.days_left == 99
+        assert self._get_sorted_adwords_ids(role, 'days_left') == \
+            [ad_1.adwords_id, ad_2.adwords_id]
+
+    def test_client_is_jailed(self):
+        self.login(ud_client1)
+        ret = self._get_rows(RolesEnum.CLIENT.value)
+        assert ret['recordsTotal'] == 1
+        assert ad_1.adwords_id in ret['data'][0]['adwords_id']
+        for column in set(ret['data'][0]) - set(['DT_RowAttr', 'row_actions']):
+            assert column in AMS.get_list_view_columns(RolesEnum.CLIENT.value)
+
+    def test_index_view_data_etag(self):
+        self.login(ud_admin)
+        endpoint = 'support_account.index_view_data'
+        r = self.client.get(url_for(endpoint))
+        assert r.status_code == 200
+        etag = r.headers['ETag']
+
+        r = self.client.get(url_for(endpoint), headers={'If-None-Match': etag})
+        assert r.status_code == 304
+        assert r.data == ''
+
+        # A new vendor shows up in the vendor filter
+        db.session.add(Vendor(nickname='V2', company_name='V2', contact_name='V2'))
+        db.session.commit()
+        r = self.client.get(url_for(endpoint), headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert r.headers['ETag'] != etag
+
+    def test_index_view_data_etag_client_side(self):
+        self.app.config['ACCOUNT_LIST_SERVER_SIDE'] = False
+        self.login(ud_admin)
+        endpoint = 'support_account.index_view_data'
+        etag = self.client.get(url_for(endpoint)).headers['ETag']
+        r = self.client.get(url_for(endpoint), headers={'If-None-Match': etag})
+        assert r.status_code == 304
+
+        # As after a deploy changing the column settings
+        support = self.app.view_functions[endpoint].__self__
+        support.get_column_defs = lambda: []
+        try:
+            r = self.client.get(url_for(endpoint), headers={'If-None-Match': etag})
+        finally:
+            del support.get_column_defs
+        assert r.status_code == 200
+        assert json.loads(r.data)['columnDefs'] == []
+
+
+class ExportTest(AccountViewsTest):
+    """Tests the streaming export of the account list views.
+    """
+    def _export(self, role, export_type, **kwargs):
+        r = self.client.get(url_for('%s_account.export' % role, export_type=export_type,
+                                    **kwargs))
+        assert r.status_code == 200
+        assert 'attachment' in r.headers['Content-Disposition']
+        return r.data
+
+    def _export_jsonl(self, role, **kwargs):
+        data = self._export(role, 'jsonl', **kwargs)
+        return [json.loads(line) for line in data.splitlines()]
+
+    def test_csv(self):
+        self.login(ud_admin)
+        lines = self._export(RolesEnum.SUPPORT.value, 'csv').splitlines()
+        assert len(lines) == 3
+        labels = AMS.get_list_view_column_labels(RolesEnum.SUPPORT.value)
+        assert labels['adwords_id'] in lines[0].decode('utf-8')
+        assert ad_1.adwords_id in lines[1] + lines[2]
+
+    def test_xlsx(self):
+        self.login(ud_admin)
+        data = self._export(RolesEnum.SUPPORT.value, 'xlsx')
+        rows = list(openpyxl.load_workbook(BytesIO(data)).active.iter_rows())
+        assert len(rows) == 3
+
+    def test_filters_and_sorting(self):
+        self.app.config['ACCOUNT_LIST_SERVER_SIDE'] = True
+        self.login(ud_admin)
+        rows = self._export_jsonl(RolesEnum.SUPPORT.value, **{'search[value]': ad_2.nickname})
+        assert [row['adwords_id'] for row in rows] == [ad_2.adwords_id]
+
+        # Sorted by adwords_id, see get_dt_columns
+        support = self.app.view_functions['support_account.index_view'].__self__
+        with self.app.test_request_context():
+            login_user(self.admin)
+            column = [key for key, label in support.get_dt_columns(True)].index('adwords_id')
+        rows = self._export_jsonl(RolesEnum.SUPPORT.value, **{
+            'order[0][column]': column, 'order[0][dir]': 'desc'})
+        assert [row['adwords_id'] for row in rows] == [ad_2.adwords_id, ad_1.adwords_id]
+
+    def test_filters_refused_client_side(self):
+        self.login(ud_admin)
+        r = self.client.get(url_for('support_account.export', export_type='jsonl',
+                                    **{'search[value]': ad_2.nickname}))
+        assert r.status_code == 302
+
+        # Unfiltered exports are still served
+        rows = self._export_jsonl(RolesEnum.SUPPORT.value)
+        assert len(rows) == 2
+
+    def test_clients_cannot_export(self):
+        self.login(ud_client1)
+        r = self.client.get(url_for('client_account.export', export_type='jsonl'))
+        assert r.status_code == 302
+
+    def test_vpses_are_loaded_per_batch(self):
+        self.app.config['ACCOUNT_EXPORT_BATCH_SIZE'] = 1
+        for i, account in enumerate([self.account_1, self.account_2]):
+            account.VPSs.append(Vps(name='VU-00%d' % i, provider='Vultr', country='Tokyo',
+                                    login='login', password='password'))
+        db.session.commit()
+        db.session.expire_all()
+
+        self.login(ud_admin)
+        rows = self._export_jsonl(RolesEnum.ADMIN.value)
+        assert sorted(row['VPSs'] for row in rows) == ['VU-000', 'VU-001']
+
+    def test_unknown_type(self):
+        self.login(ud_admin)
+        r = self.client.get(url_for('support_account.export', export_type='xls'))
+        assert r.status_code == 302
+
+
+class HistoryTest(AccountViewsTest):
+    """Tests the paginated change history of details_view.
+    """
+    def _add_history(self, n):
+        for i in xrange(n):
+            self.account_1.nickname = 'nickname_1_%d' % i
+            db.session.add(Access(user_id=self.admin.id, account_id=self.account_1.id))
+            db.session.commit()
+
+    def _count_details_view_queries(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            r = self.client.get(url_for('admin_account.details_view', id=self.account_1.id))
+            assert r.status_code == 200
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return len(statements)
+
+    def test_queries_do_not_grow_with_history(self):
+        self.app.config['ACCOUNT_HISTORY_PAGE_SIZE'] = 5
+        self.login(ud_admin)
+        self._add_history(1)
+        count = self._count_details_view_queries()
+
+        self._add_history(10)
+        assert self._count_details_view_queries() == count
+
+    def test_pages(self):
+        self.app.config['ACCOUNT_HISTORY_PAGE_SIZE'] = 3
+        self._add_history(4)
+        self.login(ud_admin)
+
+        r = self.client.get(url_for('admin_account.details_view', id=self.account_1.id))
+        assert 'nickname_1_3' in r.data
+        assert 'nickname_1_0' not in r.data
+
+        # The first version, 4 updates and 4 accesses
+        rows = r.data.count('<tr>') - len(AMS.get_list_view_columns(RolesEnum.ADMIN.value))
+        assert rows == 3
+        url = re.search('data-url="([^"]+)"', r.data).group(1).replace('&amp;', '&')
+
+        html = ''
+        while url:
+            data = json.loads(self.client.get(url).data)
+            html += data['html']
+            url = data['next_url']
+        assert html.count('<tr>') == 6
+        assert html.index('&rarr; nickname_1_1') < html.index('&rarr; nickname_1_0') < \
+            html.index('nickname: None &rarr; nickname_1')
+
+    def test_client_is_jailed(self):
+        self.login(ud_client1)
+        r = self.client.get(url_for('client_account.history_view', id=self.account_1.id))
+        assert r.status_code == 200
+        r = self.client.get(url_for('client_account.history_view', id=self.account_2.id))
+        assert r.status_code == 404
+
+
+class HandsonBatchTest(AccountViewsTest):
+    """Tests the batch creation of accounts through handson table.
+    """
+    def setUp(self):
+        super(HandsonBatchTest, self).setUp()
+        db.session.add(Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact'))
+        db.session.add(Vps(name='VU-001', provider='Vultr', country='Tokyo',
+                           login='login', password='password'))
+        db.session.commit()
+
+    def submit(self, adwords_ids):
+        setup = json.loads(self.client.get(url_for('admin_account.return_setup_data')).data)
+        columns = dict((name.rstrip(' *'), i) for i, name in enumerate(setup['column_names']))
+        values = {
+            'Status': setup['column_properties'][columns['Status']]['source'][0],
+            'Vendor': 'Vendor 1',
+            'VPS': 'VU-001',
+            'Login': 'login',
+            'Password': 'password',
+        }
+
+        rows = []
+        for adwords_id in adwords_ids:
+            row = [None] * len(columns)
+            for name, value in dict(values, Adwords_id=adwords_id).iteritems():
+                row[columns[name]] = value
+            rows.append(row)
+        # Empty rows are skipped
+        rows.append([None] * len(columns))
+
+        r = self.client.post(url_for('admin_account.submit'), data={'rows': json.dumps(rows)})
+        return json.loads(r.data)
+
+    def test_single_transaction(self):
+        self.login(ud_admin)
+        ret = self.submit(['123-456-0001', '123-456-0002', '123-456-0003'])
+        assert ret['success']
+        assert ret['accounts_added'] == 3
+
+        AccountVersion = version_class(Account)
+        versions = AccountVersion.query.filter(
+            AccountVersion.adwords_id.in_(['123-456-0001', '123-456-0002', '123-456-0003']))
+        assert len(set(v.transaction_id for v in versions)) == 1
+        assert [vps.name for vps in Account.query.filter_by(adwords_id='123-456-0003').one().VPSs] \
+            == ['VU-001']
+
+    def test_choices_are_queried_once(self):
+        self.login(ud_admin)
+
+        def _count_vendor_queries(adwords_ids):
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                assert self.submit(adwords_ids)['success']
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', listener)
+            return len([s for s in statements if 'FROM vendors' in s])
+
+        assert _count_vendor_queries(['123-456-0001']) == \
+            _count_vendor_queries(['123-456-0002', '123-456-0003', '123-456-0004'])
+
+    def test_atomic(self):
+        self.login(ud_admin)
+        # Passes validation row by row but not the unique constraint
+        ret = self.submit(['123-456-0001', '123-456-0001'])
+        assert not ret['success']
+        assert ret['message']
+        assert Account.query.filter_by(adwords_id='123-456-0001').count() == 0
+
+        ret = self.submit(['123-456-0001', ad_1.adwords_id])
+        assert not ret['success']
+        assert ret['errors'].keys() == ['2']
+        assert Account.query.filter_by(adwords_id='123-456-0001').count() == 0
+
+    def import_file(self, filename, content):
+        r = self.client.post(url_for('admin_account.import_file'),
+                             data={'file': (BytesIO(content), filename)})
+        if r.status_code != 200:
+            return r.status_code, json.loads(r.data)
+        return r.status_code, [json.loads(line) for line in r.data.splitlines()]
+
+    def test_import_csv(self):
+        self.login(ud_admin)
+        self.app.config['ACCOUNT_IMPORT_CHUNK_SIZE'] = 2
+
+        content = u'\n'.join([
+            # Labels as in handson table, in any order and case
+            u'adwords_id,Status *,vendor,VPS,Login,Password,',
+            u'123-456-0001,{status},Vendor 1,VU-001,login,password,',
+            u'123-456-000X,{status},Vendor 1,VU-001,login,password,',
+            u'123-456-0002,{status},Vendor 1,VU-001,login,password,',
+            u'123-456-0003,{status},Vendor 1,VU-001,login,password,',
+            u',,,,,,',
+            # Only fails on commit
+            u'123-456-0003,{status},Vendor 1,VU-001,login,password,',
+        ]).format(status=AccountStatusHelper.translate(AccountStatus.ACTIVE))
+
+        status_code, progress = self.import_file('accounts.csv', content.encode('utf-8'))
+        assert status_code == 200
+        assert progress[0]['row'] == 3 and progress[0]['errors']
+        assert progress[1] == {'row': 4, 'accounts_added': 2}
+        assert progress[2]['row'] == 7 and progress[2]['errors']
+        assert progress[3] == {'row': 7, 'accounts_added': 3}
+        assert progress[4] == {'accounts_added': 3, 'done': True}
+        assert Account.query.filter(Account.adwords_id.in_(
+            ['123-456-0001', '123-456-0002', '123-456-0003'])).count() == 3
+
+    def test_import_choices_survive_commits(self):
+        self.login(ud_admin)
+        self.app.config['ACCOUNT_IMPORT_CHUNK_SIZE'] = 1
+
+        def _count_choice_queries(adwords_ids):
+            content = u'\n'.join(
+                [u'adwords_id,Status *,vendor,VPS,Login,Password'] +
+                [u'%s,%s,Vendor 1,VU-001,login,password' % (
+                    adwords_id, AccountStatusHelper.translate(AccountStatus.ACTIVE))
+                 for adwords_id in adwords_ids])
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            event.listen(db.engine, 'before_cursor_execute', listener)
+            try:
+                status_code, progress = self.import_file('accounts.csv', content.encode('utf-8'))
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', listener)
+            assert progress[-1] == {'accounts_added': len(adwords_ids), 'done': True}
+            return len([s for s in statements if 'FROM vendors' in s or 'FROM vps' in s])
+
+        # Not loaded again after each chunk's commit
+        assert _count_choice_queries(['123-456-0001']) == \
+            _count_choice_queries(['123-456-0002', '123-456-0003', '123-456-0004'])
+
+    def test_import_xlsx(self):
+        self.login(ud_admin)
+
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        sheet.append(['Adwords_id *', 'Status *', 'Vendor *', 'VPS *', 'Login *',
+                      'Password *', 'Account Budget'])
+        sheet.append(['123-456-0001', AccountStatusHelper.translate(AccountStatus.ACTIVE),
+                      'Vendor 1', 'VU-001', 'login', 'password', 100])
+        f = BytesIO()
+        workbook.save(f)
+
+        status_code, progress = self.import_file('accounts.xlsx', f.getvalue())
+        assert progress == [{'row': 2, 'accounts_added': 1},
+                            {'accounts_added': 1, 'done': True}]
+        assert Account.query.filter_by(adwords_id='123-456-0001').one().account_budget == 100
+
+    def test_import_bad_file(self):
+        self.login(ud_admin)
+        assert self.import_file('accounts.txt', 'a,b')[0] == 400
+        assert self.import_file('accounts.xlsx', 'a,b')[0] == 400
+        status_code, ret = self.import_file('accounts.csv', 'adwords_id,nope\n')
+        assert status_code == 400
+        assert 'nope' in ret['error']
+
+        status_code, ret = self.import_file('accounts.csv',
+                                            u'adwords_id,\u72c0\u614b\n'.encode('utf-8'))
+        assert status_code == 400
+        assert u'\u72c0\u614b' in ret['error']
+
+    def test_import_stops_with_an_error_line(self):
+        self.login(ud_admin)
+        content = u'\n'.join([
+            u'adwords_id,Status,vendor,VPS,Login,Password',
+            u'123-456-0001,{status},Vendor 1,VU-001,login,password',
+        ]).format(status=AccountStatusHelper.translate(AccountStatus.ACTIVE)).encode('utf-8')
+
+        # Not UTF-8
+        status_code, progress = self.import_file('accounts.csv', content + '\n\xff\xfe,x\n')
+        assert status_code == 200
+        assert 'error' in progress[-1]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+import unittest
+from datetime import date
+
+from flask import url_for
+from portal.account.models import Account
+from portal.bank_account.models import BankAccount
+from portal.config import TestingConfig
+from portal.models import db
+from portal.transfer.models import Transfer
+from portal.user import RolesEnum
+from portal.user.models import find_or_create_role, find_or_create_user
+from portal.vendor.models import Vendor
+from sqlalchemy import event
+from tests import BaseTestCase
+
+
+class CustomConfig(TestingConfig):
+    LOGIN_DISABLED = False
+
+
+class BankAccountRollupTest(BaseTestCase):
+    config = CustomConfig
+
+    def setUp(self):
+        super(BankAccountRollupTest, self).setUp()
+
+        admin = find_or_create_user('admin', 'admin', 'admin')
+        admin.roles.append(find_or_create_role(RolesEnum.ADMIN.value))
+
+        self.b1 = BankAccount(name='B1', details='details')
+        self.b2 = BankAccount(name='B2', details='details')
+        v1 = Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact',
+                    bank_account=self.b1)
+        v2 = Vendor(nickname='V2', company_name='Vendor 2', contact_name='Contact',
+                    bank_account=self.b1)
+        db.session.add_all([
+            Transfer(bank_account=self.b1, gross=110, net=100, exchange_rate=7.8,
+                     date=date.today()),
+            # Not counted without net
+            Transfer(bank_account=self.b1, gross=10, exchange_rate=7.8, date=date.today()),
+            Account(adwords_id='123-456-0001', vendor=v1, account_budget=100,
+                    remaining_account_budget=40, exchange_rate=2),
+            Account(adwords_id='123-456-0002', vendor=v2, account_budget=100,
+                    remaining_account_budget=40, remaining_account_budget_override=30,
+                    exchange_rate=1),
+            # Spent nothing and nothing remaining because the exchange rate is missing
+            Account(adwords_id='123-456-0003', vendor=v2, account_budget=100,
+                    remaining_account_budget=40),
+            self.b2,
+        ])
+        db.session.commit()
+
+    def test_rollups(self):
+        assert BankAccount.get_rollups([self.b1.id, self.b2.id]) == {
+            self.b1.id: (2, 780, 190, 110),
+            self.b2.id: (0, 0, 0, 0),
+        }
+
+        assert self.b1.total_sent_in_hkd == 780
+        assert self.b1.total_spent_in_hkd == 190
+        assert self.b1.total_remaining_in_hkd == 110
+        assert self.b1.total_outstanding_in_hkd == 480
+        assert self.b2.total_outstanding_in_hkd == 0
+
+    def _count_list_view_queries(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            r = self.client.get(url_for('bank_account.index_view'))
+            assert r.status_code == 200
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return len(statements)
+
+    def test_list_view(self):
+        self.client.post(url_for('user.login'), data=dict(username='admin', password='admin'))
+        count = self._count_list_view_queries()
+
+        db.session.add_all([BankAccount(name='X%d' % i, details='details') for i in xrange(5)])
+        db.session.commit()
+
+        # Only the vendors column is still loaded per row, the totals are not
+        assert self._count_list_view_queries() <= count + 5
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import shutil
+import tempfile
+import unittest
+
+from portal.account.models import Account
+from portal.cache import SharedFileSystemCache, cache
+from portal.config import TestingConfig
+from portal.factory import create_app
+from portal.models import db
+from portal.utils.entity_cache import entity_cache
+from tests import BaseTestCase
+
+
+class CustomConfig(TestingConfig):
+    CACHE_TYPE = 'filesystem'
+
+
+class SharedCacheTest(BaseTestCase):
+    """Two apps stand in for two gunicorn workers.
+    """
+    config = CustomConfig
+
+    def setUp(self):
+        self.config.CACHE_DIR = tempfile.mkdtemp()
+        super(SharedCacheTest, self).setUp()
+        self.app1 = self.app
+        self.app2 = create_app(self.config)
+
+    def tearDown(self):
+        super(SharedCacheTest, self).tearDown()
+        shutil.rmtree(self.config.CACHE_DIR)
+
+    def test_backend(self):
+        with self.app1.app_context():
+            assert isinstance(cache.cache, SharedFileSystemCache)
+
+    def test_shared(self):
+        with self.app1.app_context():
+            cache.set('key', {'a': 1})
+
+        with self.app2.app_context():
+            assert cache.get('key') == {'a': 1}
+            cache.delete('key')
+
+        with self.app1.app_context():
+            assert cache.get('key') is None
+
+    def test_entity_cache(self):
+        with self.app1.app_context():
+            account = Account(adwords_id='123-456-0001')
+            db.session.add(account)
+            db.session.commit()
+            account_id = account.id
+            created_at = account.created_at
+
+        with self.app2.app_context():
+            # Computed by app1
+            hits = entity_cache.get_stats()['hits']
+            assert Account.query.get(account_id).created_at == created_at
+            assert entity_cache.get_stats()['hits'] == hits + 1
+
+    def test_redis_requires_url(self):
+        class RedisConfig(CustomConfig):
+            CACHE_TYPE = 'redis'
+            CACHE_REDIS_URL = None
+
+        self.assertRaises(ValueError, create_app, RedisConfig)
+
+    def test_prune_interval(self):
+        with self.app1.app_context():
+            backend = cache.cache
+            backend._threshold = 1
+            for i in xrange(3):
+                cache.set('key%d' % i, i)
+            # Not pruned until prune_interval has passed
+            assert all(cache.get('key%d' % i) == i for i in xrange(3))
+
+            backend._pruned_at -= backend.prune_interval
+            cache.set('key3', 3)
+            assert len([i for i in xrange(4) if cache.get('key%d' % i) is not None]) < 4
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+
+from portal.account.counters import (VENDOR, VPS, AccountStatusCount, get_status_counts,
+                                     reconcile)
+from portal.account.models import Account, AccountStatus
+from portal.models import db
+from portal.vendor.models import Vendor
+from portal.vps.models import Vps
+from portal.vps.widgets import ReleasableWidget
+from tests import BaseTestCase
+
+ACTIVE = AccountStatus.ACTIVE
+SUSPENDED = AccountStatus.SUSPENDED
+
+
+class AccountStatusCountTest(BaseTestCase):
+
+    def setUp(self):
+        super(AccountStatusCountTest, self).setUp()
+
+        self.v1 = Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact')
+        self.v2 = Vendor(nickname='V2', company_name='Vendor 2', contact_name='Contact')
+        self.vps1 = Vps(name='VU-001', provider='Vultr', country='Tokyo',
+                        login='login', password='password')
+        self.vps2 = Vps(name='VU-002', provider='Vultr', country='Tokyo',
+                        login='login', password='password')
+        self.act1 = Account(adwords_id='123-456-0001', status=ACTIVE, vendor=self.v1,
+                            VPSs=[self.vps1])
+        self.act2 = Account(adwords_id='123-456-0002', status=ACTIVE, vendor=self.v1,
+                            VPSs=[self.vps1, self.vps2])
+        db.session.add_all([self.act1, self.act2, self.v2])
+        db.session.commit()
+
+    def counts(self, owner_type, owner):
+        return dict(get_status_counts(owner_type, [owner.id]).get(owner.id, {}))
+
+    def test_insert(self):
+        assert self.counts(VENDOR, self.v1) == {ACTIVE: 2}
+        assert self.counts(VENDOR, self.v2) == {}
+        assert self.counts(VPS, self.vps1) == {ACTIVE: 2}
+        assert self.counts(VPS, self.vps2) == {ACTIVE: 1}
+        assert self.v1.num_accounts_total == 2
+        assert self.vps2.alive_count == 1
+
+    def test_status(self):
+        self.act2.status = SUSPENDED
+        db.session.commit()
+        assert self.counts(VENDOR, self.v1) == {ACTIVE: 1, SUSPENDED: 1}
+        assert self.counts(VPS, self.vps1) == {ACTIVE: 1, SUSPENDED: 1}
+        assert self.counts(VPS, self.vps2) == {SUSPENDED: 1}
+        assert self.vps2.alive_count == 0
+        assert '%s (1)' % SUSPENDED.value in self.vps2.dead_accounts
+
+        # Heartbeats do not recount
+        self.act1.nickname = 'nick'
+        db.session.commit()
+        assert self.counts(VENDOR, self.v1) == {ACTIVE: 1, SUSPENDED: 1}
+
+    def test_vendor(self):
+        db.session.expire_all()
+        self.act1.vendor = self.v2
+        db.session.commit()
+        assert self.counts(VENDOR, self.v1) == {ACTIVE: 1}
+        assert self.counts(VENDOR, self.v2) == {ACTIVE: 1}
+
+        self.v2.accounts.remove(self.act1)
+        db.session.commit()
+        assert self.counts(VENDOR, self.v2) == {}
+
+    def test_vpses(self):
+        self.act1.VPSs.remove(self.vps1)
+        db.session.commit()
+        assert self.counts(VPS, self.vps1) == {ACTIVE: 1}
+
+        # From the VPS side
+        db.session.expire_all()
+        self.vps2.accounts.append(self.act1)
+        db.session.commit()
+        assert self.counts(VPS, self.vps2) == {ACTIVE: 2}
+
+    def test_delete(self):
+        db.session.delete(self.act2)
+        db.session.commit()
+        assert self.counts(VENDOR, self.v1) == {ACTIVE: 1}
+        assert self.counts(VPS, self.vps2) == {}
+
+        db.session.delete(self.vps1)
+        db.session.commit()
+        assert get_status_counts(VPS, [self.vps1.id]) == {}
+
+    def test_changes_are_added(self):
+        # As if another transaction had added accounts in the meantime
+        AccountStatusCount.query.filter_by(owner_type=VENDOR, owner_id=self.v1.id,
+                                           status=ACTIVE).update({'count': 7})
+        db.session.commit()
+
+        self.act1.status = SUSPENDED
+        db.session.commit()
+        assert self.counts(VENDOR, self.v1) == {ACTIVE: 6, SUSPENDED: 1}
+
+    def test_reconcile(self):
+        assert reconcile() == []
+
+        # Not seen by the session events
+        Account.query.filter(Account.id == self.act1.id).update(
+            {'status': SUSPENDED}, synchronize_session=False)
+        db.session.commit()
+        assert self.counts(VENDOR, self.v1) == {ACTIVE: 2}
+
+        drift = reconcile()
+        assert (VENDOR, self.v1.id, ACTIVE, 2, 1) in drift
+        assert (VENDOR, self.v1.id, SUSPENDED, 0, 1) in drift
+        assert len(drift) == 4
+        assert self.counts(VENDOR, self.v1) == {ACTIVE: 1, SUSPENDED: 1}
+        assert reconcile() == []
+
+    def test_releasable_widget(self):
+        assert ReleasableWidget().get_data() == {}
+
+        self.act2.status = SUSPENDED
+        db.session.commit()
+        assert ReleasableWidget().get_data() == {self.vps2.id: self.vps2}
+
+
+if __name__ == '__main__':
+    unittest.main()
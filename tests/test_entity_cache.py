@@ -0,0 +1,88 @@
+import unittest
+
+from portal.account.models import Account, AccountStatus
+from portal.cache import cache
+from portal.models import db
+from portal.utils.entity_cache import entity_cache
+from portal.vendor.models import Vendor
+from portal.vps.models import Vps
+from sqlalchemy import event
+from tests import BaseTestCase
+
+
+class EntityCacheTest(BaseTestCase):
+
+    def setUp(self):
+        super(EntityCacheTest, self).setUp()
+        cache.clear()
+
+        self.vendor = Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact',
+                             days_to_topup=3)
+        self.vps = Vps(name='VU-001', provider='Vultr', country='Tokyo',
+                       login='login', password='password')
+        db.session.add(Account(adwords_id='123-456-0001', vendor=self.vendor,
+                               VPSs=[self.vps]))
+        db.session.commit()
+        self.account_id = Account.query.one().id
+
+    def read(self, name):
+        """Returns (value, number of statements executed) with a fresh session.
+        """
+        db.session.remove()
+        account = Account.query.get(self.account_id)
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            value = getattr(account, name)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return value, len(statements)
+
+    def test_cached(self):
+        stats = entity_cache.get_stats()
+        assert self.read('days_to_topup') == (3, 1)
+        assert self.read('days_to_topup') == (3, 0)
+
+        # None is cached too
+        assert self.read('suspended_on')[0] is None
+        assert self.read('suspended_on') == (None, 0)
+
+        after = entity_cache.get_stats()
+        assert after['hits'] - stats['hits'] == 2
+        assert after['misses'] - stats['misses'] == 2
+
+    def test_row(self):
+        self.read('suspended_on')
+        account = Account.query.get(self.account_id)
+        account.status = AccountStatus.SUSPENDED
+        db.session.commit()
+        assert self.read('suspended_on')[0] is not None
+
+    def test_vendor(self):
+        self.read('days_to_topup')
+        Vendor.query.one().days_to_topup = 5
+        db.session.commit()
+        assert self.read('days_to_topup')[0] == 5
+
+    def test_vps(self):
+        assert self.read('VPSs_jinja')[0] == 'VU-001'
+        Vps.query.one().name = 'VU-002'
+        db.session.commit()
+        assert self.read('VPSs_jinja')[0] == 'VU-002'
+
+        # From the VPS side
+        Vps.query.one().accounts = []
+        db.session.commit()
+        assert self.read('VPSs_jinja')[0] == ''
+
+    def test_other_rows_are_kept(self):
+        self.read('days_to_topup')
+        db.session.add(Account(adwords_id='123-456-0002'))
+        db.session.commit()
+        assert self.read('days_to_topup') == (3, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
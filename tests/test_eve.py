@@ -0,0 +1,199 @@
+import base64
+import json
+import unittest
+
+from flask import url_for
+from portal.account.models import Account
+from portal.api import eve
+from portal.api.eve import check_auth, drain_eve_queue
+from portal.api.models import EveSubmission
+from portal.cache import eve_credentials
+from portal.models import db
+from portal.vps.models import Vps
+from sqlalchemy import event
+from sqlalchemy_continuum import version_class
+from tests import BaseTestCase
+
+
+def entry(adwords_id, nickname='nickname', daily_budget='$10.00',
+          account_budget='$500.00', remaining_account_budget='$400.00'):
+    return dict(adwords_id=adwords_id, nickname=nickname, daily_budget=daily_budget,
+                account_budget=account_budget,
+                remaining_account_budget=remaining_account_budget)
+
+
+class EveTest(BaseTestCase):
+
+    def setUp(self):
+        super(EveTest, self).setUp()
+
+        self.vps = Vps(name='AWS-JP-001', provider='AWS', country='Tokyo',
+                       login='login', password='password')
+        db.session.add(self.vps)
+        for adwords_id in ['123-456-0001', '123-456-0002']:
+            db.session.add(Account(adwords_id=adwords_id))
+        db.session.commit()
+
+    def post(self, entries, status_code=200):
+        auth = base64.b64encode('%s:%s' % (self.vps.api_key, self.vps.api_secret))
+        r = self.client.post(url_for('eve.update_accounts'),
+                             data=json.dumps({'response': entries}),
+                             headers={'Authorization': 'Basic ' + auth})
+        assert r.status_code == status_code
+        return json.loads(r.data)
+
+    def test_update(self):
+        ret = self.post([entry('123-456-0001'), entry('123-456-0002', nickname='two')])
+        assert ret['updated_count'] == 2
+        assert ret['errors'] == {}
+
+        act = Account.query.filter(Account.adwords_id == '123-456-0002').one()
+        assert act.nickname == 'two'
+        assert act.currency == '$'
+        assert act.account_budget == 500
+        assert act.remaining_account_budget == 400
+        assert act.daily_budget == 10
+        assert act.last_visited_by_eve is not None
+
+    def test_bad_rows_do_not_roll_back_good_rows(self):
+        ret = self.post([entry('123-456-0001', nickname='one'),
+                         entry('123-456-0002', account_budget='bad'),
+                         entry('999-999-9999')])
+        assert ret['updated_count'] == 1
+        assert set(ret['errors']) == set(['123-456-0002', '999-999-9999'])
+
+        act = Account.query.filter(Account.adwords_id == '123-456-0001').one()
+        assert act.nickname == 'one'
+
+    def test_database_errors_are_isolated(self):
+        # nickname is a VARCHAR(48) so the bulk commit fails
+        ret = self.post([entry('123-456-0001', nickname='one'),
+                         entry('123-456-0002', nickname='x' * 100)])
+        assert ret['updated_count'] == 1
+        assert set(ret['errors']) == set(['123-456-0002'])
+
+        act = Account.query.filter(Account.adwords_id == '123-456-0001').one()
+        assert act.nickname == 'one'
+
+    def test_unchanged_values_are_not_versioned(self):
+        AccountVersion = version_class(Account)
+        self.post([entry('123-456-0001')])
+        count = AccountVersion.query.count()
+        first_visit = Account.query.filter(Account.adwords_id == '123-456-0001').one()\
+            .last_visited_by_eve
+
+        ret = self.post([entry('123-456-0001')])
+        assert ret['updated_count'] == 1
+        assert AccountVersion.query.count() == count
+
+        act = Account.query.filter(Account.adwords_id == '123-456-0001').one()
+        assert act.last_visited_by_eve >= first_visit
+
+        self.post([entry('123-456-0001', nickname='changed')])
+        assert AccountVersion.query.count() == count + 1
+
+    def test_async_ingest(self):
+        self.app.config['EVE_ASYNC_INGEST'] = True
+        ret = self.post([entry('123-456-0001', nickname='one')], status_code=202)
+        assert ret['queued']
+        self.post([entry('123-456-0001', nickname='two'), entry('999-999-9999')],
+                  status_code=202)
+
+        depth, lag = EveSubmission.get_stats()
+        assert depth == 2
+        assert Account.query.filter(Account.adwords_id == '123-456-0001').one().nickname is None
+
+        assert drain_eve_queue(10) == 2
+        assert drain_eve_queue(10) == 0
+        assert EveSubmission.get_stats()[0] == 0
+
+        # Later submissions win
+        act = Account.query.filter(Account.adwords_id == '123-456-0001').one()
+        assert act.nickname == 'two'
+
+        second = EveSubmission.query.get(ret['submission_id'] + 1)
+        assert second.updated_count == 1
+        assert json.loads(second.errors).keys() == ['999-999-9999']
+
+    def test_malformed_submissions(self):
+        EveSubmission.enqueue(json.dumps({'response': 5}))
+        EveSubmission.enqueue(json.dumps({'response': [
+            5, {'adwords_id': ['123-456-0002']}, entry('123-456-0001', nickname='one')]}))
+
+        assert drain_eve_queue(10) == 2
+        assert EveSubmission.get_stats()[0] == 0
+        first, second = EveSubmission.query.order_by(EveSubmission.id)
+        assert json.loads(first.errors).keys() == ['payload']
+        assert second.updated_count == 1
+        assert sorted(json.loads(second.errors).keys()) == ['row-0', 'row-1']
+        act = Account.query.filter(Account.adwords_id == '123-456-0001').one()
+        assert act.nickname == 'one'
+
+    def test_raising_submission_is_marked_processed(self):
+        ingest_accounts = eve.ingest_accounts
+
+        def raising(entries):
+            if any(dic.get('nickname') == 'raise' for dic in entries):
+                raise RuntimeError('boom')
+            return ingest_accounts(entries)
+
+        EveSubmission.enqueue(json.dumps({'response': [entry('123-456-0001', nickname='raise')]}))
+        EveSubmission.enqueue(json.dumps({'response': [entry('123-456-0002', nickname='two')]}))
+        eve.ingest_accounts = raising
+        try:
+            assert drain_eve_queue(10) == 2
+        finally:
+            eve.ingest_accounts = ingest_accounts
+
+        assert EveSubmission.get_stats()[0] == 0
+        first, second = EveSubmission.query.order_by(EveSubmission.id)
+        assert json.loads(first.errors) == {'submission': 'boom'}
+        assert second.updated_count == 1
+        act = Account.query.filter(Account.adwords_id == '123-456-0002').one()
+        assert act.nickname == 'two'
+
+    def _update_vps(self, **data):
+        """Saves the VPS through the admin view, while a concurrent request verifies
+        the old credentials right before the commit.
+        """
+        view = self.app.view_functions['vps.edit_view'].__self__
+        old_credentials = self.vps.api_key, self.vps.api_secret
+        session = db.session()
+        recache = lambda session: eve_credentials.set_verified(*old_credentials)
+        event.listen(session, 'before_commit', recache)
+        try:
+            with self.app.test_request_context():
+                form = view.edit_form(obj=self.vps)
+                for name, value in data.iteritems():
+                    getattr(form, name).data = value
+                assert view.update_model(form, self.vps)
+        finally:
+            event.remove(session, 'before_commit', recache)
+
+    def test_credentials_are_cached(self):
+        api_key, api_secret = self.vps.api_key, self.vps.api_secret
+        assert check_auth(api_key, api_secret)
+        assert not check_auth(api_key, 'wrong')
+        assert eve_credentials.is_verified(api_key, api_secret)
+        assert not eve_credentials.is_verified(api_key, 'wrong')
+
+        # Changed behind the cache's back, the cached secret is still accepted
+        Vps.query.filter(Vps.id == self.vps.id).update({'api_secret': 'new-secret'})
+        db.session.commit()
+        assert check_auth(api_key, api_secret)
+
+    def test_credentials_are_revoked_on_save(self):
+        api_key, api_secret = self.vps.api_key, self.vps.api_secret
+        assert check_auth(api_key, api_secret)
+
+        self._update_vps(api_secret='new-secret')
+        assert not check_auth(api_key, api_secret)
+        assert check_auth(api_key, 'new-secret')
+
+        self._update_vps(api_key='new-key')
+        assert not check_auth(api_key, 'new-secret')
+        assert check_auth('new-key', 'new-secret')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import shutil
+import tempfile
+import unittest
+
+from portal.account.models import Account
+from portal.cache import cache
+from portal.config import TestingConfig
+from portal.models import db
+from portal.permission.models import Permission
+from portal.user.models import find_or_create_user
+from portal.vendor.models import Vendor
+from sqlalchemy import event
+from tests import BaseTestCase
+
+
+class CustomConfig(TestingConfig):
+    CACHE_TYPE = 'filesystem'
+
+
+class SimpleCacheConfig(CustomConfig):
+    CACHE_TYPE = 'simple'
+
+
+class PermissionTestCase(BaseTestCase):
+    config = CustomConfig
+
+    def setUp(self):
+        self.config.CACHE_DIR = tempfile.mkdtemp()
+        super(PermissionTestCase, self).setUp()
+        cache.clear()
+
+        self.vendor = Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact')
+        self.users = [find_or_create_user('client%d' % i, 'client', 'client')
+                      for i in xrange(4)]
+        self.account = Account(adwords_id='123-456-0001', vendor=self.vendor)
+        db.session.add(self.account)
+        db.session.commit()
+
+        for user in self.users[:2] + self.users[3:]:
+            db.session.add(Permission(vendor=self.vendor, user=user))
+        db.session.commit()
+
+    def tearDown(self):
+        super(PermissionTestCase, self).tearDown()
+        shutil.rmtree(self.config.CACHE_DIR)
+
+    def _count_statements(self, f):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            f()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return len(statements)
+
+
+class PermissionIndexTest(PermissionTestCase):
+
+    def test_index(self):
+        ids = [user.id for user in self.users]
+        assert self.account.clients_allowed == '%d-%d, %d' % (ids[0], ids[1], ids[3])
+        assert Permission.check(self.vendor, self.users[0])
+        assert not Permission.check(self.vendor, self.users[2])
+
+        # Read from the index alone
+        def read():
+            assert Permission.check(self.vendor, self.users[1])
+            assert self.account.clients_allowed
+        assert self._count_statements(read) == 0
+
+    def test_rebuilt_on_writes(self):
+        assert not Permission.check(self.vendor, self.users[2])
+        db.session.add(Permission(vendor=self.vendor, user=self.users[2]))
+        db.session.commit()
+        assert Permission.check(self.vendor, self.users[2])
+        assert self.account.clients_allowed == '%d-%d' % (self.users[0].id, self.users[3].id)
+
+        Permission.query.filter(Permission.vendor_id == self.vendor.id).delete()
+        db.session.commit()
+        assert not Permission.check(self.vendor, self.users[0])
+        assert self.account.clients_allowed == 'Vendor permissions not defined.'
+
+    def test_uncommitted_permissions_are_left_out(self):
+        db.session.add(Permission(vendor=self.vendor, user=self.users[2]))
+        db.session.flush()
+        assert not Permission.check(self.vendor, self.users[2])
+        db.session.commit()
+        assert Permission.check(self.vendor, self.users[2])
+
+
+class PermissionFallbackTest(PermissionTestCase):
+    """A per process cache never sees the invalidations of the other workers.
+    """
+    config = SimpleCacheConfig
+
+    def test_other_workers_writes_are_seen(self):
+        assert not Permission.check(self.vendor, self.users[2])
+        assert self.account.clients_allowed == '%d-%d, %d' % tuple(
+            self.users[i].id for i in (0, 1, 3))
+
+        # Written behind the back of this process: no invalidation takes place
+        db.engine.execute(Permission.__table__.insert().values(
+            vendor_id=self.vendor.id, user_id=self.users[2].id))
+        db.engine.execute(Permission.__table__.delete().where(
+            Permission.user_id == self.users[0].id))
+        assert Permission.check(self.vendor, self.users[2])
+        assert not Permission.check(self.vendor, self.users[0])
+        assert self.account.clients_allowed == '%d-%d' % (self.users[1].id, self.users[3].id)
+
+
+if __name__ == '__main__':
+    unittest.main()
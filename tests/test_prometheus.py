@@ -0,0 +1,147 @@
+import base64
+import json
+import unittest
+
+from flask import url_for
+from portal.account.models import Account, AccountStatus
+from portal.cache import cache, prometheus_credentials
+from portal.models import db
+from portal.user.models import User, find_or_create_user
+from portal.vendor.models import Vendor
+from portal.vps.models import Vps
+from sqlalchemy import event
+from sqlalchemy.sql import func
+from tests import BaseTestCase
+
+
+class PrometheusTest(BaseTestCase):
+
+    def setUp(self):
+        super(PrometheusTest, self).setUp()
+        self._fixtures()
+        cache.clear()
+
+    def _fixtures(self):
+        find_or_create_user(self.app.config['PROMETHEUS_API_LOGIN'], 'secret', 'prometheus')
+        client = find_or_create_user('client', 'client', 'client')
+        client.id = self.app.config['WHALESMEDIA_USER_ID']
+
+        vendor = Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact')
+        aws = Vps(name='AWS-JP-001', provider='AWS', country='Tokyo',
+                  login='login', password='password')
+        vultr_1 = Vps(name='VU-002', provider='Vultr', country='Tokyo',
+                      login='login', password='password')
+        vultr_2 = Vps(name='VU-001', provider='Vultr', country='Tokyo',
+                      login='login', password='password')
+
+        self.act1 = Account(adwords_id='123-456-0001', status=AccountStatus.ACTIVE,
+                            login='mcc', account_budget=500, remaining_account_budget=400,
+                            daily_budget=10, exchange_rate=7.8, client=client,
+                            vendor=vendor, VPSs=[vultr_1, aws])
+        self.act2 = Account(adwords_id='123-456-0002', account_budget=500,
+                            account_budget_override=300, remaining_account_budget=100,
+                            exchange_rate=1, client=client, VPSs=[vultr_1, vultr_2])
+        # Not a client account
+        self.act3 = Account(adwords_id='123-456-0003')
+        db.session.add_all([self.act1, self.act2, self.act3])
+        db.session.commit()
+
+    def get(self, endpoint, status_code=200, headers=None, **kwargs):
+        auth = base64.b64encode('%s:%s' % (self.app.config['PROMETHEUS_API_LOGIN'], 'secret'))
+        headers = dict(headers or {}, Authorization='Basic ' + auth)
+        r = self.client.get(url_for(endpoint, **kwargs), headers=headers)
+        assert r.status_code == status_code
+        return r
+
+    def test_list_accounts(self):
+        ret = json.loads(self.get('prometheus.list_accounts').data)
+        assert set(ret) == set(['123-456-0001', '123-456-0002'])
+
+        assert ret['123-456-0001'] == dict(
+            status='ACTIVE', daily_budget_in_hkd=78.0, spent_in_hkd=780.0, login='mcc',
+            vendor_nickname='V1', vps='AWS-JP-001')
+
+        # Matches the model's properties, overrides included
+        act2 = ret['123-456-0002']
+        assert act2['spent_in_hkd'] == round(self.act2.spent_in_hkd, 2) == 200.0
+        assert act2['daily_budget_in_hkd'] == 0
+        assert act2['vendor_nickname'] is None
+        assert act2['vps'] == self.act2.VPSs_jinja == 'VU-001, VU-002'
+
+    def test_list_accounts_stream(self):
+        r = self.get('prometheus.list_accounts', stream=1)
+        assert r.mimetype == 'application/json'
+        streamed = json.loads(r.data)
+        assert streamed == json.loads(self.get('prometheus.list_accounts').data)
+
+    def test_list_accounts_etag(self):
+        etag = self.get('prometheus.list_accounts').headers['ETag']
+        r = self.get('prometheus.list_accounts', 304, {'If-None-Match': etag})
+        assert r.data == ''
+
+        # Streaming is a different representation
+        self.get('prometheus.list_accounts', 200, {'If-None-Match': etag}, stream=1)
+
+        # Moving an account to another VPS does not touch accounts.updated_at
+        self.act2.VPSs = self.act2.VPSs[:1]
+        db.session.commit()
+        r = self.get('prometheus.list_accounts', 200, {'If-None-Match': etag})
+        assert r.headers['ETag'] != etag
+        etag = r.headers['ETag']
+
+        self.act1.status = AccountStatus.SUSPENDED
+        db.session.commit()
+        r = self.get('prometheus.list_accounts', 200, {'If-None-Match': etag})
+        assert json.loads(r.data)['123-456-0001']['status'] == 'SUSPENDED'
+
+    def test_metrics(self):
+        r = self.get('prometheus.metrics')
+        assert r.mimetype == 'text/plain'
+        lines = r.data.splitlines()
+
+        assert '# TYPE portal_account_spent_hkd gauge' in lines
+        assert 'portal_account_spent_hkd{adwords_id="123-456-0001",status="ACTIVE",' \
+            'vendor="V1",vps="AWS-JP-001"} 780.0' in lines
+        assert not [l for l in lines if '123-456-0003' in l]
+
+        assert 'portal_vendor_accounts{status="UNINITIALIZED",vendor=""} 2.0' in lines
+        assert 'portal_vps_accounts{status="UNINITIALIZED",vps="VU-002"} 1.0' in lines
+        assert 'portal_vps_accounts{status="ACTIVE",vps="VU-002"} 1.0' in lines
+        assert 'portal_eve_queue_depth 0.0' in lines
+        assert [l for l in lines if l.startswith('portal_entity_cache_hits ')]
+        assert not [l for l in lines if l.startswith('portal_account_eve_age_seconds')]
+
+        # Served from the cache until PROMETHEUS_METRICS_CACHE_TIMEOUT
+        self.act1.last_visited_by_eve = func.now()
+        db.session.commit()
+        assert self.get('prometheus.metrics').data == r.data
+
+        cache.delete('prometheus_metrics')
+        lines = self.get('prometheus.metrics').data.splitlines()
+        assert [l for l in lines
+                if l.startswith('portal_account_eve_age_seconds{adwords_id="123-456-0001"}')]
+
+    def test_credentials_are_revoked_on_save(self):
+        """The password is changed through the admin view, while a concurrent request
+        verifies the old one right before the commit.
+        """
+        login = self.app.config['PROMETHEUS_API_LOGIN']
+        user = User.query.filter(User.username == login).one()
+        view = self.app.view_functions['admin_user.edit_view'].__self__
+
+        session = db.session()
+        recache = lambda session: prometheus_credentials.set_verified(login, 'secret')
+        event.listen(session, 'before_commit', recache)
+        try:
+            with self.app.test_request_context():
+                form = view.edit_form(obj=user)
+                form.plain_password.data = 'new-secret'
+                assert view.update_model(form, user)
+        finally:
+            event.remove(session, 'before_commit', recache)
+
+        self.get('prometheus.list_accounts', 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
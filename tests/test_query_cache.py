@@ -0,0 +1,86 @@
+import unittest
+
+from flask_sqlalchemy_cache import FromCache
+from portal.account.models import Account
+from portal.api.eve import touch_last_visited_by_eve
+from portal.cache import cache
+from portal.models import db
+from portal.utils.query_cache import TRACKED_TABLES, get_generations
+from portal.vendor.models import Vendor
+from sqlalchemy import event
+from tests import BaseTestCase
+
+
+class QueryCacheTest(BaseTestCase):
+
+    def setUp(self):
+        super(QueryCacheTest, self).setUp()
+        cache.clear()
+
+        self.vendor = Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact')
+        db.session.add(Account(adwords_id='123-456-0001', nickname='nick', vendor=self.vendor))
+        db.session.commit()
+
+    def query(self):
+        """Returns (nicknames, number of statements executed).
+        """
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            nicknames = [a.nickname for a in Account.query.options(FromCache(cache))
+                         .order_by(Account.id)]
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return nicknames, len(statements)
+
+    def test_cached(self):
+        assert self.query() == (['nick'], 1)
+        assert self.query() == (['nick'], 0)
+
+    def test_flush(self):
+        self.query()
+        Account.query.one().nickname = 'changed'
+        db.session.commit()
+        assert self.query() == (['changed'], 1)
+
+        # Pending changes are flushed first
+        db.session.add(Account(adwords_id='123-456-0002', nickname='new'))
+        nicknames, count = self.query()
+        assert nicknames == ['changed', 'new']
+
+    def test_related_table(self):
+        self.query()
+        generations = get_generations()
+        self.vendor.nickname = 'V2'
+        db.session.commit()
+        changed = [t for t, a, b in zip(TRACKED_TABLES, generations, get_generations())
+                   if a != b]
+        assert changed == ['vendors']
+
+    def test_bulk_update(self):
+        self.query()
+        Account.query.update({'nickname': 'bulk'}, synchronize_session=False)
+        db.session.commit()
+        assert self.query() == (['bulk'], 1)
+
+    def test_core_update(self):
+        self.query()
+        generations = get_generations()
+        touch_last_visited_by_eve([Account.query.one().id])
+        db.session.commit()
+        assert get_generations() != generations
+
+    def test_evicted_generation(self):
+        self.query()
+        cache.delete('query-generation-accounts')
+        assert self.query()[1] == 1
+
+    def test_yield_per_is_not_cached(self):
+        query = Account.query.options(FromCache(cache)).yield_per(10)
+        assert [a.nickname for a in query] == ['nick']
+        assert self.query()[1] == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
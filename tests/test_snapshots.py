@@ -0,0 +1,102 @@
+import unittest
+from datetime import datetime, time, timedelta
+
+from portal.account.models import (HKTZ, Account, AccountSnapshot, AccountStatus,
+                                   get_hkt_day_start)
+from portal.account.widgets import ActiveAccountsWidget, TotalSpendWidget
+from portal.models import db
+from portal.user import RolesEnum
+from portal.user.models import find_or_create_role, find_or_create_user
+from tests import BaseTestCase
+
+
+def hkt(day, hour):
+    return HKTZ.localize(datetime.combine(day, time(hour)))
+
+
+class AccountSnapshotTest(BaseTestCase):
+
+    def setUp(self):
+        super(AccountSnapshotTest, self).setUp()
+
+        self.client_user = find_or_create_user('client', 'client', 'client')
+        self.client_user.roles.append(find_or_create_role(RolesEnum.CLIENT.value))
+        db.session.commit()
+
+        self.today = datetime.now(HKTZ).date()
+        self.days = [self.today - timedelta(days=i) for i in reversed(xrange(5))]
+
+    def _update(self, account, dt, **kwargs):
+        for k, v in kwargs.iteritems():
+            setattr(account, k, v)
+        account.updated_at = dt
+        db.session.add(account)
+        db.session.commit()
+
+    def _fixtures(self):
+        """Day 0: created at 10:00 and spends 10 more at 20:00
+        Day 2: suspended
+        """
+        d = self.days
+        self.act = Account(adwords_id='123-456-0001', client=self.client_user,
+                           exchange_rate=2, account_budget=100, daily_budget=5)
+        self._update(self.act, hkt(d[0], 10), status=AccountStatus.ACTIVE,
+                     remaining_account_budget=90)
+        self._update(self.act, hkt(d[0], 20), remaining_account_budget=80)
+        self._update(self.act, hkt(d[2], 10), status=AccountStatus.SUSPENDED)
+
+    def test_take(self):
+        self._fixtures()
+        d = self.days
+
+        assert AccountSnapshot.take(until=d[3]) == 4
+        snapshots = AccountSnapshot.query.order_by(AccountSnapshot.day).all()
+        assert [s.day for s in snapshots] == d[:4]
+        assert [s.remaining_account_budget for s in snapshots] == [80] * 4
+        assert [s.status for s in snapshots] == [AccountStatus.ACTIVE] * 2 + \
+            [AccountStatus.SUSPENDED] * 2
+        assert [s.was_active for s in snapshots] == [True, True, True, False]
+        assert snapshots[0].spent_in_hkd == 40
+
+        # Incremental, carrying the state of the last snapshot
+        assert AccountSnapshot.take(until=d[3]) == 0
+        self._update(self.act, hkt(d[4], 10), remaining_account_budget=70)
+        assert AccountSnapshot.take(until=d[4]) == 1
+        snapshot = AccountSnapshot.query.filter(AccountSnapshot.day == d[4]).one()
+        assert snapshot.remaining_account_budget == 70
+        assert snapshot.status == AccountStatus.SUSPENDED
+
+    def test_day_boundaries_are_hkt(self):
+        d = self.days
+        act = Account(adwords_id='123-456-0001', client=self.client_user)
+        # 23:30 HKT is still the same day even though it is 15:30 UTC
+        self._update(act, hkt(d[0], 23) + timedelta(minutes=30),
+                     status=AccountStatus.ACTIVE)
+        self._update(act, get_hkt_day_start(d[1]), status=AccountStatus.SUSPENDED)
+
+        AccountSnapshot.take(until=d[1])
+        statuses = [s.status for s in AccountSnapshot.query.order_by(AccountSnapshot.day)]
+        assert statuses == [AccountStatus.ACTIVE, AccountStatus.SUSPENDED]
+
+    def test_widgets_read_snapshots(self):
+        self._fixtures()
+
+        # Without snapshots the widgets fall back to accounts_version
+        users, before = TotalSpendWidget().get_data()
+
+        assert AccountSnapshot.take() == 4
+        users, after = TotalSpendWidget().get_data()
+        assert after == before
+        assert [r.get(self.client_user.id) for r in after] == [None, None, 40, 40, 40, 40, 40]
+
+        # Suspended during the day before yesterday, after being active
+        [(user_id, unified)] = ActiveAccountsWidget().get_data()
+        assert user_id == self.client_user.id
+        assert unified[0] == ['123-456-0001']
+        assert unified[1][0].spent_in_hkd == 40
+        assert unified[2] == [None]
+        assert unified[3] == [None]
+
+
+if __name__ == '__main__':
+    unittest.main()
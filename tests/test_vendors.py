@@ -0,0 +1,78 @@
+import unittest
+
+from flask import url_for
+from portal.account.models import Account, AccountStatus
+from portal.config import TestingConfig
+from portal.models import db
+from portal.user import RolesEnum
+from portal.user.models import find_or_create_role, find_or_create_user
+from portal.vendor.models import Vendor
+from sqlalchemy import event
+from tests import BaseTestCase
+
+
+class CustomConfig(TestingConfig):
+    LOGIN_DISABLED = False
+
+
+class VendorListTest(BaseTestCase):
+    config = CustomConfig
+
+    def setUp(self):
+        super(VendorListTest, self).setUp()
+
+        admin = find_or_create_user('admin', 'admin', 'admin')
+        admin.roles.append(find_or_create_role(RolesEnum.ADMIN.value))
+
+        self.v1 = Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact')
+        self.v2 = Vendor(nickname='V2', company_name='Vendor 2', contact_name='Contact')
+        db.session.add_all([
+            Account(adwords_id='123-456-0001', status=AccountStatus.ACTIVE, vendor=self.v1,
+                    account_budget=100, remaining_account_budget=40, exchange_rate=2),
+            Account(adwords_id='123-456-0002', status=AccountStatus.SUSPENDED, vendor=self.v1,
+                    account_budget=100, account_budget_override=50,
+                    remaining_account_budget=40, exchange_rate=1),
+            # Spent nothing because the exchange rate is missing
+            Account(adwords_id='123-456-0003', status=AccountStatus.UNASSIGNED, vendor=self.v1,
+                    account_budget=100, remaining_account_budget=40),
+            self.v2,
+        ])
+        db.session.commit()
+
+    def test_account_stats(self):
+        assert Vendor.get_account_stats([self.v1.id, self.v2.id]) == {self.v1.id: (3, 1, 130)}
+
+        assert (self.v1.num_accounts_total, self.v1.num_accounts_unused,
+                self.v1.num_accounts_used, self.v1.total_spent_in_hkd) == (3, 1, 2, 130)
+        assert (self.v2.num_accounts_total, self.v2.num_accounts_unused,
+                self.v2.num_accounts_used, self.v2.total_spent_in_hkd) == (0, 0, 0, 0)
+
+        Vendor.set_account_stats([self.v1, self.v2])
+        assert self.v1.num_accounts_used == 2
+
+    def _count_list_view_queries(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            r = self.client.get(url_for('vendor.index_view'))
+            assert r.status_code == 200
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return len(statements)
+
+    def test_list_view(self):
+        self.client.post(url_for('user.login'), data=dict(username='admin', password='admin'))
+        count = self._count_list_view_queries()
+
+        for i in xrange(5):
+            vendor = Vendor(nickname='X%d' % i, company_name='X', contact_name='X')
+            db.session.add(Account(adwords_id='123-456-010%d' % i, vendor=vendor))
+        db.session.commit()
+
+        # Does not grow with the number of vendors
+        assert self._count_list_view_queries() == count
+
+
+if __name__ == '__main__':
+    unittest.main()
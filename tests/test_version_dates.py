@@ -0,0 +1,90 @@
+import unittest
+
+from flask import url_for
+from portal.account.models import Account, AccountStatus
+from portal.cache import cache
+from portal.config import TestingConfig
+from portal.models import db
+from portal.user import RolesEnum
+from portal.user.models import find_or_create_role, find_or_create_user
+from sqlalchemy import event
+from tests import BaseTestCase
+
+
+class CustomConfig(TestingConfig):
+    LOGIN_DISABLED = False
+
+
+class VersionDatesTest(BaseTestCase):
+    config = CustomConfig
+
+    def setUp(self):
+        super(VersionDatesTest, self).setUp()
+        cache.clear()
+
+        admin = find_or_create_user('admin', 'admin', 'admin')
+        admin.roles.append(find_or_create_role(RolesEnum.ADMIN.value))
+
+        self.act1 = Account(adwords_id='123-456-0001')
+        self.act2 = Account(adwords_id='123-456-0002')
+        db.session.add_all([self.act1, self.act2])
+        db.session.commit()
+
+    def _set_status(self, account, status):
+        account.status = status
+        db.session.commit()
+        return account.versions[-1].updated_at
+
+    def test_version_dates(self):
+        suspended_on = self._set_status(self.act1, AccountStatus.SUSPENDED)
+        self._set_status(self.act1, AccountStatus.ACTIVE)
+        self._set_status(self.act1, AccountStatus.SUSPENDED)
+
+        dates = Account.get_version_dates([self.act1.id, self.act2.id, 0])
+        assert sorted(dates) == [self.act1.id, self.act2.id]
+        assert dates[self.act1.id][1] == suspended_on
+        assert dates[self.act2.id][1] is None
+        assert dates[self.act1.id][0] == self.act1.versions[0].transaction.issued_at
+
+        assert self.act1.suspended_on == suspended_on
+        assert self.act2.created_at == dates[self.act2.id][0].strftime('%m/%d %H:%M')
+
+    def test_preloaded(self):
+        accounts = Account.query.all()
+        Account.set_version_dates(accounts)
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            for account in accounts:
+                assert account.created_at
+                assert account.suspended_on is None
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert statements == []
+
+    def _count_list_view_queries(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            r = self.client.get(url_for('admin_account.index_view'))
+            assert r.status_code == 200
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return len([s for s in statements if 'accounts_version' in s])
+
+    def test_list_view(self):
+        self.client.post(url_for('user.login'), data=dict(username='admin', password='admin'))
+        count = self._count_list_view_queries()
+
+        db.session.add_all([Account(adwords_id='123-456-010%d' % i) for i in xrange(5)])
+        db.session.commit()
+
+        # Does not grow with the number of accounts
+        assert self._count_list_view_queries() == count
+
+
+if __name__ == '__main__':
+    unittest.main()
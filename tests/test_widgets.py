@@ -0,0 +1,186 @@
+import unittest
+from datetime import timedelta
+
+from flask import url_for
+from portal.account.models import Account, AccountStatus
+from portal.account.widgets import (AccountHistoryWidget, AttentionWidget, ExpiringWidget,
+                                    HighSpendWidget)
+from portal.cache import cache
+from portal.config import TestingConfig
+from portal.models import db
+from portal.user import RolesEnum
+from portal.user.models import find_or_create_role, find_or_create_user
+from portal.utils.widgets import refresh_widgets
+from portal.vendor.models import Vendor
+from sqlalchemy import event, func
+from tests import BaseTestCase
+
+
+class CustomConfig(TestingConfig):
+    LOGIN_DISABLED = False
+
+
+class WidgetCacheTest(BaseTestCase):
+    config = CustomConfig
+
+    def setUp(self):
+        super(WidgetCacheTest, self).setUp()
+        cache.clear()
+
+        admin = find_or_create_user('admin', 'admin', 'admin')
+        admin.roles.append(find_or_create_role(RolesEnum.ADMIN.value))
+        self.vendor = Vendor(nickname='V1', company_name='Vendor 1', contact_name='Contact')
+        db.session.add(Account(adwords_id='123-456-0001', status=AccountStatus.ATTENTION,
+                               vendor=self.vendor))
+        db.session.commit()
+
+    def _get_adwords_ids(self):
+        with self.app.test_request_context():
+            widget = AttentionWidget(role=RolesEnum.ADMIN.value)
+            data = widget.get_cached_data()
+            assert widget.as_of is not None
+            return [a.adwords_id for status, accounts in data for a in accounts]
+
+    def _age(self, widget_cls, role, seconds):
+        """Pretends that the cached result was computed `seconds` ago.
+        """
+        with self.app.test_request_context():
+            key = widget_cls(role=role).get_cache_key()
+            as_of, data = cache.get(key)
+            cache.set(key, (as_of - timedelta(seconds=seconds), data))
+
+    def test_cached_until_refreshed(self):
+        assert self._get_adwords_ids() == ['123-456-0001']
+
+        db.session.add(Account(adwords_id='123-456-0002', status=AccountStatus.ATTENTION))
+        db.session.commit()
+        assert self._get_adwords_ids() == ['123-456-0001']
+
+        # Every other variant is computed up front, fresh results are left alone
+        assert refresh_widgets(self.app) > 0
+        assert refresh_widgets(self.app) == 0
+
+        self._age(AttentionWidget, RolesEnum.ADMIN.value, AttentionWidget.cache_timeout)
+        assert refresh_widgets(self.app) == 1
+        assert self._get_adwords_ids() == ['123-456-0001', '123-456-0002']
+
+    def test_every_variant_is_refreshed(self):
+        refresh_widgets(self.app)
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            for locale in ['en', 'zh_CN']:
+                with self.app.test_request_context(query_string={'lang': locale}):
+                    AccountHistoryWidget(role=RolesEnum.SUPPORT.value).get_cached_data()
+                    AttentionWidget(role=RolesEnum.ADMIN.value).get_cached_data()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert statements == []
+
+    def test_cached_models_can_lazy_load(self):
+        self._get_adwords_ids()
+        db.session.remove()
+
+        with self.app.test_request_context():
+            [(status, [account])] = AttentionWidget(role=RolesEnum.ADMIN.value) \
+                .get_cached_data()
+            assert account.vendor.company_name == 'Vendor 1'
+
+    def test_cached_relationships_are_not_lazy_loaded(self):
+        client = find_or_create_user('client', 'client', 'client')
+        db.session.add(Account(adwords_id='123-456-0002', status=AccountStatus.ACTIVE,
+                               daily_budget=10, remaining_account_budget=10,
+                               account_budget=100, exchange_rate=1,
+                               vendor=self.vendor, client=client))
+        db.session.commit()
+        with self.app.test_request_context():
+            for cls in [ExpiringWidget, HighSpendWidget]:
+                cls(role=RolesEnum.ADMIN.value).refresh()
+        db.session.remove()
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            with self.app.test_request_context():
+                [account] = ExpiringWidget(role=RolesEnum.ADMIN.value).get_cached_data()
+                assert account.vendor.contact_name == 'Contact'
+                [account] = HighSpendWidget(role=RolesEnum.ADMIN.value).get_cached_data()
+                assert account.vendor.company_name == 'Vendor 1'
+                assert account.client.username == 'client'
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert statements == []
+
+    def test_cached_per_role(self):
+        with self.app.test_request_context():
+            admin = AccountHistoryWidget(role=RolesEnum.ADMIN.value)
+            support = AccountHistoryWidget(role=RolesEnum.SUPPORT.value)
+            assert admin.get_cache_key() != support.get_cache_key()
+
+            # Not per role
+            assert AttentionWidget(role=RolesEnum.ADMIN.value).get_cache_key() == \
+                AttentionWidget(role=RolesEnum.SUPPORT.value).get_cache_key()
+
+    def test_account_history(self):
+        account = Account.query.one()
+        account.last_visited_by_eve = func.now()
+        db.session.commit()
+        account.status = AccountStatus.ACTIVE
+        db.session.commit()
+
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            with self.app.test_request_context():
+                histories = AccountHistoryWidget(role=RolesEnum.ADMIN.value).get_data()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        # The heartbeat is left out
+        assert len(histories) == 2
+        assert 'updated status' in histories[0].content
+        assert 'created' in histories[1].content
+        assert histories[0].user == 'eve'
+        assert len(statements) == 1
+
+    def login(self, username):
+        r = self.client.post(url_for('user.login'), follow_redirects=True,
+                             data=dict(username=username, password=username))
+        assert r.status_code == 200
+        return r
+
+    def test_member_page_renders_placeholders(self):
+        r = self.login('admin')
+        assert '123-456-0001' not in r.data
+        assert 'data-url="/user/widget/AttentionWidget"' in r.data
+
+    def test_widget(self):
+        self.login('admin')
+        r = self.client.get(url_for('user.widget', name='AttentionWidget'))
+        assert r.status_code == 200
+        assert '123-456-0001' in r.data
+        assert 'As of' in r.data
+
+        for name in ['RecentStatusChangeWidget', 'AccountHistoryWidget', 'TotalSpendWidget',
+                     'HighSpendWidget', 'ExpiringWidget', 'NotUpdatedTodayWidget',
+                     'ActiveAccountsWidget']:
+            assert self.client.get(url_for('user.widget', name=name)).status_code == 200
+
+        assert self.client.get(url_for('user.widget', name='Widget')).status_code == 404
+        assert self.client.get(url_for('user.widget', name='Nope')).status_code == 404
+
+    def test_widget_is_accessible(self):
+        client = find_or_create_user('client', 'client', 'client')
+        client.roles.append(find_or_create_role(RolesEnum.CLIENT.value))
+        db.session.commit()
+
+        self.login('client')
+        r = self.client.get(url_for('user.widget', name='AttentionWidget'))
+        assert r.status_code == 403
+
+if __name__ == '__main__':
+    unittest.main()